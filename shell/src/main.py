@@ -60,7 +60,8 @@ def run(stdin, stdout, stderr, argv):
     bdb = bayeslite.bayesdb_open(pathname=args.bdbpath,
         builtin_backends=False)
 
-    multiprocess = args.jobs != 1
+    # -j N analyzes models in N processes; -j 0 in one per CPU.
+    multiprocess = args.jobs if args.jobs > 1 else args.jobs != 1
     backend = CGPM_Backend(cgpm_registry={}, multiprocess=multiprocess)
     bayeslite.bayesdb_register_backend(bdb, backend)
     bdbshell = shell.Shell(bdb, 'cgpm', stdin, stdout, stderr)
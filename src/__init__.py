@@ -68,6 +68,7 @@ from bayeslite.quote import bql_quote_name
 from bayeslite.read_csv import bayesdb_read_csv
 from bayeslite.read_csv import bayesdb_read_csv_file
 from bayeslite.schema import bayesdb_upgrade_schema
+from bayeslite.similarity import bayesdb_row_similarities
 from bayeslite.txn import BayesDBTxnError
 from bayeslite.version import __version__
 
@@ -85,6 +86,7 @@ __all__ = [
     'bayesdb_read_csv',
     'bayesdb_read_csv_file',
     'bayesdb_register_backend',
+    'bayesdb_row_similarities',
     'bayesdb_upgrade_schema',
     'bql_quote_name',
     'BayesDB_Backend',
@@ -41,6 +41,9 @@ the table::
        print x
 """
 
+import numpy
+
+from bayeslite.stats import arithmetic_mean
 from bayeslite.util import cursor_value
 
 builtin_backends = []
@@ -112,10 +115,44 @@ class BayesDB_Backend(object):
 
         The boolean variable `switch` toggles between single (`False`) and multi
         (`True`) processing, if the choice is available, and otherwise ignores
-        the request.
+        the request.  Backends may also accept a number of processes.
         """
         raise NotImplementedError
 
+    def prepare_concurrent(self, bdb, generator_id, memo, method, *args,
+            **kwargs):
+        """Prepare the query method `method` to run away from the query.
+
+        Called in the thread executing the query, when a BQL function
+        combines several generators, with the arguments `method` would
+        be called with after `bdb` and `generator_id`.  Return None to
+        have `method` called as usual, in turn.  Otherwise read from
+        `bdb` everything `method` needs and return ``(executor,
+        function, args)`` such that ``function(*args)`` returns what
+        `method` would, without using `bdb`:  no SQL, no catalog
+        lookups, no BayesDB PRNGs.  `executor` is
+
+        - ``'thread'`` to call it in a thread of this process, e.g. if
+          it waits on a server process; or
+        - ``'process'`` to call it in a worker process dedicated to the
+          generator, in which case `function` must be a module-level
+          function and `args` picklable.
+
+        `memo` is a dict that persists with the worker process of the
+        generator, and is empty whenever it is new, so that a backend
+        can remember what it has sent there before.
+
+        The default returns None.
+        """
+        return None
+
+    def cache_stats(self, bdb):
+        """Return a dict of statistics about in-memory caches for `bdb`.
+
+        Backends that keep no caches return an empty dict.
+        """
+        return {}
+
     def create_generator(self, bdb, table, schema, **kwargs):
         """Create a generator for a table with the given schema.
 
@@ -206,6 +243,24 @@ class BayesDB_Backend(object):
         """Compute ``DEPENDENCE PROBABILITY OF <col0> WITH <col1>``."""
         raise NotImplementedError
 
+    def column_dependence_probability_matrix(self, bdb, generator_id,
+            modelnos, colnos):
+        """Compute ``DEPENDENCE PROBABILITY`` of each pair of `colnos`.
+
+        Returns a list of lists `m` with ``m[i][j]`` the result of
+        :meth:`column_dependence_probability` for ``colnos[i]`` and
+        ``colnos[j]``.
+
+        The default implementation calls
+        :meth:`column_dependence_probability` for each pair.
+        """
+        return [
+            [self.column_dependence_probability(
+                bdb, generator_id, modelnos, colno0, colno1)
+                for colno1 in colnos]
+            for colno0 in colnos
+        ]
+
     def column_mutual_information(self, bdb, generator_id, modelnos, colnos0,
             colnos1, constraints=None, numsamples=100):
         """Compute ``MUTUAL INFORMATION OF (<cols0>) WITH (<cols1>)``."""
@@ -216,6 +271,43 @@ class BayesDB_Backend(object):
         """Compute ``SIMILARITY TO <target_row>`` for given `rowid`."""
         raise NotImplementedError
 
+    def row_similarity_many(self, bdb, generator_id, modelnos, queries,
+            colnos):
+        """Compute ``SIMILARITY`` for each of `queries` in context `colnos`.
+
+        `queries` is a list of ``(rowid, target_rowid)`` pairs.  Returns a
+        list with the result of :meth:`row_similarity` for each pair.
+
+        The default implementation calls :meth:`row_similarity` for each
+        pair.
+        """
+        return [
+            self.row_similarity(
+                bdb, generator_id, modelnos, rowid, target_rowid, colnos)
+            for rowid, target_rowid in queries
+        ]
+
+    def row_similarity_blocks(self, bdb, generator_id, modelnos, rowids,
+            colnos, block_size=256):
+        """Compute the ``SIMILARITY`` matrix of `rowids` in context `colnos`.
+
+        Yields the rows of the matrix in blocks of at most `block_size`
+        consecutive rows, each a NumPy array of shape ``(n, len(rowids))``
+        whose entry ``[i, j]`` is the similarity of the ``i``th row of the
+        block to ``rowids[j]``, averaged over the models.
+
+        The default implementation calls :meth:`row_similarity_many` for
+        each block.
+        """
+        for i in xrange(0, len(rowids), block_size):
+            block = rowids[i:i + block_size]
+            queries = [(rowid, target) for rowid in block for target in rowids]
+            similarity_lists = self.row_similarity_many(
+                bdb, generator_id, modelnos, queries, colnos)
+            similarities = map(arithmetic_mean, similarity_lists)
+            yield numpy.array(similarities, dtype=float).reshape(
+                len(block), len(rowids))
+
     def predictive_relevance(self, bdb, generator_id, modelnos, rowid_target,
             rowid_query, hypotheticals, colno):
         """Compute predictive relevance, also known as relevance probability.
@@ -270,6 +362,24 @@ class BayesDB_Backend(object):
         """
         raise NotImplementedError
 
+    def simulate_joint_many(self, bdb, generator_id, modelnos, queries,
+            num_samples=1, accuracy=None):
+        """Simulate for each of `queries`.
+
+        `queries` is a list of ``(rowid, targets, constraints)`` triples
+        as for :meth:`simulate_joint`.  Returns a list with the list of
+        `num_samples` samples for each query.
+
+        The default implementation calls :meth:`simulate_joint` for each
+        query.
+        """
+        return [
+            self.simulate_joint(
+                bdb, generator_id, modelnos, rowid, targets, constraints,
+                num_samples=num_samples, accuracy=accuracy)
+            for rowid, targets, constraints in queries
+        ]
+
     def logpdf_joint(self, bdb, generator_id, modelnos, rowid, targets,
             constraints):
         """Evalute the joint probability of `targets` subject to `constraints`.
@@ -285,3 +395,19 @@ class BayesDB_Backend(object):
         `modelno` is a model number or `None`, meaning all models.
         """
         raise NotImplementedError
+
+    def logpdf_joint_many(self, bdb, generator_id, modelnos, queries):
+        """Evaluate the joint probability for each of `queries`.
+
+        `queries` is a list of ``(rowid, targets, constraints)`` triples
+        as for :meth:`logpdf_joint`.  Returns a list with the log density
+        for each query.
+
+        The default implementation calls :meth:`logpdf_joint` for each
+        query.
+        """
+        return [
+            self.logpdf_joint(
+                bdb, generator_id, modelnos, rowid, targets, constraints)
+            for rowid, targets, constraints in queries
+        ]
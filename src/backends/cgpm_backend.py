@@ -17,17 +17,31 @@
 import itertools
 import json
 import math
+import multiprocessing
+import numpy
+import sys
+import time
+import weakref
 
 from collections import Counter
+from collections import OrderedDict
 from collections import defaultdict
+from collections import deque
 
 from cgpm.crosscat.engine import Engine
+from cgpm.crosscat.state import State
 
 import bayeslite.core as core
 
 from bayeslite.exception import BQLError
 from bayeslite.backend import BayesDB_Backend
 from bayeslite.backend import bayesdb_backend_version
+from bayeslite.backends.cgpm_engine_format import ENGINE_FORMAT_STATES
+from bayeslite.backends.cgpm_engine_format import engine_dumps
+from bayeslite.backends.cgpm_engine_format import engine_format_loads
+from bayeslite.backends.cgpm_engine_format import engine_loads
+from bayeslite.backends.cgpm_engine_format import partition_dumps
+from bayeslite.backends.cgpm_engine_format import partition_loads
 from bayeslite.sqlite3_util import sqlite3_quote_name
 from bayeslite.util import casefold
 from bayeslite.util import cursor_value
@@ -96,10 +110,57 @@ INSERT INTO bayesdb_cgpm_modelno (generator_id, modelno, cgpm_modelno)
     );
 '''
 
+# Engines written from version 4 on are stored in engine_json in the
+# binary format of cgpm_engine_format, as recorded in engine_format.
+# Existing JSON engines are read as they are, and rewritten in the
+# binary format the next time they are analyzed.
+CGPM_SCHEMA_4 = '''
+UPDATE bayesdb_backend SET version = 4 WHERE name = 'cgpm';
+
+ALTER TABLE bayesdb_cgpm_generator
+    ADD COLUMN engine_format
+    INTEGER NOT NULL DEFAULT 0;
+'''
+
+# From version 5 on, each state of an engine is stored in its own row of
+# bayesdb_cgpm_state, with the stamp of the engine when it was last
+# written, so that ANALYZE of some models rewrites only those and queries
+# of some models read only those.  The rest of the engine metadata stays
+# in engine_json, with engine_format ENGINE_FORMAT_STATES.  Existing
+# engines are split into states the next time they are analyzed.
+CGPM_SCHEMA_5 = '''
+UPDATE bayesdb_backend SET version = 5 WHERE name = 'cgpm';
+
+CREATE TABLE bayesdb_cgpm_state (
+    generator_id        INTEGER NOT NULL REFERENCES bayesdb_generator(id),
+    cgpm_modelno        INTEGER NOT NULL CHECK (0 <= cgpm_modelno),
+    state_blob          BLOB NOT NULL,
+    state_stamp         INTEGER NOT NULL,
+    PRIMARY KEY(generator_id, cgpm_modelno)
+);
+'''
+
+# From version 6 on, the column and row partitions of each state are
+# stored with it in the binary format of cgpm_engine_format, so that
+# dependence probabilities and row similarities can be read from them
+# without deserializing any state.  States with foreign cgpms, and
+# states written before version 6, have none.
+CGPM_SCHEMA_6 = '''
+UPDATE bayesdb_backend SET version = 6 WHERE name = 'cgpm';
+
+ALTER TABLE bayesdb_cgpm_state ADD COLUMN partition_blob BLOB;
+'''
+
+
+# Default budget for the engines, states, and partitions held in the
+# cache of a CGPM_Backend, in estimated bytes of memory.
+CGPM_CACHE_BUDGET = 1 << 30
+
 
 class CGPM_Backend(BayesDB_Backend):
 
-    def __init__(self, cgpm_registry, multiprocess=None):
+    def __init__(self, cgpm_registry, multiprocess=None,
+            cache_budget=CGPM_CACHE_BUDGET):
         self._cgpm_registry = cgpm_registry
         self._multiprocess = multiprocess
         # The cache is a dictionary whose keys are bayeslite.BayesDB objects,
@@ -111,6 +172,16 @@ class CGPM_Backend(BayesDB_Backend):
         # import, creates a single CGPM_Backend object to be used throughout
         # the python session).
         self._cache = dict()
+        # Engines, partial engines of some states, and partitions are
+        # large, so we account for their estimated sizes in
+        # self._cache_lru, which maps (bdb, generator_id, key) to bytes
+        # in least recently used order, and evict the least recently used
+        # of them, across all bdbs, to keep the total within the budget.
+        # A budget of None is unbounded.
+        self._cache_budget = cache_budget
+        self._cache_lru = OrderedDict()
+        self._cache_bytes = 0
+        self._cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
 
     def name(self):
         return 'cgpm'
@@ -133,17 +204,67 @@ class CGPM_Backend(BayesDB_Backend):
                 # Install CGPM version 3.
                 bdb.sql_execute(CGPM_SCHEMA_3)
                 version = 3
-            if version != 3:
+            if version == 3:
+                # Install CGPM version 4.
+                bdb.sql_execute(CGPM_SCHEMA_4)
+                version = 4
+            if version == 4:
+                # Install CGPM version 5.
+                bdb.sql_execute(CGPM_SCHEMA_5)
+                version = 5
+            if version == 5:
+                # Install CGPM version 6.
+                bdb.sql_execute(CGPM_SCHEMA_6)
+                version = 6
+            if version != 6:
                 # Unrecognized version.
                 raise BQLError(bdb, 'CGPM already installed'
                     ' with unknown schema version: %d' % (version,))
 
     def set_multiprocess(self, switch):
+        # switch may also be a number of processes for ANALYZE.
         old = self._multiprocess
         self._multiprocess = switch
         return old
 
+    def analysis_stats(self, bdb, generator_id):
+        """Return statistics about the last analysis of `generator_id`.
+
+        The result is a dict mapping each model number analyzed to a
+        dict with the number of `iterations` done, the `seconds` they
+        took, their throughput in `iterations_per_second`, and the
+        number of `checkpoints` written, or None if no analysis of
+        `generator_id` is remembered.
+        """
+        stats = self._get_cache_entry(bdb, generator_id, 'analysis')
+        if stats is None:
+            return None
+        return dict((modelno, dict(stat)) for modelno, stat in stats.items())
+
+    def set_cache_budget(self, budget):
+        """Set the cache budget to `budget` bytes, or None for unbounded.
+
+        Returns the old budget.
+        """
+        old = self._cache_budget
+        self._cache_budget = budget
+        self._evict_cache_entries()
+        return old
+
+    def cache_stats(self, bdb):
+        # The cache is shared by every bdb this backend serves.
+        stats = dict(self._cache_stats)
+        stats['budget'] = self._cache_budget
+        stats['bytes'] = self._cache_bytes
+        stats['entries'] = len(self._cache_lru)
+        return stats
+
     def create_generator(self, bdb, generator_id, schema_tokens, **kwargs):
+        # Forget anything cached for an earlier generator with this id
+        # whose creation was rolled back.
+        self._del_cache_entry(bdb, generator_id, None)
+        self._forget_stamps(bdb, generator_id)
+
         schema_ast = cgpm_schema.parse.parse(schema_tokens)
         schema = _create_schema(bdb, generator_id, schema_ast, **kwargs)
 
@@ -231,6 +352,12 @@ class CGPM_Backend(BayesDB_Backend):
             DELETE FROM bayesdb_cgpm_modelno WHERE generator_id = ?
         ''', (generator_id,))
 
+        # Delete states.
+        bdb.sql_execute('''
+            DELETE FROM bayesdb_cgpm_state WHERE generator_id = ?
+        ''', (generator_id,))
+        self._forget_stamps(bdb, generator_id)
+
         # Delete generator.
         bdb.sql_execute('''
             DELETE FROM bayesdb_cgpm_generator WHERE generator_id = ?
@@ -266,6 +393,7 @@ class CGPM_Backend(BayesDB_Backend):
                         (generator_id, colno, value, code)
                         VALUES (?, ?, ?, ?)
                 ''', (generator_id, colno, value, code))
+            self._del_cache_entry(bdb, generator_id, 'categories')
 
         # Retrieve the rows from the table.
         rows = list(itertools.chain.from_iterable(
@@ -363,8 +491,16 @@ class CGPM_Backend(BayesDB_Backend):
                 DELETE FROM bayesdb_cgpm_modelno
                 WHERE generator_id = ?
             ''', (generator_id,))
+            # Delete the states.
+            bdb.sql_execute('''
+                DELETE FROM bayesdb_cgpm_state
+                WHERE generator_id = ?
+            ''', (generator_id,))
+            self._forget_stamps(bdb, generator_id)
             # Delete the engine from the cache.
             self._del_cache_entry(bdb, generator_id, 'engine')
+            self._del_cache_entry(bdb, generator_id, 'states')
+            self._del_cache_entry(bdb, generator_id, 'partitions')
         # Drop some models.
         else:
             engine = self._engine(bdb, generator_id)
@@ -399,8 +535,9 @@ class CGPM_Backend(BayesDB_Backend):
         # Get the modelnos.
         cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
 
-        # Retrieve the engine.
-        engine = self._engine(bdb, generator_id)
+        # Retrieve the engine, or just the states to alter.
+        engine, statenos = self._engine_states(
+            bdb, generator_id, cgpm_modelnos)
 
         # Find baseline variable numbers for error checking.
         vars_baseline = engine.states[0].outputs
@@ -502,15 +639,13 @@ class CGPM_Backend(BayesDB_Backend):
                     ''', (generator_id,))
                     rows0 = [c[0] for c in cursor]
                 else:
-                    unknown_rowids = []
-                    def get_cgpm_rowid(rowid_user):
-                        try:
-                            return self._cgpm_rowid(
-                                bdb, generator_id, rowid_user, nullok=False)
-                        except ValueError:
-                            unknown_rowids.append(rowid_user)
-                            return None
-                    rows0 = map(get_cgpm_rowid, clause.rows0)
+                    rows0 = self._cgpm_rowids(
+                        bdb, generator_id, clause.rows0).tolist()
+                    unknown_rowids = [
+                        rowid_user
+                        for rowid_user, row0 in zip(clause.rows0, rows0)
+                        if row0 == -1
+                    ]
                     if unknown_rowids:
                         raise BQLError(bdb,
                             'Unknown rows: %s' % (unknown_rowids,))
@@ -548,11 +683,12 @@ class CGPM_Backend(BayesDB_Backend):
                 alter_funcs.append(func)
 
         # Execute alteration functions.
-        engine.alter(alter_funcs, statenos=cgpm_modelnos,
+        engine.alter(alter_funcs, statenos=statenos,
             multiprocess=self._multiprocess)
 
-        # Serialize the engine.
-        self._serialize_engine(bdb, generator_id, engine, True)
+        # Serialize the altered states.
+        self._serialize_engine(
+            bdb, generator_id, engine, True, statenos, cgpm_modelnos)
 
     def analyze_models(
             self, bdb, generator_id, modelnos=None, iterations=None,
@@ -562,24 +698,25 @@ class CGPM_Backend(BayesDB_Backend):
         if not iterations and not max_seconds:
             return
 
-        # Checkpoint by seconds disabled.
-        if ckpt_seconds:
-            raise NotImplementedError('Checkpoint by seconds in CGPM analyze.')
-
         if program is None:
             program = []
 
         # Get the modelnos.
         cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
 
-        # Retrieve the engine.
-        engine = self._engine(bdb, generator_id)
-
         # Retrieve user-specified target variables to transition.
         analyze_ast = cgpm_analyze.parse.parse(program)
         vars_user, rowids_user, subproblems, optimized, quiet = \
             _retrieve_analyze_variables(bdb, generator_id, analyze_ast)
 
+        # Retrieve the engine, or just the states to transition.  Loom
+        # transitions every state, so it needs the whole engine.
+        if optimized and optimized.backend == 'loom':
+            engine, statenos = self._engine(bdb, generator_id), None
+        else:
+            engine, statenos = self._engine_states(
+                bdb, generator_id, cgpm_modelnos)
+
         # Explicitly suppress progress bar if quiet, otherwise use default.
         progress = False if quiet else None
 
@@ -603,15 +740,13 @@ class CGPM_Backend(BayesDB_Backend):
         # Convert the user rowids to cgpm rowids.
         rowids_cgpm = None
         if rowids_user:
-            unknown_rowids = []
-            def get_cgpm_rowid(rowid_user):
-                try:
-                    return self._cgpm_rowid(
-                        bdb, generator_id, rowid_user, nullok=False)
-                except ValueError:
-                    unknown_rowids.append(rowid_user)
-                    return None
-            rowids_cgpm = map(get_cgpm_rowid, rowids_user)
+            rowids_cgpm = self._cgpm_rowids(
+                bdb, generator_id, rowids_user).tolist()
+            unknown_rowids = [
+                rowid_user
+                for rowid_user, rowid_cgpm in zip(rowids_user, rowids_cgpm)
+                if rowid_cgpm == -1
+            ]
             if unknown_rowids:
                 raise BQLError(bdb, 'Unknown ROWS: %s' % (rowids_user,))
 
@@ -627,6 +762,11 @@ class CGPM_Backend(BayesDB_Backend):
             raise BQLError(bdb,
                 'Timed analysis accepts foreign xor baseline variables.')
 
+        # Error: Checkpoint by seconds only with the default cgpm kernels.
+        if ckpt_seconds and (optimized or vars_target_foreign):
+            raise BQLError(bdb, 'Checkpoint by seconds accepts neither'
+                ' OPTIMIZED nor foreign variables.')
+
         # Error: Targeted analysis with loom backend is not supported.
         if optimized and optimized.backend == 'loom':
             if vars_user:
@@ -653,21 +793,18 @@ class CGPM_Backend(BayesDB_Backend):
                     rowids=rowids_cgpm,
                     progress=progress,
                     checkpoint=ckpt_iterations,
-                    statenos=cgpm_modelnos,
+                    statenos=statenos,
                     multiprocess=self._multiprocess,
                 )
             else:
-                engine.transition(
-                    N=iterations,
-                    S=max_seconds,
-                    kernels=kernels,
-                    cols=vars_target_baseline,
-                    rowids=rowids_cgpm,
-                    progress=progress,
-                    checkpoint=ckpt_iterations,
-                    statenos=cgpm_modelnos,
-                    multiprocess=self._multiprocess,
-                )
+                # Checkpoints each state as it goes, so there is nothing
+                # left to serialize unless we go on to foreign variables.
+                self._analyze_states(
+                    bdb, generator_id, engine, statenos, cgpm_modelnos,
+                    iterations, max_seconds, ckpt_iterations, ckpt_seconds,
+                    kernels, vars_target_baseline, rowids_cgpm, progress)
+                if not vars_target_foreign:
+                    return
 
         # Run transitions on foreign variables.
         if vars_target_foreign:
@@ -676,12 +813,177 @@ class CGPM_Backend(BayesDB_Backend):
                 S=max_seconds,
                 cols=vars_target_foreign,
                 progress=progress,
-                statenos=cgpm_modelnos,
+                statenos=statenos,
                 multiprocess=self._multiprocess,
             )
 
-        # Serialize the engine.
-        self._serialize_engine(bdb, generator_id, engine, True)
+        # Serialize the transitioned states.
+        self._serialize_engine(
+            bdb, generator_id, engine, True, statenos, cgpm_modelnos)
+
+    def _analyze_states(self, bdb, generator_id, engine, statenos,
+            cgpm_modelnos, iterations, max_seconds, ckpt_iterations,
+            ckpt_seconds, kernels, cols, rowids, progress):
+        """Transition the states of `engine`, checkpointing each as it goes.
+
+        Each state is transitioned for `iterations` or `max_seconds`,
+        whichever comes first, in rounds of at most `ckpt_iterations`
+        iterations or `ckpt_seconds` seconds, and written to the
+        database after every round.  Each write is of that state alone,
+        in a transaction of its own unless the caller holds one, so
+        that an interrupted analysis keeps the rounds already done and
+        readers see the states written so far without waiting for the
+        whole analysis.  With multiprocessing, the rounds are
+        distributed over a pool of processes, and each state is
+        written as soon as its round is done.  Without either
+        checkpoint interval, all the states are written together at the
+        end.  The iterations, seconds, and checkpoints of each state are
+        reported by :meth:`analysis_stats`, and `progress` is passed on
+        to :meth:`State.transition` in this process.
+
+        `statenos` and `cgpm_modelnos` are as for :meth:`_serialize_engine`.
+        """
+        if statenos is None:
+            models = [(m, m) for m in range(len(engine.states))]
+        else:
+            models = zip(statenos, cgpm_modelnos)
+        cursor = bdb.sql_execute('''
+            SELECT cgpm_modelno, modelno FROM bayesdb_cgpm_modelno
+                WHERE generator_id = ?
+        ''', (generator_id,))
+        modelnos = dict(cursor)
+        stats = dict(
+            (cgpm_modelno, {
+                'iterations': 0,
+                'seconds': 0.,
+                'iterations_per_second': 0.,
+                'checkpoints': 0,
+            })
+            for _stateno, cgpm_modelno in models)
+        # Seconds spent on each state, including writing checkpoints,
+        # against max_seconds.
+        spent = dict((cgpm_modelno, 0.) for _stateno, cgpm_modelno in models)
+        self._set_cache_entry(bdb, generator_id, 'analysis', dict(
+            (modelnos.get(cgpm_modelno, cgpm_modelno), stat)
+            for cgpm_modelno, stat in stats.iteritems()))
+
+        def next_round(cgpm_modelno):
+            # Return the iterations and seconds for the next round of
+            # the state, or None if it is done.
+            stat = stats[cgpm_modelno]
+            n = seconds = None
+            if iterations:
+                n = iterations - stat['iterations']
+                if ckpt_iterations:
+                    n = min(n, ckpt_iterations)
+                if n <= 0:
+                    return None
+            elif ckpt_iterations:
+                n = ckpt_iterations
+            if max_seconds:
+                seconds = max_seconds - spent[cgpm_modelno]
+                if seconds <= 0:
+                    return None
+            if ckpt_seconds:
+                seconds = ckpt_seconds if seconds is None \
+                    else min(seconds, ckpt_seconds)
+            return n, seconds
+
+        def checkpoint(stateno, cgpm_modelno, n, seconds):
+            # Return true if the state may go on to another round.  A
+            # round cut short by the clock before any iteration means the
+            # time is up, and there is nothing new to write.
+            if n == 0:
+                return False
+            stat = stats[cgpm_modelno]
+            start = time.time()
+            if ckpt_iterations or ckpt_seconds:
+                self._serialize_engine(bdb, generator_id, engine, True,
+                    [stateno], [cgpm_modelno])
+                stat['checkpoints'] += 1
+            spent[cgpm_modelno] += seconds + (time.time() - start)
+            stat['iterations'] += n
+            stat['seconds'] += seconds
+            if stat['seconds'] > 0:
+                stat['iterations_per_second'] = \
+                    stat['iterations'] / stat['seconds']
+            return True
+
+        def transition_args(cgpm_modelno, round_, progress):
+            n, seconds = round_
+            return (n, seconds, kernels, cols, rowids, ckpt_iterations,
+                stats[cgpm_modelno]['iterations'], progress)
+
+        processes = min(self._analysis_processes(), len(models))
+        if processes <= 1:
+            for stateno, cgpm_modelno in models:
+                state = engine.states[stateno]
+                round_ = next_round(cgpm_modelno)
+                while round_ is not None:
+                    args = transition_args(cgpm_modelno, round_, progress)
+                    n, seconds = _transition_state(state, *args)
+                    if not checkpoint(stateno, cgpm_modelno, n, seconds):
+                        break
+                    round_ = next_round(cgpm_modelno)
+        else:
+            # Seed each round of each state in the worker processes, and
+            # the state rebuilt from its result, from its own stream, so
+            # the results do not depend on the order in which the rounds
+            # finish.
+            #
+            # Each round ships the whole state to a worker and back.  That
+            # is the same metadata the checkpoint after the round writes
+            # to the database anyway, and it is linear in the data, while
+            # every iteration of the round sweeps all of the data through
+            # every kernel.  Without checkpoints there is one round per
+            # state.  Workers show no progress bars, which would garble
+            # each other; the parent records each round in the stats.
+            def submit(stateno, cgpm_modelno, round_, k):
+                prng = bdb.prng_stream(generator_id, cgpm_modelno, k)
+                seed = [prng.weakrandom32() for _ in range(4)]
+                rng = numpy.random.RandomState(
+                    [prng.weakrandom32() for _ in range(4)])
+                args = (engine.states[stateno].to_metadata(), seed) + \
+                    transition_args(cgpm_modelno, round_, False)
+                result = pool.apply_async(_transition_state_metadata, args)
+                pending.append((stateno, cgpm_modelno, k, rng, result))
+
+            pool = multiprocessing.Pool(processes)
+            try:
+                pending = deque()
+                for stateno, cgpm_modelno in models:
+                    round_ = next_round(cgpm_modelno)
+                    if round_ is not None:
+                        submit(stateno, cgpm_modelno, round_, 0)
+                while pending:
+                    stateno, cgpm_modelno, k, rng, result = \
+                        pending.popleft()
+                    metadata, n, seconds = result.get()
+                    engine.states[stateno] = State.from_metadata(
+                        metadata, rng=rng)
+                    if not checkpoint(stateno, cgpm_modelno, n, seconds):
+                        continue
+                    round_ = next_round(cgpm_modelno)
+                    if round_ is not None:
+                        submit(stateno, cgpm_modelno, round_, k + 1)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+
+        if not (ckpt_iterations or ckpt_seconds):
+            # Written in a savepoint by _serialize_engine.
+            self._serialize_engine(
+                bdb, generator_id, engine, True, statenos, cgpm_modelnos)
+
+    def _analysis_processes(self):
+        # multiprocess is False, True for a process per CPU, or a number
+        # of processes.
+        if self._multiprocess is True:
+            return multiprocessing.cpu_count()
+        if not self._multiprocess:
+            return 1
+        return int(self._multiprocess)
 
 
     def column_dependence_probability(
@@ -692,19 +994,74 @@ class CGPM_Backend(BayesDB_Backend):
         if colno0 == colno1:
             return [1]
 
-        # Get the modelnos.
+        [depprob_list] = self._dependence_probabilities(
+            bdb, generator_id, modelnos, [(colno0, colno1)])
+        return depprob_list
+
+    def column_dependence_probability_matrix(
+            self, bdb, generator_id, modelnos, colnos):
+        # Dependence is symmetric, so ask only about the pairs above the
+        # diagonal and mirror them below it.
+        pairs = [
+            (colno0, colno1)
+            for i, colno0 in enumerate(colnos)
+            for colno1 in colnos[i + 1:]
+        ]
+        depprobs = self._dependence_probabilities(
+            bdb, generator_id, modelnos, pairs) if pairs else []
+        matrix = [[[1]] * len(colnos) for _colno in colnos]
+        k = 0
+        for i in xrange(len(colnos)):
+            for j in xrange(i + 1, len(colnos)):
+                matrix[i][j] = matrix[j][i] = depprobs[k]
+                k += 1
+        return matrix
+
+    def _dependence_probabilities(self, bdb, generator_id, modelnos, pairs):
+        # Get the modelnos, and the stored partitions or else the engine.
         cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
+        colnos = set(itertools.chain.from_iterable(pairs))
+        partitions, engine, statenos = self._partitions_or_states(
+            bdb, generator_id, cgpm_modelnos, colnos)
+
+        # Column partitions alone give the dependence probabilities.
+        if partitions is not None:
+            depprobs = partitions.dependence_probabilities()
+            return [
+                [1] if colno0 == colno1
+                else depprobs[min(colno0, colno1), max(colno0, colno1)]
+                for colno0, colno1 in pairs
+            ]
 
-        # Get the engine.
-        engine = self._engine(bdb, generator_id)
+        # Dependence probabilities depend only on the engine, so keep them
+        # with it until its stamp changes, i.e. until the next ANALYZE or
+        # ALTER, or until a rollback reloads it.  Writing the engine, or
+        # any of its states, forgets them.
+        stamp = self._get_cache_entry(bdb, generator_id, 'stamp')
+        cached = self._get_cache_entry(bdb, generator_id, 'depprob')
+        if cached is None or cached[0] is not engine or cached[1] != stamp:
+            cached = (engine, stamp, {})
+            self._set_cache_entry(bdb, generator_id, 'depprob', cached)
+        statenos_key = None if statenos is None else tuple(statenos)
+        if statenos_key not in cached[2]:
+            cached[2][statenos_key] = _column_partition_depprobs(
+                engine, statenos)
+        depprobs = cached[2][statenos_key]
 
         # Engine gives us a list of dependence probabilities which it is our
         # responsibility to integrate over.
-        depprob_list = engine.dependence_probability(
-            colno0, colno1, statenos=cgpm_modelnos,
-            multiprocess=self._multiprocess)
-
-        return depprob_list
+        depprob_lists = []
+        for colno0, colno1 in pairs:
+            if colno0 == colno1:
+                depprob_lists.append([1])
+                continue
+            pair = (min(colno0, colno1), max(colno0, colno1))
+            if pair not in depprobs:
+                depprobs[pair] = engine.dependence_probability(
+                    colno0, colno1, statenos=statenos,
+                    multiprocess=self._multiprocess)
+            depprob_lists.append(depprobs[pair])
+        return depprob_lists
 
     def column_mutual_information(
             self, bdb, generator_id, modelnos, colnos0, colnos1,
@@ -717,7 +1074,8 @@ class CGPM_Backend(BayesDB_Backend):
         cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
 
         # Get the engine.
-        engine = self._engine(bdb, generator_id)
+        engine, statenos = self._engine_states(
+            bdb, generator_id, cgpm_modelnos)
 
         # Build the evidence, ignoring nan values and converting nominals.
         evidence = constraints and {
@@ -730,7 +1088,7 @@ class CGPM_Backend(BayesDB_Backend):
         # responsibility to integrate over.
         mi_list = engine.mutual_information(
             colnos0, colnos1, constraints=evidence, N=numsamples,
-            progress=True, statenos=cgpm_modelnos,
+            progress=True, statenos=statenos,
             multiprocess=self._multiprocess)
 
         # Pass through the distribution of CMI to BayesDB without aggregation.
@@ -749,17 +1107,93 @@ class CGPM_Backend(BayesDB_Backend):
         if cgpm_rowid == -1 or cgpm_target_rowid == -1:
             return [float('nan')]
 
-        # Get the engine.
-        engine = self._engine(bdb, generator_id)
+        # Read the row partitions straight from storage if we can.
+        partitions, engine, statenos = self._partitions_or_states(
+            bdb, generator_id, cgpm_modelnos, colnos)
+        if partitions is not None:
+            return partitions.row_similarity(
+                cgpm_rowid, cgpm_target_rowid, colnos)
 
         # Engine gives us a list of similarities which it is our
         # responsibility to integrate over.
         similarity_list = engine.row_similarity(
-            cgpm_rowid, cgpm_target_rowid, colnos, statenos=cgpm_modelnos,
+            cgpm_rowid, cgpm_target_rowid, colnos, statenos=statenos,
             multiprocess=self._multiprocess)
 
         return similarity_list
 
+    def row_similarity_many(
+            self, bdb, generator_id, modelnos, queries, colnos):
+        # Retrieve the modelnos and the individual indexing once.
+        cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
+        cgpm_rowids = self._cgpm_rowid_map(bdb, generator_id)
+        partitions = engine = None
+        similarities = []
+        for rowid, target_rowid in queries:
+            cgpm_rowid = cgpm_rowids.get(rowid, -1)
+            cgpm_target_rowid = cgpm_rowids.get(target_rowid, -1)
+            # XXX TODO: If neither rowids are incorporated, return None.
+            if cgpm_rowid == -1 or cgpm_target_rowid == -1:
+                similarities.append([float('nan')])
+                continue
+            if partitions is None and engine is None:
+                partitions, engine, statenos = self._partitions_or_states(
+                    bdb, generator_id, cgpm_modelnos, colnos)
+            if partitions is not None:
+                similarities.append(partitions.row_similarity(
+                    cgpm_rowid, cgpm_target_rowid, colnos))
+            else:
+                similarities.append(engine.row_similarity(
+                    cgpm_rowid, cgpm_target_rowid, colnos, statenos=statenos,
+                    multiprocess=self._multiprocess))
+        return similarities
+
+    def row_similarity_blocks(
+            self, bdb, generator_id, modelnos, rowids, colnos,
+            block_size=256):
+        # Retrieve the modelnos and map the individual indexing once.
+        cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
+        cgpm_rowid_map = self._cgpm_rowid_map(bdb, generator_id)
+        cgpm_rowids = [cgpm_rowid_map.get(rowid, -1) for rowid in rowids]
+        # XXX TODO: If neither rowids are incorporated, return None.
+        missing = numpy.array([cgpm_rowid == -1 for cgpm_rowid in cgpm_rowids])
+
+        # Read the row partitions straight from storage if we can.
+        partitions, engine, statenos = self._partitions_or_states(
+            bdb, generator_id, cgpm_modelnos, colnos)
+        if partitions is not None:
+            state_labels = partitions.row_labels(cgpm_rowids, colnos)
+            for block in _similarity_blocks(state_labels, missing, block_size):
+                yield block
+            return
+
+        # Otherwise take them from the states of the engine.
+        states = engine.states if statenos is None \
+            else [engine.states[stateno] for stateno in statenos]
+
+        # Only variables in the views of the states have row partitions;
+        # let the engine handle any others pair by pair.
+        if any(colno not in states[0].outputs for colno in colnos):
+            blocks = super(CGPM_Backend, self).row_similarity_blocks(
+                bdb, generator_id, modelnos, rowids, colnos,
+                block_size=block_size)
+            for block in blocks:
+                yield block
+            return
+
+        state_labels = [
+            [
+                numpy.array([
+                    view.Zr(cgpm_rowid) if cgpm_rowid != -1 else -1
+                    for cgpm_rowid in cgpm_rowids
+                ])
+                for view in set(state.view_for(colno) for colno in colnos)
+            ]
+            for state in states
+        ]
+        for block in _similarity_blocks(state_labels, missing, block_size):
+            yield block
+
     def predictive_relevance(
             self, bdb, generator_id, modelnos, rowid_target, rowid_query,
             hypotheticals, colno):
@@ -777,10 +1211,8 @@ class CGPM_Backend(BayesDB_Backend):
         # XXX TODO: Move any items of cgpm_query_rowid which are not yet
         # incorporated into the `hypotheticals` list. For now, we will just
         # drop any rowids which are not incorporated.
-        cgpm_rowid_query = filter(
-            lambda r: r != -1,
-            [self._cgpm_rowid(bdb, generator_id, r) for r in rowid_query]
-        )
+        cgpm_rowid_query = self._cgpm_rowids(bdb, generator_id, rowid_query)
+        cgpm_rowid_query = cgpm_rowid_query[cgpm_rowid_query != -1].tolist()
 
         # If the query rowids are all not incorporated and no hypotheticals,
         # return nan.
@@ -788,8 +1220,9 @@ class CGPM_Backend(BayesDB_Backend):
             return [float('nan')]
 
         # Build list of hypotheticals dictionaries.
+        categories = self._categories(bdb, generator_id)
         hypotheticals_numeric = [
-            {c: self._to_numeric(bdb, generator_id, c, v) for c, v in row}
+            {c: categories.to_numeric(c, v) for c, v in row}
             for row in hypotheticals
         ]
 
@@ -803,12 +1236,13 @@ class CGPM_Backend(BayesDB_Backend):
                 % (hypotheticals,))
 
         # Get the engine.
-        engine = self._engine(bdb, generator_id)
+        engine, statenos = self._engine_states(
+            bdb, generator_id, cgpm_modelnos)
 
         # Go!
         similarity_list = engine.relevance_probability(
             cgpm_rowid_target, cgpm_rowid_query, colno, hypotheticals_numeric,
-            statenos=cgpm_modelnos, multiprocess=self._multiprocess)
+            statenos=statenos, multiprocess=self._multiprocess)
 
         return similarity_list
 
@@ -855,72 +1289,160 @@ class CGPM_Backend(BayesDB_Backend):
         # Perpare the rowid, query, and evidence for cgpm.
         cgpm_rowid = self._cgpm_rowid(bdb, generator_id, rowid)
         cgpm_targets = targets
+        categories = self._categories(bdb, generator_id)
         cgpm_constraints = {}
         for colno, value in full_constraints:
-            value_numeric = self._to_numeric(bdb, generator_id, colno, value)
+            value_numeric = categories.to_numeric(colno, value)
             if not math.isnan(value_numeric):
                 cgpm_constraints.update({colno: value_numeric})
         # Retrieve the engine.
-        engine = self._engine(bdb, generator_id)
-        samples = engine.simulate(
-            rowid=cgpm_rowid,
-            targets=cgpm_targets,
-            constraints=cgpm_constraints,
-            inputs=None,
-            N=num_samples,
-            accuracy=accuracy,
-            statenos=cgpm_modelnos,
-            multiprocess=self._multiprocess
-        )
-        weighted_samples = engine._likelihood_weighted_resample(
-            samples=samples,
-            rowid=cgpm_rowid,
-            constraints=cgpm_constraints,
-            inputs=None,
-            statenos=cgpm_modelnos,
-            multiprocess=self._multiprocess
-        )
-        def map_value(colno, value):
-            return self._from_numeric(bdb, generator_id, colno, value)
+        engine, statenos = self._engine_states(
+            bdb, generator_id, cgpm_modelnos)
+        weighted_samples = self._simulate_weighted(
+            bdb, generator_id, engine, statenos, rowid, cgpm_rowid,
+            cgpm_targets, cgpm_constraints, num_samples, accuracy)
         return [
-            [map_value(colno, row[colno]) for colno in cgpm_targets]
+            [categories.from_numeric(colno, row[colno])
+                for colno in cgpm_targets]
             for row in weighted_samples
         ]
 
+    def simulate_joint_many(
+            self, bdb, generator_id, modelnos, queries, num_samples=None,
+            accuracy=None):
+        if num_samples is None:
+            num_samples = 1
+        # Share the modelnos, engine, and value conversions across queries.
+        cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
+        cgpm_rowids = self._cgpm_rowid_map(bdb, generator_id)
+        categories = self._categories(bdb, generator_id)
+        engine, statenos = self._engine_states(
+            bdb, generator_id, cgpm_modelnos)
+        results = []
+        for rowid, targets, constraints in queries:
+            full_constraints = self._merge_user_table_constraints(
+                bdb, generator_id, rowid, targets, constraints)
+            cgpm_rowid = cgpm_rowids.get(rowid, -1)
+            cgpm_constraints = {}
+            for colno, value in full_constraints:
+                value_numeric = categories.to_numeric(colno, value)
+                if not math.isnan(value_numeric):
+                    cgpm_constraints.update({colno: value_numeric})
+            weighted_samples = self._simulate_weighted(
+                bdb, generator_id, engine, statenos, rowid, cgpm_rowid,
+                targets, cgpm_constraints, num_samples, accuracy)
+            results.append([
+                [categories.from_numeric(colno, row[colno])
+                    for colno in targets]
+                for row in weighted_samples
+            ])
+        return results
+
+    def _simulate_weighted(
+            self, bdb, generator_id, engine, statenos, rowid, cgpm_rowid,
+            targets, constraints, num_samples, accuracy):
+        # Draw the engine's choices for the row from the stream of the
+        # generator for the row and targets, not from bdb.np_prng, so
+        # that the row gets the same samples alone or among other rows,
+        # and other queries of the row get other samples.  The states
+        # draw from their own generators.
+        rng = engine.rng
+        engine.rng = bdb.np_prng_stream(generator_id, None, rowid, *targets)
+        try:
+            samples = engine.simulate(
+                rowid=cgpm_rowid,
+                targets=targets,
+                constraints=constraints,
+                inputs=None,
+                N=num_samples,
+                accuracy=accuracy,
+                statenos=statenos,
+                multiprocess=self._multiprocess
+            )
+            return engine._likelihood_weighted_resample(
+                samples=samples,
+                rowid=cgpm_rowid,
+                constraints=constraints,
+                inputs=None,
+                statenos=statenos,
+                multiprocess=self._multiprocess
+            )
+        finally:
+            engine.rng = rng
+
     def logpdf_joint(
             self, bdb, generator_id, modelnos, rowid, targets, constraints):
+        [logpdf] = self.logpdf_joint_many(
+            bdb, generator_id, modelnos, [(rowid, targets, constraints)])
+        return logpdf
+
+    def logpdf_joint_many(self, bdb, generator_id, modelnos, queries):
+        engine, statenos, cgpm_queries = self._logpdf_queries(
+            bdb, generator_id, modelnos, queries)
+        return [
+            _engine_logpdf(engine, statenos, self._multiprocess, *query)
+            for query in cgpm_queries
+        ]
+
+    def prepare_concurrent(self, bdb, generator_id, memo, method, *args,
+            **kwargs):
+        # Worker processes cannot start processes of their own, so the
+        # worker of the generator evaluates its states in turn, where
+        # the engine here would spread them over processes.  Only take
+        # that trade when asked to multiprocess at all.
+        if not self._multiprocess:
+            return None
+        if method == 'logpdf_joint':
+            modelnos, rowid, targets, constraints = args
+            queries = [(rowid, targets, constraints)]
+            function = _worker_logpdf_1
+        elif method == 'logpdf_joint_many':
+            modelnos, queries = args
+            function = _worker_logpdf
+        else:
+            return None
+        engine, statenos, cgpm_queries = self._logpdf_queries(
+            bdb, generator_id, modelnos, queries)
+        # Send the engine only if the worker does not hold it already.
+        # Analysis changes engines in place, so check the stamp as well.
+        stamp = self._engine_stamp(bdb, generator_id)
+        sent = memo.get('engine')
+        if sent is not None and sent[0]() is engine and sent[1] == stamp:
+            metadata = None
+        else:
+            metadata = engine.to_metadata()
+            memo['engine'] = (weakref.ref(engine), stamp)
+        return ('process', function, (metadata, statenos, cgpm_queries))
+
+    def _logpdf_queries(self, bdb, generator_id, modelnos, queries):
+        """Return the engine, statenos, and cgpm form of logpdf `queries`.
+
+        Each query ``(rowid, targets, constraints)`` becomes
+        ``(cgpm_rowid, cgpm_targets, cgpm_constraints)`` as
+        :func:`_engine_logpdf` takes it.  The modelnos, engine, and
+        value conversions are shared across queries.
+        """
         cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
-        cgpm_rowid = self._cgpm_rowid(bdb, generator_id, rowid)
-        # TODO: Handle nan values in the logpdf query.
-        cgpm_targets = {
-            colno: self._to_numeric(bdb, generator_id, colno, value)
-            for colno, value in targets
-        }
-        # Build the evidence, ignoring nan values.
-        cgpm_constraints = {}
-        for colno, value in constraints:
-            value_numeric = self._to_numeric(bdb, generator_id, colno, value)
-            if not math.isnan(value_numeric):
-                cgpm_constraints.update({colno: value_numeric})
-        # Retrieve the engine.
-        engine = self._engine(bdb, generator_id)
-        logpdfs = engine.logpdf(
-            rowid=cgpm_rowid,
-            targets=cgpm_targets,
-            constraints=cgpm_constraints,
-            inputs=None,
-            accuracy=None,
-            statenos=cgpm_modelnos,
-            multiprocess=self._multiprocess
-        )
-        return engine._likelihood_weighted_integrate(
-            logpdfs=logpdfs,
-            rowid=cgpm_rowid,
-            constraints=cgpm_constraints,
-            inputs=None,
-            statenos=cgpm_modelnos,
-            multiprocess=self._multiprocess,
-        )
+        cgpm_rowids = self._cgpm_rowid_map(bdb, generator_id)
+        categories = self._categories(bdb, generator_id)
+        engine, statenos = self._engine_states(
+            bdb, generator_id, cgpm_modelnos)
+        cgpm_queries = []
+        for rowid, targets, constraints in queries:
+            cgpm_rowid = cgpm_rowids.get(rowid, -1)
+            # TODO: Handle nan values in the logpdf query.
+            cgpm_targets = {
+                colno: categories.to_numeric(colno, value)
+                for colno, value in targets
+            }
+            # Build the evidence, ignoring nan values.
+            cgpm_constraints = {}
+            for colno, value in constraints:
+                value_numeric = categories.to_numeric(colno, value)
+                if not math.isnan(value_numeric):
+                    cgpm_constraints.update({colno: value_numeric})
+            cgpm_queries.append((cgpm_rowid, cgpm_targets, cgpm_constraints))
+        return engine, statenos, cgpm_queries
 
     def _unique_rowid(self, rowids):
         if len(set(rowids)) != 1:
@@ -953,10 +1475,10 @@ class CGPM_Backend(BayesDB_Backend):
         ''' % (qexpressions, qt), (generator_id,))
 
         # Map values to codes.
-        def map_value(colno, value):
-            return self._to_numeric(bdb, generator_id, colno, value)
+        categories = self._categories(bdb, generator_id)
         return [
-            tuple(map_value(colno, x) for colno, x in zip(colnos, row))
+            tuple(categories.to_numeric(colno, x)
+                for colno, x in zip(colnos, row))
             for row in cursor
         ]
 
@@ -1062,14 +1584,17 @@ class CGPM_Backend(BayesDB_Backend):
         # Probe the cache.
         cached_engine = self._engine_latest(bdb, generator_id)
         if cached_engine is not None:
+            self._cache_stats['hits'] += 1
             return cached_engine
 
         # Not cached or mismatched stamps. Load the engine from the database.
+        self._cache_stats['misses'] += 1
         cursor = bdb.sql_execute('''
-            SELECT engine_json, engine_stamp FROM bayesdb_cgpm_generator
+            SELECT engine_json, engine_format, engine_stamp
+                FROM bayesdb_cgpm_generator
                 WHERE generator_id = ?
         ''', (generator_id,)).fetchall()
-        engine_json, engine_stamp = cursor[0]
+        engine_json, engine_format, engine_stamp = cursor[0]
 
         # Check if the generator has an initialized engine.
         if not engine_json:
@@ -1077,17 +1602,141 @@ class CGPM_Backend(BayesDB_Backend):
             raise BQLError(bdb, 'No models initialized for generator: %r'
                 % (generator,))
 
-        # Deserialize the engine.
+        # Deserialize the engine, with all its states.
+        metadata = engine_format_loads(engine_format, engine_json)
+        if engine_format == ENGINE_FORMAT_STATES:
+            cursor = bdb.sql_execute('''
+                SELECT state_blob FROM bayesdb_cgpm_state
+                    WHERE generator_id = ?
+                    ORDER BY cgpm_modelno ASC
+            ''', (generator_id,))
+            metadata['states'] = [engine_loads(blob) for (blob,) in cursor]
+        nbytes = _metadata_nbytes(metadata)
         engine = Engine.from_metadata(
-            json.loads(engine_json), rng=bdb.np_prng,
-            multiprocess=self._multiprocess)
+            metadata, rng=bdb.np_prng, multiprocess=self._multiprocess)
 
         # Cache the engine with its stamp.
-        self._set_cache_entry(bdb, generator_id, 'engine', engine)
+        self._set_cache_entry(bdb, generator_id, 'engine', engine, nbytes)
         self._set_cache_entry(bdb, generator_id, 'stamp', engine_stamp)
+        memo = self._stamp_memo(bdb, generator_id)
+        if memo is not None:
+            memo['engine'] = engine_stamp
 
         return engine
 
+    def _engine_states(self, bdb, generator_id, cgpm_modelnos):
+        """Return an engine with the states `cgpm_modelnos`, and their statenos.
+
+        If `cgpm_modelnos` is None, return the whole engine and None.
+        Otherwise, unless the whole engine is already loaded, load only
+        the requested states into an engine of their own, numbered in
+        the order of `cgpm_modelnos`.
+        """
+        if cgpm_modelnos is None:
+            return self._engine(bdb, generator_id), None
+
+        # Use the whole engine if we have it.
+        cached_engine = self._engine_latest(bdb, generator_id)
+        if cached_engine is not None:
+            self._cache_stats['hits'] += 1
+            return cached_engine, cgpm_modelnos
+
+        # Find the stamps of the states.  Engines written before version 5
+        # have no states of their own, and must be loaded whole.
+        key = tuple(cgpm_modelnos)
+        stamps = self._state_stamps(bdb, generator_id, key)
+        if len(stamps) < len(set(key)):
+            return self._engine(bdb, generator_id), cgpm_modelnos
+        statenos = range(len(key))
+
+        # Probe the cache.
+        cached = self._get_cache_entry(bdb, generator_id, 'states')
+        if cached is not None and cached[0] == key and cached[1] == stamps:
+            self._cache_stats['hits'] += 1
+            return cached[2], statenos
+
+        # Not cached or mismatched stamps.  Load the states.
+        self._cache_stats['misses'] += 1
+        cursor = bdb.sql_execute('''
+            SELECT engine_json, engine_format FROM bayesdb_cgpm_generator
+                WHERE generator_id = ?
+        ''', (generator_id,))
+        engine_json, engine_format = cursor.fetchall()[0]
+        assert engine_format == ENGINE_FORMAT_STATES
+        cursor = bdb.sql_execute('''
+            SELECT cgpm_modelno, state_blob FROM bayesdb_cgpm_state
+                WHERE generator_id = ? AND cgpm_modelno IN (%s)
+        ''' % (','.join(map(str, set(key))),), (generator_id,))
+        state_blobs = dict(cursor)
+        metadata = engine_format_loads(engine_format, engine_json)
+        metadata['states'] = [engine_loads(state_blobs[m]) for m in key]
+        nbytes = _metadata_nbytes(metadata)
+        engine = Engine.from_metadata(
+            metadata, rng=bdb.np_prng, multiprocess=self._multiprocess)
+
+        # Cache the states with their stamps.
+        self._set_cache_entry(
+            bdb, generator_id, 'states', (key, stamps, engine), nbytes)
+
+        return engine, statenos
+
+    def _partitions_or_states(self, bdb, generator_id, cgpm_modelnos, colnos):
+        """Return partitions of the states `cgpm_modelnos`, or the states.
+
+        Returns (partitions, None, None) if the partitions of `colnos` in
+        every state are stored, and the engine is not already loaded,
+        whose states answer as quickly.  Otherwise returns (None, engine,
+        statenos) as :meth:`_engine_states` does.
+        """
+        cached_engine = self._engine_latest(bdb, generator_id)
+        if cached_engine is not None:
+            self._cache_stats['hits'] += 1
+            return None, cached_engine, cgpm_modelnos
+        partitions = self._partitions(bdb, generator_id, cgpm_modelnos)
+        if partitions is not None and partitions.has_variables(colnos):
+            return partitions, None, None
+        engine, statenos = self._engine_states(
+            bdb, generator_id, cgpm_modelnos)
+        return None, engine, statenos
+
+    def _partitions(self, bdb, generator_id, cgpm_modelnos):
+        """Return the stored partitions of the states `cgpm_modelnos`.
+
+        Returns None if any of the states has no partitions.
+        """
+        # Find the stamps of the states.
+        key = None if cgpm_modelnos is None else tuple(cgpm_modelnos)
+        stamps = self._state_stamps(bdb, generator_id, key)
+        if not stamps or (key is not None and len(stamps) < len(set(key))):
+            return None
+
+        # Probe the cache.
+        cached = self._get_cache_entry(bdb, generator_id, 'partitions')
+        if cached is not None and cached.key == key \
+                and cached.stamps == stamps:
+            self._cache_stats['hits'] += 1
+            return cached
+
+        # Not cached or mismatched stamps.  Read the partitions.
+        where = '' if key is None else 'AND cgpm_modelno IN (%s)' \
+            % (','.join(map(str, set(key))),)
+        cursor = bdb.sql_execute('''
+            SELECT cgpm_modelno, partition_blob FROM bayesdb_cgpm_state
+                WHERE generator_id = ? %s
+        ''' % (where,), (generator_id,))
+        blobs = dict(cursor)
+        if any(blob is None for blob in blobs.itervalues()):
+            return None
+        self._cache_stats['misses'] += 1
+        modelnos = sorted(blobs) if key is None else key
+        partitions = _Partitions(key, stamps, [blobs[m] for m in modelnos])
+
+        # Cache them with their stamps.
+        self._set_cache_entry(bdb, generator_id, 'partitions', partitions,
+            sum(len(blob) for blob in blobs.itervalues()))
+
+        return partitions
+
     def _engine_latest(self, bdb, generator_id):
         # Check whether there is a cached_engine.
         cached_engine = self._get_cache_entry(bdb, generator_id, 'engine')
@@ -1105,36 +1754,158 @@ class CGPM_Backend(BayesDB_Backend):
         return cached_engine if cached_stamp == latest_stamp else None
 
     def _engine_stamp(self, bdb, generator_id):
+        memo = self._stamp_memo(bdb, generator_id)
+        if memo is not None and 'engine' in memo:
+            return memo['engine']
         cursor = bdb.sql_execute('''
             SELECT engine_stamp FROM bayesdb_cgpm_generator
                 WHERE generator_id = ?
         ''', (generator_id,))
-        return cursor_value(cursor)
+        stamp = cursor_value(cursor)
+        if memo is not None:
+            memo['engine'] = stamp
+        return stamp
 
-    def _serialize_engine(self, bdb, generator_id, engine, cache):
-        # Write the engine to JSON.
-        engine_json = json_dumps(engine.to_metadata())
+    def _state_stamps(self, bdb, generator_id, key):
+        """Return a dict mapping the cgpm_modelnos in `key` to stamps.
 
-        # Increment the stamp.
-        engine_stamp_old = self._engine_stamp(bdb, generator_id)
-        engine_stamp_new = engine_stamp_old + 1
+        If `key` is None, map every stored state.  States that are not
+        stored, as in engines written before version 5, are omitted.
+        """
+        memo = self._stamp_memo(bdb, generator_id)
+        if memo is not None and ('states', key) in memo:
+            return memo['states', key]
+        where = '' if key is None else 'AND cgpm_modelno IN (%s)' \
+            % (','.join(map(str, set(key))),)
+        cursor = bdb.sql_execute('''
+            SELECT cgpm_modelno, state_stamp FROM bayesdb_cgpm_state
+                WHERE generator_id = ? %s
+        ''' % (where,), (generator_id,))
+        stamps = dict(cursor)
+        if memo is not None:
+            memo['states', key] = stamps
+        return stamps
+
+    def _stamp_memo(self, bdb, generator_id):
+        # Within a transaction, or a caching scope, no other connection
+        # can change the stamps under us, so remember them until we write
+        # an engine ourselves or a savepoint rolls back, which clears
+        # bdb.cache.  Outside them, return None: ask every time.
+        if bdb.cache is None:
+            return None
+        memo = bdb.cache.setdefault('cgpm_stamps', {})
+        return memo.setdefault(generator_id, {})
 
-        # Update the engine and stamp.
-        bdb.sql_execute('''
-            UPDATE bayesdb_cgpm_generator
-                SET engine_json = :engine_json,
-                    engine_stamp = :engine_stamp
-                WHERE generator_id = :generator_id
-        ''', {
-            'engine_json': engine_json,
-            'engine_stamp': engine_stamp_new,
-            'generator_id': generator_id,
-        })
-
-        # Add it to the cache.
-        if cache:
-            self._set_cache_entry(bdb, generator_id, 'engine', engine)
-            self._set_cache_entry(bdb, generator_id, 'stamp', engine_stamp_new)
+    def _forget_stamps(self, bdb, generator_id):
+        if bdb.cache is not None:
+            bdb.cache.get('cgpm_stamps', {}).pop(generator_id, None)
+
+    def _serialize_engine(self, bdb, generator_id, engine, cache,
+            statenos=None, cgpm_modelnos=None):
+        """Write `engine`, or only its states `statenos`, to the database.
+
+        If `statenos` is given, only the states at `statenos` in `engine`,
+        which are stored as `cgpm_modelnos`, have changed, and `engine`
+        was obtained from :meth:`_engine_states` with `cgpm_modelnos`.
+
+        The writes are done in a savepoint, so that they are never torn
+        even if the caller has no transaction.
+        """
+        with bdb.savepoint():
+            # Increment the stamp.
+            cursor = bdb.sql_execute('''
+                SELECT engine_format, engine_stamp FROM bayesdb_cgpm_generator
+                    WHERE generator_id = ?
+            ''', (generator_id,))
+            engine_format, engine_stamp_old = cursor.fetchall()[0]
+            engine_stamp_new = engine_stamp_old + 1
+            self._forget_stamps(bdb, generator_id)
+
+            # Dependence probabilities and partitions of the states we change
+            # are stale.
+            self._del_cache_entry(bdb, generator_id, 'depprob')
+            self._del_cache_entry(bdb, generator_id, 'partitions')
+
+            # Store the partitions of each state over all the individuals.
+            _table_rowids, cgpm_rowids, _map = \
+                self._retrieve_rowids(bdb, generator_id)
+            n_rows = int(cgpm_rowids.max()) + 1 if len(cgpm_rowids) else 0
+
+            # Write only the changed states if the engine is stored by state.
+            if statenos is not None and engine_format == ENGINE_FORMAT_STATES:
+                state_nbytes = 0
+                for stateno, cgpm_modelno in zip(statenos, cgpm_modelnos):
+                    state = engine.states[stateno]
+                    state_metadata = state.to_metadata()
+                    state_nbytes += _metadata_nbytes(state_metadata)
+                    state_blob = engine_dumps(state_metadata)
+                    bdb.sql_execute('''
+                        UPDATE bayesdb_cgpm_state
+                            SET state_blob = ?, state_stamp = ?,
+                                partition_blob = ?
+                            WHERE generator_id = ? AND cgpm_modelno = ?
+                    ''', (buffer(state_blob), engine_stamp_new,
+                        _state_partition(state, n_rows), generator_id,
+                        cgpm_modelno))
+                bdb.sql_execute('''
+                    UPDATE bayesdb_cgpm_generator SET engine_stamp = ?
+                        WHERE generator_id = ?
+                ''', (engine_stamp_new, generator_id))
+                if cache:
+                    # Estimate the size of the engine from the states written.
+                    nbytes = state_nbytes * len(engine.states) // len(statenos)
+                    cached = self._get_cache_entry(bdb, generator_id, 'states')
+                    if cached is not None and cached[2] is engine:
+                        stamps = dict(cached[1])
+                        stamps.update(
+                            (cgpm_modelno, engine_stamp_new)
+                            for cgpm_modelno in cgpm_modelnos)
+                        self._set_cache_entry(bdb, generator_id, 'states',
+                            (cached[0], stamps, engine), nbytes)
+                    else:
+                        self._set_cache_entry(
+                            bdb, generator_id, 'engine', engine, nbytes)
+                        self._set_cache_entry(
+                            bdb, generator_id, 'stamp', engine_stamp_new)
+                return
+
+            # Otherwise write the whole engine, each state in its own row and
+            # the rest in engine_json, all in the binary format.
+            metadata = engine.to_metadata()
+            states = metadata.pop('states')
+            bdb.sql_execute('''
+                UPDATE bayesdb_cgpm_generator
+                    SET engine_json = :engine_json,
+                        engine_format = :engine_format,
+                        engine_stamp = :engine_stamp
+                    WHERE generator_id = :generator_id
+            ''', {
+                'engine_json': buffer(engine_dumps(metadata)),
+                'engine_format': ENGINE_FORMAT_STATES,
+                'engine_stamp': engine_stamp_new,
+                'generator_id': generator_id,
+            })
+            bdb.sql_execute('''
+                DELETE FROM bayesdb_cgpm_state WHERE generator_id = ?
+            ''', (generator_id,))
+            for cgpm_modelno, state in enumerate(states):
+                bdb.sql_execute('''
+                    INSERT INTO bayesdb_cgpm_state
+                        (generator_id, cgpm_modelno, state_blob, state_stamp,
+                            partition_blob)
+                        VALUES (?, ?, ?, ?, ?)
+                ''', (generator_id, cgpm_modelno, buffer(engine_dumps(state)),
+                    engine_stamp_new,
+                    _state_partition(engine.states[cgpm_modelno], n_rows)))
+
+            # Add it to the cache.
+            if cache:
+                nbytes = _metadata_nbytes(metadata) + \
+                    sum(_metadata_nbytes(state) for state in states)
+                self._set_cache_entry(
+                    bdb, generator_id, 'engine', engine, nbytes)
+                self._set_cache_entry(
+                    bdb, generator_id, 'stamp', engine_stamp_new)
 
 
     def _retrieve_cache(self, bdb,):
@@ -1143,11 +1914,17 @@ class CGPM_Backend(BayesDB_Backend):
         self._cache[bdb] = dict()
         return self._cache[bdb]
 
-    def _set_cache_entry(self, bdb, generator_id, key, value):
+    def _set_cache_entry(self, bdb, generator_id, key, value, nbytes=None):
+        # If nbytes is given, the entry counts against the budget.
         cache = self._retrieve_cache(bdb)
         if generator_id not in cache:
             cache[generator_id] = dict()
         cache[generator_id][key] = value
+        self._forget_cache_bytes(bdb, generator_id, key)
+        if nbytes is not None:
+            self._cache_lru[bdb, generator_id, key] = nbytes
+            self._cache_bytes += nbytes
+            self._evict_cache_entries()
 
     def _get_cache_entry(self, bdb, generator_id, key):
         # Returns None if the generator_id or key do not exist.
@@ -1156,6 +1933,10 @@ class CGPM_Backend(BayesDB_Backend):
             return None
         if key not in cache[generator_id]:
             return None
+        # Mark it most recently used.
+        lru_key = (bdb, generator_id, key)
+        if lru_key in self._cache_lru:
+            self._cache_lru[lru_key] = self._cache_lru.pop(lru_key)
         return cache[generator_id][key]
 
     def _del_cache_entry(self, bdb, generator_id, key):
@@ -1163,66 +1944,101 @@ class CGPM_Backend(BayesDB_Backend):
         cache = self._retrieve_cache(bdb)
         if generator_id in cache:
             if key is None:
+                for k in cache[generator_id]:
+                    self._forget_cache_bytes(bdb, generator_id, k)
                 del cache[generator_id]
             elif key in cache[generator_id]:
+                self._forget_cache_bytes(bdb, generator_id, key)
                 del cache[generator_id][key]
 
+    def _forget_cache_bytes(self, bdb, generator_id, key):
+        nbytes = self._cache_lru.pop((bdb, generator_id, key), None)
+        if nbytes is not None:
+            self._cache_bytes -= nbytes
+
+    def _evict_cache_entries(self):
+        # Evict least recently used entries until within the budget, but
+        # keep the most recently used, which a query is about to use.
+        if self._cache_budget is None:
+            return
+        while self._cache_bytes > self._cache_budget \
+                and len(self._cache_lru) > 1:
+            (bdb, generator_id, key), nbytes = \
+                self._cache_lru.popitem(last=False)
+            self._cache_bytes -= nbytes
+            self._cache_stats['evictions'] += 1
+            cache = self._cache[bdb][generator_id]
+            value = cache.pop(key)
+            # Dependence probabilities hold on to their engine.
+            engine = value[2] if key == 'states' else value
+            depprob = cache.get('depprob')
+            if depprob is not None and depprob[0] is engine:
+                del cache['depprob']
+
     def _cgpm_rowid(self, bdb, generator_id, table_rowid, nullok=True):
-        cursor = bdb.sql_execute('''
-            SELECT cgpm_rowid FROM bayesdb_cgpm_individual
-                WHERE generator_id = ? AND table_rowid = ?
-        ''', (generator_id, table_rowid))
-        cgpm_rowid = cursor_value(cursor, nullok=nullok)
+        cgpm_rowid = self._cgpm_rowid_map(bdb, generator_id).get(table_rowid)
+        if cgpm_rowid is None and not nullok:
+            raise ValueError('Empty cursor')
         return cgpm_rowid if cgpm_rowid is not None else -1
 
+    def _cgpm_rowids(self, bdb, generator_id, table_rowids):
+        """Map `table_rowids` to an array of cgpm rowids, -1 if absent."""
+        table_rowids_sorted, cgpm_rowids_sorted, _map = \
+            self._retrieve_rowids(bdb, generator_id)
+        table_rowids = numpy.asarray(table_rowids, dtype=numpy.int64)
+        if len(table_rowids_sorted) == 0:
+            return numpy.full(len(table_rowids), -1, dtype=numpy.int64)
+        i = numpy.searchsorted(table_rowids_sorted, table_rowids)
+        i = numpy.minimum(i, len(table_rowids_sorted) - 1)
+        found = table_rowids_sorted[i] == table_rowids
+        return numpy.where(found, cgpm_rowids_sorted[i], -1)
+
+    def _cgpm_rowid_map(self, bdb, generator_id):
+        """Return map of table rowid to cgpm rowid for incorporated rows."""
+        _table_rowids, _cgpm_rowids, cgpm_rowid_map = \
+            self._retrieve_rowids(bdb, generator_id)
+        return cgpm_rowid_map
+
+    def _retrieve_rowids(self, bdb, generator_id):
+        # Individuals are assigned when the generator is created and
+        # forgotten when it is dropped, which both clear the cache, so
+        # the mapping needs no stamp.
+        cached = self._get_cache_entry(bdb, generator_id, 'rowids')
+        if cached is None:
+            cursor = bdb.sql_execute('''
+                SELECT table_rowid, cgpm_rowid FROM bayesdb_cgpm_individual
+                    WHERE generator_id = ?
+                    ORDER BY table_rowid ASC
+            ''', (generator_id,))
+            rows = cursor.fetchall()
+            cached = (
+                numpy.array([t for t, _c in rows], dtype=numpy.int64),
+                numpy.array([c for _t, c in rows], dtype=numpy.int64),
+                dict(rows),
+            )
+            self._set_cache_entry(bdb, generator_id, 'rowids', cached)
+        return cached
+
+    def _categories(self, bdb, generator_id):
+        # Category codes change only when the generator is created or
+        # gains a column, both of which bump or precede the stamp, so
+        # keep them with the stamp they were loaded at.
+        stamp = self._engine_stamp(bdb, generator_id)
+        cached = self._get_cache_entry(bdb, generator_id, 'categories')
+        if cached is None or cached.stamp != stamp:
+            cached = _Categories(bdb, generator_id, stamp)
+            self._set_cache_entry(bdb, generator_id, 'categories', cached)
+        return cached
+
     def _to_numeric(self, bdb, generator_id, colno, value):
         """Convert value in bayeslite to equivalent cgpm format."""
-        if value is None:
-            return float('NaN')
-        # XXX Latent variables are not associated with an entry in
-        # bayesdb_cgpm_category, so just pass through whatever value
-        # the user supplied, as a float.
-        if colno < 0:
-            return float(value)
-        population_id = core.bayesdb_generator_population(bdb, generator_id)
-        stattype = core.bayesdb_variable_stattype(
-            bdb, population_id, generator_id, colno)
-        if _is_nominal(stattype):
-            cursor = bdb.sql_execute('''
-                SELECT code FROM bayesdb_cgpm_category
-                    WHERE generator_id = ? AND colno = ? AND value = ?
-            ''', (generator_id, colno, value))
-            integer = cursor_value(cursor, nullok=True)
-            if integer is None:
-                return float('NaN')
-                # raise BQLError('Invalid category: %r' % (value,))
-            return integer
-        else:
-            return value
+        categories = self._categories(bdb, generator_id)
+        return categories.to_numeric(colno, value)
 
     def _from_numeric(self, bdb, generator_id, colno, value):
         """Convert value in cgpm to equivalent bayeslite format."""
-        if math.isnan(value):
-            return None
-        population_id = core.bayesdb_generator_population(bdb, generator_id)
-        stattype = core.bayesdb_variable_stattype(
-            bdb, population_id, generator_id, colno)
-        if _is_nominal(stattype):
-            # XXX Latent variables are not associated with an entry in
-            # bayesdb_cgpm_category, so just pass through whatever value cgpm
-            # returns as a string.
-            if colno < 0:
-                return str(value)
-            cursor = bdb.sql_execute('''
-                SELECT value FROM bayesdb_cgpm_category
-                    WHERE generator_id = ? AND colno = ? AND code = ?
-            ''', (generator_id, colno, value))
-            text = cursor_value(cursor, nullok=True)
-            if text is None:
-                raise BQLError('Invalid category: %r' % (value,))
-            return text
-        else:
-            return value
+        categories = self._categories(bdb, generator_id)
+        return categories.from_numeric(colno, value)
 
     def _retrieve_baseline_variables(self, bdb, generator_id):
         # XXX Store this data in the bdb.
@@ -1284,11 +2100,7 @@ class CGPM_Backend(BayesDB_Backend):
             SELECT 1 FROM %s WHERE oid = ?
         ''' % (qt,), (rowid,)).fetchall()
         # Is the rowid incorporated into the cgpm?
-        incorporated = bdb.sql_execute('''
-            SELECT 1 FROM bayesdb_cgpm_individual
-            WHERE generator_id = ? AND table_rowid = ?
-            LIMIT 1
-        ''', (generator_id, rowid,)).fetchall()
+        incorporated = rowid in self._cgpm_rowid_map(bdb, generator_id)
         # Populate values if necessary.
         table_constraints = []
         if exists and (not incorporated):
@@ -1379,6 +2191,360 @@ class CGPM_Backend(BayesDB_Backend):
         return kernels
 
 
+class _Categories(object):
+    """Category codes and stattypes of the variables of a generator.
+
+    Loaded in one pass from bayesdb_cgpm_category, so that converting
+    values to and from cgpm codes is a dictionary or list lookup rather
+    than a query per value.
+    """
+
+    def __init__(self, bdb, generator_id, stamp):
+        self.bdb = bdb
+        self.generator_id = generator_id
+        self.stamp = stamp
+        population_id = core.bayesdb_generator_population(bdb, generator_id)
+        self.nominal = {
+            colno: _is_nominal(core.bayesdb_variable_stattype(
+                bdb, population_id, generator_id, colno))
+            for colno in core.bayesdb_variable_numbers(
+                bdb, population_id, generator_id)
+        }
+        self.codes = defaultdict(dict)
+        self.values = defaultdict(list)
+        cursor = bdb.sql_execute('''
+            SELECT colno, value, code FROM bayesdb_cgpm_category
+                WHERE generator_id = ?
+        ''', (generator_id,))
+        for colno, value, code in cursor:
+            self.codes[colno][value] = code
+            values = self.values[colno]
+            if len(values) <= code:
+                values.extend([None] * (code + 1 - len(values)))
+            values[code] = value
+
+    def is_nominal(self, colno):
+        if colno not in self.nominal:
+            population_id = core.bayesdb_generator_population(
+                self.bdb, self.generator_id)
+            self.nominal[colno] = _is_nominal(core.bayesdb_variable_stattype(
+                self.bdb, population_id, self.generator_id, colno))
+        return self.nominal[colno]
+
+    def to_numeric(self, colno, value):
+        """Convert value in bayeslite to equivalent cgpm format."""
+        if value is None:
+            return float('NaN')
+        # XXX Latent variables are not associated with an entry in
+        # bayesdb_cgpm_category, so just pass through whatever value
+        # the user supplied, as a float.
+        if colno < 0:
+            return float(value)
+        if self.is_nominal(colno):
+            key = _category_key(value)
+            if key is None:
+                # Let SQLite decide how the value compares as text.
+                cursor = self.bdb.sql_execute('''
+                    SELECT code FROM bayesdb_cgpm_category
+                        WHERE generator_id = ? AND colno = ? AND value = ?
+                ''', (self.generator_id, colno, value))
+                integer = cursor_value(cursor, nullok=True)
+            else:
+                integer = self.codes[colno].get(key)
+            if integer is None:
+                return float('NaN')
+                # raise BQLError('Invalid category: %r' % (value,))
+            return integer
+        else:
+            return value
+
+    def from_numeric(self, colno, value):
+        """Convert value in cgpm to equivalent bayeslite format."""
+        if math.isnan(value):
+            return None
+        if self.is_nominal(colno):
+            # XXX Latent variables are not associated with an entry in
+            # bayesdb_cgpm_category, so just pass through whatever value cgpm
+            # returns as a string.
+            if colno < 0:
+                return str(value)
+            values = self.values[colno]
+            text = None
+            if value == int(value) and 0 <= value < len(values):
+                text = values[int(value)]
+            if text is None:
+                raise BQLError(self.bdb, 'Invalid category: %r' % (value,))
+            return text
+        else:
+            return value
+
+def _category_key(value):
+    """Return `value` as SQLite compares it with TEXT, or None if unsure.
+
+    Categories are stored with TEXT affinity, so SQLite compares
+    integers and strings by their text; other values are left for
+    SQLite itself to compare.
+    """
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        try:
+            return value.decode('ascii')
+        except UnicodeDecodeError:
+            return None
+    if isinstance(value, (int, long)):
+        return unicode(int(value))
+    return None
+
+def _column_partition_depprobs(engine, statenos):
+    """Dependence probabilities of all pairs of modelled variables.
+
+    Without foreign cgpms, two variables are dependent in a state
+    exactly when they are in the same view, so the dependence
+    probabilities of every pair follow from the column partitions of
+    the states in one pass.  Returns a dict mapping each pair (colno0,
+    colno1) with colno0 < colno1 to a list of the dependence
+    probabilities in the states `statenos`, or an empty dict if any
+    state has foreign cgpms.
+    """
+    states = engine.states if statenos is None \
+        else [engine.states[stateno] for stateno in statenos]
+    if any(state.hooked_cgpms for state in states):
+        return {}
+    colnos = states[0].outputs
+    views = numpy.array([
+        [Zv[colno] for colno in colnos]
+        for Zv in (state.Zv() for state in states)
+    ])
+    return _view_depprobs(colnos, views)
+
+def _transition_state(state, n, seconds, kernels, cols, rowids,
+        ckpt_iterations, done, progress):
+    """Transition `state` for `n` iterations or `seconds`, whichever first.
+
+    Either may be None for no limit, but not both.  `done` is the
+    number of iterations already done before, so that diagnostics are
+    recorded every `ckpt_iterations` iterations, as
+    :meth:`State.transition` would with `checkpoint`.  Returns the
+    number of iterations and the seconds they took.
+
+    The iterations are run in chunks, each ending at the next multiple
+    of `ckpt_iterations` if there is one.  Under a time limit, which
+    :meth:`State.transition` would cut short without saying how many
+    iterations it did, each chunk is sized to take about half the time
+    left at the rate so far.
+    """
+    assert n is not None or seconds is not None
+    start = time.time()
+    i = 0
+    while n is None or i < n:
+        chunk = n - i if n is not None else None
+        if seconds is not None:
+            elapsed = time.time() - start
+            if elapsed >= seconds:
+                break
+            estimate = 1
+            if i and elapsed > 0:
+                estimate = max(1, int((seconds - elapsed) * i / elapsed / 2))
+            chunk = estimate if chunk is None else min(chunk, estimate)
+        checkpoint = None
+        if ckpt_iterations:
+            chunk = min(chunk, ckpt_iterations - (done + i) % ckpt_iterations)
+            if (done + i + chunk) % ckpt_iterations == 0:
+                checkpoint = chunk
+        state.transition(N=chunk, kernels=kernels, cols=cols, rowids=rowids,
+            progress=progress, checkpoint=checkpoint)
+        i += chunk
+    return i, time.time() - start
+
+def _transition_state_metadata(metadata, seed, *args):
+    # Run _transition_state in a worker process on a copy of a state.
+    state = State.from_metadata(
+        metadata, rng=numpy.random.RandomState(seed))
+    n, seconds = _transition_state(state, *args)
+    return state.to_metadata(), n, seconds
+
+def _engine_logpdf(engine, statenos, multiprocess, cgpm_rowid, cgpm_targets,
+        cgpm_constraints):
+    logpdfs = engine.logpdf(
+        rowid=cgpm_rowid,
+        targets=cgpm_targets,
+        constraints=cgpm_constraints,
+        inputs=None,
+        accuracy=None,
+        statenos=statenos,
+        multiprocess=multiprocess
+    )
+    return engine._likelihood_weighted_integrate(
+        logpdfs=logpdfs,
+        rowid=cgpm_rowid,
+        constraints=cgpm_constraints,
+        inputs=None,
+        statenos=statenos,
+        multiprocess=multiprocess,
+    )
+
+# The engine that a worker process of bqlfn's generator executor holds
+# for its generator, as last sent by CGPM_Backend.prepare_concurrent.
+_worker_engine = None
+
+def _worker_logpdf(metadata, statenos, cgpm_queries):
+    # Run _engine_logpdf in the worker process of the generator, on the
+    # engine sent with this call or held from an earlier one.  Densities
+    # draw no random numbers, so the engine needs no particular seed.
+    global _worker_engine
+    if metadata is not None:
+        _worker_engine = Engine.from_metadata(metadata,
+            rng=numpy.random.RandomState(0), multiprocess=False)
+    return [
+        _engine_logpdf(_worker_engine, statenos, False, *query)
+        for query in cgpm_queries
+    ]
+
+def _worker_logpdf_1(metadata, statenos, cgpm_queries):
+    [logpdf] = _worker_logpdf(metadata, statenos, cgpm_queries)
+    return logpdf
+
+def _metadata_nbytes(metadata):
+    """Estimate the memory taken by engine `metadata`, in bytes.
+
+    Serves as an estimate of the size of the engine built from it.
+    Lists of numbers are assumed uniform, and sized by their first.
+    """
+    nbytes = sys.getsizeof(metadata)
+    if isinstance(metadata, dict):
+        for key, value in metadata.iteritems():
+            nbytes += _metadata_nbytes(key) + _metadata_nbytes(value)
+    elif isinstance(metadata, (list, tuple)) and metadata:
+        if isinstance(metadata[0], (dict, list, tuple)):
+            nbytes += sum(_metadata_nbytes(x) for x in metadata)
+        else:
+            nbytes += len(metadata) * sys.getsizeof(metadata[0])
+    return nbytes
+
+def _view_depprobs(colnos, views):
+    """Dependence probabilities of `colnos` given their `views`.
+
+    `views[k, i]` is the view of colnos[i] in the kth state.
+    """
+    depprobs = {}
+    for i, j in itertools.combinations(xrange(len(colnos)), 2):
+        pair = (min(colnos[i], colnos[j]), max(colnos[i], colnos[j]))
+        depprobs[pair] = (views[:, i] == views[:, j]).astype(float).tolist()
+    return depprobs
+
+def _state_partition(state, n_rows):
+    """Serialize the column and row partitions of `state`.
+
+    Returns None if `state` has foreign cgpms, whose variables are not
+    partitioned into views.
+    """
+    if state.hooked_cgpms:
+        return None
+    colnos = state.outputs
+    Zv = state.Zv()
+    view_ids = sorted(set(Zv[colno] for colno in colnos))
+    view_index = {view_id: v for v, view_id in enumerate(view_ids)}
+    view_colno = {Zv[colno]: colno for colno in colnos}
+    rows = numpy.empty((len(view_ids), n_rows), dtype=numpy.int32)
+    for v, view_id in enumerate(view_ids):
+        # Copy the view's whole map of rowid to cluster at once, rather
+        # than asking for the cluster of each row in turn.
+        Zr = state.view_for(view_colno[view_id]).Zr()
+        rows[v, numpy.fromiter(Zr.iterkeys(), int, len(Zr))] = \
+            numpy.fromiter(Zr.itervalues(), int, len(Zr))
+    views = [view_index[Zv[colno]] for colno in colnos]
+    return buffer(partition_dumps(colnos, views, rows))
+
+def _similarity_blocks(state_labels, missing, block_size):
+    """Yield blocks of rows of the similarity matrix of some rows.
+
+    `state_labels` has, for each state, the cluster labels of the rows
+    in each view of the context; `missing` marks the rows that are not
+    incorporated.  The similarity of two rows in a state is the fraction
+    of the views of the context in which they share a cluster, so the
+    matrix is a weighted sum of the co-clustering matrices of the row
+    partitions of those views.
+    """
+    n = len(missing)
+    for i in xrange(0, n, block_size):
+        block = slice(i, i + block_size)
+        similarity = numpy.zeros((len(missing[block]), n))
+        for view_labels in state_labels:
+            weight = 1. / (len(state_labels) * len(view_labels))
+            for labels in view_labels:
+                similarity += weight * (labels[block, None] == labels[None, :])
+        similarity[missing[block], :] = float('nan')
+        similarity[:, missing] = float('nan')
+        yield similarity
+
+class _Partitions(object):
+    """Column and row partitions of some states of a generator.
+
+    Decoded from the partition_blob of each state, as SQLite returns it
+    to this process, so that dependence probabilities and row
+    similarities need no state to be deserialized.  Densities and
+    simulation still load the states.  `stamps` maps the cgpm_modelno of each state to the
+    stamp its partitions were read at.
+    """
+
+    def __init__(self, key, stamps, blobs):
+        self.key = key
+        self.stamps = stamps
+        self.partitions = [partition_loads(blob) for blob in blobs]
+        self.indices = [
+            {colno: i for i, colno in enumerate(colnos.tolist())}
+            for colnos, _views, _rows in self.partitions
+        ]
+        self.depprobs = None
+
+    def has_variables(self, colnos):
+        return all(
+            colno in index for index in self.indices for colno in colnos)
+
+    def dependence_probabilities(self):
+        """Dependence probabilities of all pairs of modelled variables.
+
+        As :func:`_column_partition_depprobs`, computed once.
+        """
+        if self.depprobs is None:
+            colnos = self.partitions[0][0].tolist()
+            views = numpy.array([
+                views[[index[colno] for colno in colnos]]
+                for (_colnos, views, _rows), index
+                in zip(self.partitions, self.indices)
+            ])
+            self.depprobs = _view_depprobs(colnos, views)
+        return self.depprobs
+
+    def row_labels(self, cgpm_rowids, colnos):
+        """Cluster labels of `cgpm_rowids` in each view of `colnos`.
+
+        Returns, for each state, a list of label arrays, one per view
+        of the variables `colnos`.  Rows not incorporated are labelled -1.
+        """
+        cgpm_rowids = numpy.asarray(cgpm_rowids, dtype=numpy.int64)
+        state_labels = []
+        for (_colnos, views, rows), index in \
+                zip(self.partitions, self.indices):
+            known = (0 <= cgpm_rowids) & (cgpm_rowids < rows.shape[1])
+            view_labels = []
+            for v in sorted(set(views[index[colno]] for colno in colnos)):
+                labels = numpy.full(len(cgpm_rowids), -1, dtype=numpy.int32)
+                labels[known] = rows[v, cgpm_rowids[known]]
+                view_labels.append(labels)
+            state_labels.append(view_labels)
+        return state_labels
+
+    def row_similarity(self, cgpm_rowid0, cgpm_rowid1, colnos):
+        """List of the similarities of two rows in each state."""
+        return [
+            float(numpy.mean(
+                [labels[0] == labels[1] for labels in view_labels]))
+            for view_labels
+            in self.row_labels([cgpm_rowid0, cgpm_rowid1], colnos)
+        ]
+
 def _create_schema(bdb, generator_id, schema_ast):
     # Get some parameters.
     population_id = core.bayesdb_generator_population(bdb, generator_id)
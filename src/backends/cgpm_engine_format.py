@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2017, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Binary serialization of CGPM engine metadata.
+
+Engines are stored as the metadata dictionaries of
+``Engine.to_metadata``.  Originally they were stored as JSON, which is
+slow to write and read and large when the engine has many models over
+many rows, because the bulk of the metadata -- row and column
+partitions, sufficient statistics, the data -- is long lists of
+numbers.
+
+The binary format stores every long list of numbers of uniform type,
+and every rectangular list of such lists, as a raw little-endian NumPy
+array, and the rest of the metadata as JSON with placeholders for the
+arrays.  The whole is compressed with zlib::
+
+    magic 'BQLCGPM\\0', version byte, zlib(header length, header, arrays)
+
+where the header is JSON ``{"arrays": [[dtype, shape, offset], ...],
+"metadata": <metadata with placeholders>}``.  Decoding yields exactly
+the lists that decoding the JSON would, so engines round-trip
+unchanged.
+
+Alongside each state we store its column and row partitions, which
+alone answer dependence probability and row similarity queries, as
+uncompressed little-endian arrays that are decoded as views of the
+blob without building any Python objects::
+
+    magic 'BQLPART\0', version byte, int64 n_colnos, n_views, n_rows,
+    int64 colnos[n_colnos], int64 views[n_colnos],
+    int32 rows[n_views][n_rows]
+
+where views[i] is the view of colnos[i], and rows[v][r] the cluster of
+cgpm rowid r in view v, or -1 if r is not incorporated.
+"""
+
+import json
+import numpy
+import struct
+import zlib
+
+# Values of bayesdb_cgpm_generator.engine_format.  In ENGINE_FORMAT_STATES
+# the metadata is binary but lacks its states, which are stored binary
+# one per row of bayesdb_cgpm_state.
+ENGINE_FORMAT_JSON = 0
+ENGINE_FORMAT_BINARY = 1
+ENGINE_FORMAT_STATES = 2
+
+MAGIC = 'BQLCGPM\0'
+VERSION = 1
+
+PARTITION_MAGIC = 'BQLPART\0'
+PARTITION_VERSION = 1
+
+# Lists shorter than this are cheaper to leave in the JSON header.
+MIN_ARRAY_LENGTH = 16
+
+# Favour speed: engines are rewritten after every ANALYZE.
+COMPRESSION_LEVEL = 1
+
+_ARRAY = '__ndarray__'
+_DICT = '__dict__'
+_INT32 = numpy.dtype('<i4')
+_INT64 = numpy.dtype('<i8')
+_FLOAT64 = numpy.dtype('<f8')
+
+
+def engine_dumps(metadata):
+    """Return the binary serialization of engine `metadata`."""
+    arrays = []
+    skeleton = _encode(metadata, arrays)
+    header = []
+    chunks = []
+    offset = 0
+    for array in arrays:
+        data = array.tostring()
+        header.append([array.dtype.str, list(array.shape), offset])
+        chunks.append(data)
+        offset += len(data)
+    header_json = json.dumps(
+        {'arrays': header, 'metadata': skeleton}, sort_keys=True)
+    body = ''.join(
+        [struct.pack('<I', len(header_json)), header_json] + chunks)
+    return MAGIC + chr(VERSION) + zlib.compress(body, COMPRESSION_LEVEL)
+
+def engine_loads(blob):
+    """Return engine metadata from its binary serialization `blob`."""
+    blob = str(blob)
+    if not blob.startswith(MAGIC):
+        raise ValueError('Not a binary engine')
+    version = ord(blob[len(MAGIC)])
+    if version != VERSION:
+        raise ValueError('Unknown binary engine version: %d' % (version,))
+    body = zlib.decompress(blob[len(MAGIC) + 1:])
+    (header_length,) = struct.unpack('<I', body[:4])
+    header = json.loads(body[4:4 + header_length])
+    data = body[4 + header_length:]
+    arrays = []
+    for dtype, shape, offset in header['arrays']:
+        dtype = numpy.dtype(str(dtype))
+        count = int(numpy.prod(shape))
+        array = numpy.frombuffer(data, dtype=dtype, count=count,
+            offset=offset)
+        arrays.append(array.reshape(shape).tolist())
+    return _decode(header['metadata'], arrays)
+
+def engine_format_loads(engine_format, blob):
+    """Return engine metadata from `blob` stored in `engine_format`."""
+    if engine_format == ENGINE_FORMAT_JSON:
+        return json.loads(blob)
+    elif engine_format in (ENGINE_FORMAT_BINARY, ENGINE_FORMAT_STATES):
+        return engine_loads(blob)
+    else:
+        raise ValueError('Unknown engine format: %r' % (engine_format,))
+
+def partition_dumps(colnos, views, rows):
+    """Return the binary serialization of a state's partitions."""
+    colnos = numpy.asarray(colnos, dtype=_INT64)
+    views = numpy.asarray(views, dtype=_INT64)
+    rows = numpy.asarray(rows, dtype=_INT32)
+    assert colnos.shape == views.shape
+    assert rows.ndim == 2
+    header = struct.pack('<qqq', len(colnos), rows.shape[0], rows.shape[1])
+    return ''.join([PARTITION_MAGIC, chr(PARTITION_VERSION), header,
+        colnos.tostring(), views.tostring(), rows.tostring()])
+
+def partition_loads(blob):
+    """Return the arrays (colnos, views, rows) of serialized partitions.
+
+    The arrays are read-only views of `blob`, which they keep alive.
+    """
+    start = len(PARTITION_MAGIC) + 1
+    if str(blob[:len(PARTITION_MAGIC)]) != PARTITION_MAGIC:
+        raise ValueError('Not binary partitions')
+    version = ord(blob[len(PARTITION_MAGIC)])
+    if version != PARTITION_VERSION:
+        raise ValueError('Unknown binary partition version: %d' % (version,))
+    n_colnos, n_views, n_rows = \
+        struct.unpack('<qqq', str(blob[start:start + 24]))
+    offset = start + 24
+    colnos = numpy.frombuffer(blob, dtype=_INT64, count=n_colnos,
+        offset=offset)
+    offset += colnos.nbytes
+    views = numpy.frombuffer(blob, dtype=_INT64, count=n_colnos,
+        offset=offset)
+    offset += views.nbytes
+    rows = numpy.frombuffer(blob, dtype=_INT32, count=n_views * n_rows,
+        offset=offset).reshape((n_views, n_rows))
+    return colnos, views, rows
+
+def _encode(x, arrays):
+    if isinstance(x, (list, tuple)):
+        array = _numeric_array(x)
+        if array is not None:
+            arrays.append(array)
+            return {_ARRAY: len(arrays) - 1}
+        return [_encode(y, arrays) for y in x]
+    elif isinstance(x, dict):
+        encoded = {k: _encode(v, arrays) for k, v in x.iteritems()}
+        # Escape dictionaries that look like our placeholders.
+        if len(x) == 1 and (_ARRAY in x or _DICT in x):
+            encoded = {_DICT: encoded}
+        return encoded
+    else:
+        return x
+
+def _decode(x, arrays):
+    if isinstance(x, list):
+        return [_decode(y, arrays) for y in x]
+    elif isinstance(x, dict):
+        if len(x) == 1 and _ARRAY in x:
+            return arrays[x[_ARRAY]]
+        if len(x) == 1 and _DICT in x:
+            x = x[_DICT]
+        return {k: _decode(v, arrays) for k, v in x.iteritems()}
+    else:
+        return x
+
+def _numeric_array(x):
+    """Return `x` as an array if it is a long uniform list of numbers."""
+    if len(x) < MIN_ARRAY_LENGTH and \
+            not (x and isinstance(x[0], (list, tuple))):
+        return None
+    dtype = _numeric_dtype(x)
+    if dtype is not None:
+        return numpy.array(x, dtype=dtype)
+    # Rectangular lists of lists of numbers of one type.
+    if not all(isinstance(row, (list, tuple)) for row in x):
+        return None
+    if len(set(len(row) for row in x)) != 1 or not x[0]:
+        return None
+    if len(x) * len(x[0]) < MIN_ARRAY_LENGTH:
+        return None
+    dtypes = set(_numeric_dtype(row) for row in x)
+    if len(dtypes) != 1 or None in dtypes:
+        return None
+    return numpy.array(x, dtype=dtypes.pop())
+
+def _numeric_dtype(x):
+    if not x:
+        return None
+    if all(isinstance(y, (int, long)) and not isinstance(y, bool) for y in x):
+        if all(-2**63 <= y < 2**63 for y in x):
+            return _INT64
+        return None
+    if all(isinstance(y, float) for y in x):
+        return _FLOAT64
+    return None
@@ -29,6 +29,7 @@ import tempfile
 
 from StringIO import StringIO
 from collections import Counter
+from collections import defaultdict
 from collections import OrderedDict
 from datetime import datetime
 
@@ -548,6 +549,33 @@ class LoomBackend(BayesDB_Backend):
         ''' % (','.join(map(str, modelnos)),), (generator_id, colno0, colno1))
         return [c for (c,) in cursor]
 
+    def column_dependence_probability_matrix(self,
+            bdb, generator_id, modelnos, colnos):
+        if modelnos is None:
+            modelnos = range(self._get_num_models(bdb, generator_id))
+        # Read the kind of every column in every model in one query.
+        cursor = bdb.sql_execute('''
+            SELECT modelno, colno, kind_id
+            FROM bayesdb_loom_column_kind_partition
+            WHERE generator_id = ?
+                AND modelno in (%s)
+        ''' % (','.join(map(str, modelnos)),), (generator_id,))
+        kinds = defaultdict(dict)
+        for modelno, colno, kind_id in cursor:
+            kinds[modelno][colno] = kind_id
+        def depprob_list(colno0, colno1):
+            if colno0 == colno1:
+                return [1.]
+            return [
+                int(kinds[m][colno0] == kinds[m][colno1])
+                for m in modelnos
+                if colno0 in kinds[m] and colno1 in kinds[m]
+            ]
+        return [
+            [depprob_list(colno0, colno1) for colno1 in colnos]
+            for colno0 in colnos
+        ]
+
     def _get_kind_id(self, bdb, generator_id, modelno, colno):
         """Return kind_id (view assignment) of colno in modelno."""
         cursor = bdb.sql_execute('''
@@ -685,6 +713,42 @@ class LoomBackend(BayesDB_Backend):
             generator_id, colnos[0], rowid, target_rowid))
         return [c for (c,) in cursor]
 
+    def row_similarity_many(self, bdb, generator_id, modelnos, queries,
+            colnos):
+        if modelnos is None:
+            modelnos = range(self._get_num_models(bdb, generator_id))
+        assert len(colnos) == 1
+        # Read the row partition of the context column's kind in every
+        # model in one query.
+        cursor = bdb.sql_execute('''
+            SELECT t1.modelno, t1.table_rowid, t1.partition_id
+            FROM bayesdb_loom_row_kind_partition as t1
+            WHERE t1.generator_id = ?
+                AND t1.modelno in (%s)
+                AND t1.kind_id = (
+                    SELECT kind_id
+                    FROM bayesdb_loom_column_kind_partition
+                    WHERE generator_id = t1.generator_id
+                        AND modelno = t1.modelno
+                        AND colno = ?
+                )
+        ''' % (','.join(map(str, modelnos)),), (generator_id, colnos[0]))
+        partitions = defaultdict(dict)
+        for modelno, rowid, partition_id in cursor:
+            partitions[modelno][rowid] = partition_id
+        def similarity_list(rowid, target_rowid):
+            if rowid == target_rowid:
+                return [1.] * len(modelnos)
+            return [
+                int(partitions[m][rowid] == partitions[m][target_rowid])
+                for m in modelnos
+                if rowid in partitions[m] and target_rowid in partitions[m]
+            ]
+        return [
+            similarity_list(rowid, target_rowid)
+            for rowid, target_rowid in queries
+        ]
+
     def predictive_relevance(self, bdb, generator_id, modelnos, rowid_target,
             rowid_queries, hypotheticals, colno):
         if len(hypotheticals) > 0:
@@ -829,36 +893,69 @@ class LoomBackend(BayesDB_Backend):
 
     def logpdf_joint(self, bdb, generator_id, modelnos, rowid, targets,
             constraints):
-        population_id = bayesdb_generator_population(bdb, generator_id)
-        ordered_column_names = self._get_ordered_column_names(bdb, generator_id)
-
-        # Pr[targets|constraints] = Pr[targets, constraints] / Pr[constraints]
-        # The numerator is and_case; denominator is conditional_case.
-        and_case = OrderedDict(
-            [(a, None) for a in ordered_column_names])
-        conditional_case = OrderedDict(
-            [(a, None) for a in ordered_column_names])
-
-        for (colno, value) in targets:
-            column_name = bayesdb_variable_name(bdb, population_id, None, colno)
-            and_case[column_name] = self._convert_to_proper_stattype(
-                bdb, generator_id, colno, value)
-            conditional_case[column_name] = None
-        for (colno, value) in constraints:
-            column_name = bayesdb_variable_name(bdb, population_id, None, colno)
-            processed_value = self._convert_to_proper_stattype(
-                bdb, generator_id, colno, value)
+        [logpdf] = self.logpdf_joint_many(
+            bdb, generator_id, modelnos, [(rowid, targets, constraints)])
+        return logpdf
 
-            and_case[column_name] = processed_value
-            conditional_case[column_name] = processed_value
+    def logpdf_joint_many(self, bdb, generator_id, modelnos, queries):
+        server = self._get_query_server(bdb, generator_id)
+        return _score_cases(server, self._logpdf_cases(
+            bdb, generator_id, queries))
+
+    def prepare_concurrent(self, bdb, generator_id, memo, method, *args,
+            **kwargs):
+        # The query server answers in a process of its own, so scoring
+        # only waits on it, and can do so in a thread.
+        if method == 'logpdf_joint':
+            modelnos, rowid, targets, constraints = args
+            queries = [(rowid, targets, constraints)]
+            function = _score_cases_1
+        elif method == 'logpdf_joint_many':
+            modelnos, queries = args
+            function = _score_cases
+        else:
+            return None
+        server = self._get_query_server(bdb, generator_id)
+        cases = self._logpdf_cases(bdb, generator_id, queries)
+        return ('thread', function, (server, cases))
 
-        and_case = and_case.values()
-        conditional_case = conditional_case.values()
+    def _logpdf_cases(self, bdb, generator_id, queries):
+        """Return the rows for the query server to score for `queries`.
 
-        server = self._get_query_server(bdb, generator_id)
-        and_score = server.score(and_case)
-        conditional_score = server.score(conditional_case)
-        return and_score - conditional_score
+        Pr[targets|constraints] = Pr[targets, constraints]
+        / Pr[constraints], so for each query return the pair of rows
+        (and_case, conditional_case) for the numerator and denominator.
+        """
+        population_id = bayesdb_generator_population(bdb, generator_id)
+        ordered_column_names = self._get_ordered_column_names(bdb, generator_id)
+        # Share variable names and value conversions across queries.
+        names = {}
+        converted = {}
+        def column_name(colno):
+            if colno not in names:
+                names[colno] = bayesdb_variable_name(
+                    bdb, population_id, None, colno)
+            return names[colno]
+        def convert(colno, value):
+            if (colno, value) not in converted:
+                converted[colno, value] = self._convert_to_proper_stattype(
+                    bdb, generator_id, colno, value)
+            return converted[colno, value]
+        def cases(targets, constraints):
+            and_case = OrderedDict(
+                [(a, None) for a in ordered_column_names])
+            conditional_case = OrderedDict(
+                [(a, None) for a in ordered_column_names])
+            for (colno, value) in targets:
+                and_case[column_name(colno)] = convert(colno, value)
+            for (colno, value) in constraints:
+                and_case[column_name(colno)] = convert(colno, value)
+                conditional_case[column_name(colno)] = convert(colno, value)
+            return (and_case.values(), conditional_case.values())
+        return [
+            cases(targets, constraints)
+            for _rowid, targets, constraints in queries
+        ]
 
     def _convert_to_proper_stattype(self, bdb, generator_id, colno, value):
         """Convert a value returned by the logpdf_joint method parameters into a
@@ -1003,6 +1100,17 @@ class LoomBackend(BayesDB_Backend):
             elif key in cache[generator_id]:
                 del cache[generator_id][key]
 
+def _score_cases(server, cases):
+    """Return the log density of each pair of rows from _logpdf_cases."""
+    return [
+        server.score(and_case) - server.score(conditional_case)
+        for and_case, conditional_case in cases
+    ]
+
+def _score_cases_1(server, cases):
+    [logpdf] = _score_cases(server, cases)
+    return logpdf
+
 def _is_nominal(stattype):
     return casefold(stattype) in ['nominal', 'unbounded_nominal']
 
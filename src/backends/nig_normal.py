@@ -281,13 +281,48 @@ class NIGNormalBackend(bayeslite.backend.BayesDB_Backend):
         with bdb.savepoint():
             if modelnos is None:
                 modelnos = self._modelnos(bdb, generator_id)
-            modelno = self.prng.choice(modelnos)
+            modelno, prng = self._choose_model(
+                bdb, generator_id, modelnos, rowid, targets)
             (mus, sigmas) = self._model_mus_sigmas(bdb, generator_id, modelno)
-            return [[self._simulate_1(bdb, generator_id, mus, sigmas, colno)
+            return [[self._simulate_1(
+                        bdb, generator_id, mus, sigmas, colno, prng)
                      for colno in targets]
                     for _ in range(num_samples)]
 
-    def _simulate_1(self, bdb, generator_id, mus, sigmas, colno):
+    def simulate_joint_many(
+            self, bdb, generator_id, modelnos, queries, num_samples=1,
+            accuracy=None):
+        # Read the parameters of all models once, rather than once per
+        # query, and then draw exactly as simulate_joint would.
+        with bdb.savepoint():
+            if modelnos is None:
+                modelnos = self._modelnos(bdb, generator_id)
+            (all_mus, all_sigmas) = self._all_mus_sigmas(bdb, generator_id)
+            def simulate(rowid, targets):
+                modelno, prng = self._choose_model(
+                    bdb, generator_id, modelnos, rowid, targets)
+                mus = all_mus.get(modelno, {})
+                sigmas = all_sigmas.get(modelno, {})
+                return [[self._simulate_1(
+                            bdb, generator_id, mus, sigmas, colno, prng)
+                         for colno in targets]
+                        for _ in range(num_samples)]
+            return [
+                simulate(rowid, targets)
+                for rowid, targets, _constraints in queries
+            ]
+
+    def _choose_model(self, bdb, generator_id, modelnos, rowid, colnos):
+        # Choose the model for the row and columns from the stream of the
+        # generator, and return it with the stream of the model, so that
+        # the row gets the same draws alone or in a batch, and other
+        # columns of the row get other draws.
+        prng = bdb.np_prng_stream(generator_id, None, rowid, *colnos)
+        modelno = modelnos[prng.randint(len(modelnos))]
+        prng = bdb.np_prng_stream(generator_id, modelno, rowid, *colnos)
+        return (modelno, prng)
+
+    def _simulate_1(self, bdb, generator_id, mus, sigmas, colno, prng):
         if colno < 0:
             dev_colno = colno
             cursor = bdb.sql_execute('''
@@ -295,9 +330,9 @@ class NIGNormalBackend(bayeslite.backend.BayesDB_Backend):
                     WHERE generator_id = ? AND deviation_colno = ?
             ''', (generator_id, dev_colno))
             obs_colno = cursor_value(cursor)
-            return self.prng.gauss(0, sigmas[obs_colno])
+            return prng.normal(0, sigmas[obs_colno])
         else:
-            return self.prng.gauss(mus[colno], sigmas[colno])
+            return prng.normal(mus[colno], sigmas[colno])
 
     def _model_mus_sigmas(self, bdb, generator_id, modelno):
         # TODO Filter in the database by the columns I will actually use?
@@ -321,6 +356,21 @@ class NIGNormalBackend(bayeslite.backend.BayesDB_Backend):
         # Note: The constraints are irrelevant for the same reason as
         # in simulate_joint.
         (all_mus, all_sigmas) = self._all_mus_sigmas(bdb, generator_id)
+        return self._logpdf_targets(
+            bdb, generator_id, all_mus, all_sigmas, targets)
+
+    def logpdf_joint_many(self, bdb, generator_id, modelnos, queries):
+        # Note: The constraints are irrelevant for the same reason as
+        # in simulate_joint.
+        (all_mus, all_sigmas) = self._all_mus_sigmas(bdb, generator_id)
+        return [
+            self._logpdf_targets(
+                bdb, generator_id, all_mus, all_sigmas, targets)
+            for _rowid, targets, _constraints in queries
+        ]
+
+    def _logpdf_targets(self, bdb, generator_id, all_mus, all_sigmas,
+            targets):
         def model_log_pdf(modelno):
             mus = all_mus[modelno]
             sigmas = all_sigmas[modelno]
@@ -368,6 +418,11 @@ class NIGNormalBackend(bayeslite.backend.BayesDB_Backend):
         # XXX Fix me!
         return [0]
 
+    def column_dependence_probability_matrix(self, bdb, generator_id,
+            modelnos, colnos):
+        # XXX Fix me!
+        return [[[0] for _colno1 in colnos] for _colno0 in colnos]
+
     def column_mutual_information(self, bdb, generator_id, modelnos, colnos0,
             colnos1, constraints, numsamples):
         # XXX Fix me!
@@ -378,13 +433,19 @@ class NIGNormalBackend(bayeslite.backend.BayesDB_Backend):
         # XXX Fix me!
         return [0]
 
+    def row_similarity_many(self, bdb, generator_id, modelnos, queries,
+            colnos):
+        # XXX Fix me!
+        return [[0] for _query in queries]
+
     def predict_confidence(self, bdb, generator_id, modelnos, rowid, colno,
             numsamples=None):
         if colno < 0:
             return (0, 1)       # deviation of mode from mean is zero
         if modelnos is None:
             modelnos = self._modelnos(bdb, generator_id)
-        modelno = self.prng.choice(modelnos)
+        modelno, _prng = self._choose_model(
+            bdb, generator_id, modelnos, rowid, [colno])
         mus, _sigmas = self._model_mus_sigmas(bdb, generator_id, modelno)
         return (mus[colno], 1.)
 
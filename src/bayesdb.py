@@ -16,6 +16,8 @@
 
 import apsw
 import contextlib
+import multiprocessing
+import numpy
 import numpy.random
 import random
 import struct
@@ -24,18 +26,26 @@ import bayeslite.bql as bql
 import bayeslite.bqlfn as bqlfn
 import bayeslite.bqlmath as bqlmath
 import bayeslite.bqlvtab as bqlvtab
+import bayeslite.core as core
 import bayeslite.parse as parse
 import bayeslite.schema as schema
 import bayeslite.txn as txn
 import bayeslite.weakprng as weakprng
+import bayeslite.weakprng.chacha as chacha
 
+from bayeslite.backend import bayesdb_register_backend
 from bayeslite.backend import bayesdb_register_builtin_backends
+from bayeslite.exception import BQLError
 from bayeslite.util import cursor_value
 
 bayesdb_open_cookie = 0xed63e2c26d621a5b5146a334849d43f0
 
+# Milliseconds for a connection in WAL mode to wait for another
+# connection's write to finish before failing with SQLITE_BUSY.
+WAL_BUSY_TIMEOUT = 10000
+
 def bayesdb_open(pathname=None, builtin_backends=None, seed=None,
-        version=None, compatible=None):
+        version=None, compatible=None, wal=None):
     """Open the BayesDB in the file at `pathname`.
 
     If there is no file at `pathname`, it is automatically created.
@@ -51,15 +61,44 @@ def bayesdb_open(pathname=None, builtin_backends=None, seed=None,
     bayeslite cannot read it.  If `compatible` is `True`,
     `bayesdb_open` will not incompatibly change the format of the
     database (but some newer bayesdb features may not work).
+
+    If `wal` is `True`, the database is switched to SQLite's
+    write-ahead log journal mode, which persists in the file.  Readers
+    in other connections then see the last committed state of the
+    database without waiting for a writer, such as an ANALYZE started
+    with :meth:`~BayesDB.execute_background`, and writers wait their
+    turn instead of failing.  In-memory databases cannot use it.
     """
     if builtin_backends is None:
         builtin_backends = True
     bdb = BayesDB(bayesdb_open_cookie, pathname=pathname, seed=seed,
-        version=version, compatible=compatible)
+        version=version, compatible=compatible, wal=wal)
     if builtin_backends:
         bayesdb_register_builtin_backends(bdb)
     return bdb
 
+# Last input word of the ChaCha core when deriving stream keys, which
+# the 128-bit block counter of a WeakPRNG never reaches in practice.
+_PRNG_STREAM_TAG = 0x746c7073   # 'splt'
+
+def _prng_derive(key, path):
+    """Derive a ChaCha key from `key` for each element of `path` in turn.
+
+    Each element, an integer of at most 64 bits or ``None``, is the
+    input block of one ChaCha8 core under the current key, and the
+    first eight words of its output are the next key.
+    """
+    out = [0] * 16
+    for x in path:
+        if x is None:
+            block = [0, 0, 0, _PRNG_STREAM_TAG]
+        else:
+            x &= 0xffffffffffffffff
+            block = [x & 0xffffffff, x >> 32, 1, _PRNG_STREAM_TAG]
+        chacha.core(8, out, block, key, chacha.const32)
+        key = out[0:8]
+    return tuple(key)
+
 class BayesDB(object):
     """A handle for a Bayesian database in memory or on disk.
 
@@ -73,23 +112,37 @@ class BayesDB(object):
     """
 
     def __init__(self, cookie, pathname=None, seed=None, version=None,
-            compatible=None):
+            compatible=None, wal=None):
         if cookie != bayesdb_open_cookie:
             raise ValueError('Do not construct BayesDB objects directly!')
         if pathname is None:
             pathname = ":memory:"
+        if wal and pathname == ":memory:":
+            raise ValueError('In-memory BayesDB cannot use WAL mode!')
         self.pathname = pathname
         self._sqlite3 = apsw.Connection(pathname)
+        self._wal = bool(wal)
+        if wal:
+            self._sqlite3.setbusytimeout(WAL_BUSY_TIMEOUT)
+            cursor = self._sqlite3.cursor().execute(
+                'PRAGMA journal_mode = WAL')
+            if cursor_value(cursor) != 'wal':
+                raise IOError('Unable to use WAL mode: %s' % (pathname,))
         self._txn_depth = 0     # managed in txn.py
         self._cache = None      # managed in txn.py
+        self._catalog = None    # managed in core.py
+        self._plans = bql.BQLPlanCache()
+        self._generator_executor = None     # managed in bqlfn.py
         self.backends = {}
         self.tracer = None
         self.sql_tracer = None
         self.temptable = 0
         self.qid = 0
+        self.query_id = 0
         if seed is None:
             seed = struct.pack('<QQQQ', 0, 0, 0, 0)
         self._prng = weakprng.weakprng(seed)
+        self._stream_key = None
         pyrseed = self._prng.weakrandom32()
         self._py_prng = random.Random(pyrseed)
         nprseed = [self._prng.weakrandom32() for _ in range(4)]
@@ -122,6 +175,9 @@ class BayesDB(object):
     def close(self):
         """Close the database.  Further use is not allowed."""
         assert self._txn_depth == 0, "pending BayesDB transactions"
+        if self._generator_executor is not None:
+            self._generator_executor.close()
+            self._generator_executor = None
         self._sqlite3.close()
         self._sqlite3 = None
 
@@ -145,10 +201,65 @@ class BayesDB(object):
         """
         return self._np_prng
 
+    def prng_stream(self, *key):
+        """Return a pseudorandom number generator for a stream in this query.
+
+        `key` is a sequence of integers or ``None`` naming the stream
+        within the BQL query now executing.  By convention it starts
+        with the generator and the model drawing from it, ``None`` for
+        either if it is yet to be chosen, and the row drawn for,
+        followed by whatever else tells the draws apart, such as the
+        columns drawn: e.g. ``(generator_id, modelno, rowid, colno)``
+        to simulate a cell from a model, or ``(generator_id, None,
+        rowid, colno)`` to choose the model.  The result is a
+        :class:`~bayeslite.weakprng.WeakPRNG` whose seed is derived
+        with ChaCha from the seed supplied to :func:`bayesdb_open`, the
+        number of the query, and `key` alone.  Unlike :attr:`np_prng`,
+        it does not depend on how many numbers anyone drew before, so
+        a row evaluated alone, in a batch, concurrently with others, or
+        from a cached plan sees the same numbers.
+        """
+        if self._stream_key is None or self._stream_key[0] != self.query_id:
+            query_key = _prng_derive(self._prng.key, (self.query_id,))
+            self._stream_key = (self.query_id, query_key)
+        seed = _prng_derive(self._stream_key[1], key)
+        return weakprng.WeakPRNG(struct.pack('<IIIIIIII', *seed))
+
+    def np_prng_stream(self, *key):
+        """Return a Numpy RandomState for a stream in this query.
+
+        `key` is as for :meth:`prng_stream`, whose stream seeds it.
+        """
+        prng = self.prng_stream(*key)
+        return numpy.random.RandomState(
+            [prng.weakrandom32() for _ in range(4)])
+
+    def _begin_query(self):
+        self.query_id += 1
+
     @property
     def cache(self):
         return self._cache
 
+    def cache_stats(self):
+        """Return statistics about the in-memory caches of each backend.
+
+        The result is a dict mapping each backend name to the dict
+        returned by its :meth:`~BayesDB_Backend.cache_stats` method.
+        """
+        return dict(
+            (name, backend.cache_stats(self))
+            for name, backend in self.backends.iteritems())
+
+    def plan_cache_stats(self):
+        """Return statistics about the cache of compiled BQL queries.
+
+        The result is a dict with the number of `hits` and `misses` of
+        queries looked up, the number of `entries` in the cache, and its
+        maximum `size`.
+        """
+        return self._plans.stats()
+
     def trace(self, tracer):
         """Trace execution of BQL queries.
 
@@ -228,6 +339,7 @@ class BayesDB(object):
         """
         if bindings is None:
             bindings = ()
+        self._begin_query()
         return self._maybe_trace(
             self.tracer, self._do_execute, string, bindings)
 
@@ -266,6 +378,21 @@ class BayesDB(object):
             raise
 
     def _do_execute(self, string, bindings):
+        # Reuse the compiled query if we compiled this text against the
+        # current catalog, skipping parsing and compiling.
+        core.bayesdb_validate_catalog(self)
+        version = core.bayesdb_catalog_version(self)
+        if version is not None:
+            out = self._plans.get((string, version))
+            if out is not None:
+                cursor = bql.execute_plan(self, out.rebind(bindings))
+                if cursor is not None:
+                    return cursor
+        phrase = self._parse_phrase(string)
+        cursor = bql.execute_phrase(self, phrase, bindings, plan_key=string)
+        return self._empty_cursor if cursor is None else cursor
+
+    def _parse_phrase(self, string):
         phrases = parse.parse_bql_string(string)
         phrase = None
         try:
@@ -278,8 +405,81 @@ class BayesDB(object):
             pass
         else:
             raise ValueError('>1 phrase in string')
-        cursor = bql.execute_phrase(self, phrase, bindings)
-        return self._empty_cursor if cursor is None else cursor
+        return phrase
+
+    def execute_df(self, string, bindings=None):
+        """Execute a BQL query and return its results as a dataframe.
+
+        The arguments are as for :meth:`execute`.  The columns of the
+        :class:`pandas.DataFrame` are built directly from the arrays
+        returned by :meth:`~bayeslite.bql.BayesDBCursor.fetch_columns`,
+        with NULL as NaN in numeric columns and None otherwise.
+        """
+        # Avoid a module-wide import: pandas is needed only here.
+        import pandas
+        cursor = self.execute(string, bindings)
+        names = [d[0] for d in cursor.description]
+        columns = []
+        for column in cursor.fetch_columns():
+            if column.dtype == numpy.object_:
+                # Masked entries already hold None.
+                columns.append(column.data)
+            elif column.mask.any():
+                columns.append(
+                    column.astype(numpy.float64).filled(numpy.nan))
+            else:
+                columns.append(column.data)
+        df = pandas.DataFrame(dict(enumerate(columns)),
+            columns=range(len(columns)))
+        df.columns = names
+        return df
+
+    def prepare(self, string):
+        """Prepare a BQL query for repeated execution.
+
+        The argument `string` is parsed, as for :meth:`execute`, into a
+        single BQL phrase, and a :class:`BayesDBStatement` is returned
+        whose :meth:`~BayesDBStatement.execute` method executes it with
+        bindings for its parameters, without parsing it again, and,
+        while the populations and generators stay the same, without
+        compiling it again.
+        """
+        return BayesDBStatement(self, string, self._parse_phrase(string))
+
+    def execute_background(self, string, bindings=None):
+        """Execute a BQL query in a background process.
+
+        The arguments are as for :meth:`execute`.  The query, normally
+        an ANALYZE, runs on a connection of its own to the same file,
+        with the backends registered here, and any results are
+        discarded.  Backends that commit their progress as they go
+        make it visible to this and other connections meanwhile, which
+        is best with a database opened in WAL mode.
+
+        Returns a :class:`BayesDBBackground` handle to wait for the
+        query or cancel it.  The database must be on disk, and there
+        must be no transaction in progress, since the query would not
+        see its changes.
+        """
+        if self.pathname == ":memory:":
+            raise ValueError('In-memory BayesDB cannot execute in background!')
+        if self._txn_depth:
+            raise txn.BayesDBTxnError(self,
+                'Cannot execute in background inside a transaction.')
+        if bindings is None:
+            bindings = ()
+        # Seed the background connection from the stream of this query,
+        # so that it is as reproducible as the query here would be.
+        self._begin_query()
+        seed = self.prng_stream().weakrandom_bytes(32)
+        backends = self.backends.values()
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_execute_background,
+            args=(self.pathname, seed, self._wal, backends, string, bindings,
+                writer))
+        process.start()
+        writer.close()
+        return BayesDBBackground(self, process, reader)
 
     def sql_execute(self, string, bindings=None):
         """Execute a SQL query on the underlying SQLite database.
@@ -366,6 +566,7 @@ class BayesDB(object):
             raise ValueError("""Cannot meaningfully reconnect to an in-memory
                 database. All prior transactions would be lost.""")
         assert self._txn_depth == 0, "pending BayesDB transactions"
+        core.bayesdb_invalidate_catalog(self)
         self._sqlite3.close()
         self._sqlite3 = apsw.Connection(self.pathname)
 
@@ -377,6 +578,124 @@ class BayesDB(object):
         """
         return self._sqlite3.changes()
 
+def _execute_background(pathname, seed, wal, backends, string, bindings,
+        writer):
+    error = None
+    try:
+        bdb = BayesDB(bayesdb_open_cookie, pathname=pathname, seed=seed,
+            wal=wal)
+        try:
+            if not wal:
+                bdb._sqlite3.setbusytimeout(WAL_BUSY_TIMEOUT)
+            for backend in backends:
+                bayesdb_register_backend(bdb, backend)
+            bdb.execute(string, bindings).fetchall()
+        finally:
+            bdb.close()
+    except Exception as e:
+        error = str(e) or type(e).__name__
+    writer.send(error)
+    writer.close()
+
+class BayesDBBackground(object):
+    """A BQL query executing in a background process.
+
+    Returned by :meth:`BayesDB.execute_background`.
+    """
+
+    def __init__(self, bdb, process, reader):
+        self.bdb = bdb
+        self._process = process
+        self._reader = reader
+        self._error = None
+
+    def running(self):
+        """True if the query has not yet finished."""
+        return self._process.is_alive()
+
+    def wait(self, timeout=None):
+        """Wait for the query to finish, for at most `timeout` seconds.
+
+        Returns true if it finished, and false if it is still running.
+        If it failed, raises :exc:`~bayeslite.BQLError` with its message.
+        """
+        self._process.join(timeout)
+        if self._process.is_alive():
+            return False
+        if self._reader is not None:
+            if self._reader.poll():
+                self._error = self._reader.recv()
+            elif self._process.exitcode:
+                self._error = 'Background process exited with status %d' % \
+                    (self._process.exitcode,)
+            self._reader.close()
+            self._reader = None
+        if self._error is not None:
+            raise BQLError(self.bdb, self._error)
+        return True
+
+    def cancel(self):
+        """Stop the query, keeping whatever it has already committed."""
+        if self._process.is_alive():
+            self._process.terminate()
+        self._process.join()
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+class BayesDBStatement(object):
+    """A BQL query prepared for repeated execution.
+
+    Do not create BayesDBStatement instances directly; use
+    :meth:`BayesDB.prepare` instead.
+
+    Queries and REGRESS whose compiled SQL depends only on the query
+    and the catalog are compiled once per version of the catalog, and
+    then only bound to parameters and run, reusing the SQLite
+    statement.  Work that depends on the parameters or on the data,
+    such as simulating the rows of SIMULATE or evaluating row
+    functions in batches, is redone by the winders of the compiled
+    query each time.  Other phrases, e.g. commands, are executed afresh
+    from the parsed phrase each time.
+    """
+
+    def __init__(self, bdb, string, phrase):
+        self.bdb = bdb
+        self.string = string
+        self._phrase = phrase
+        self._plan = None       # (catalog version, compiler.Output)
+
+    def execute(self, bindings=None):
+        """Execute the statement and return a cursor for its results.
+
+        The argument `bindings` is as for :meth:`BayesDB.execute`.
+        """
+        if bindings is None:
+            bindings = ()
+        self.bdb._begin_query()
+        return self.bdb._maybe_trace(
+            self.bdb.tracer, self._do_execute, self.string, bindings)
+
+    def _do_execute(self, string, bindings):
+        bdb = self.bdb
+        core.bayesdb_validate_catalog(bdb)
+        if self._plan is not None:
+            version, out = self._plan
+            if version == core.bayesdb_catalog_version(bdb):
+                cursor = bql.execute_plan(bdb, out.rebind(bindings))
+                if cursor is not None:
+                    return cursor
+            self._plan = None
+        cursor = bql.execute_phrase(bdb, self._phrase, bindings,
+            plan_key=string, plans=self)
+        return bdb._empty_cursor if cursor is None else cursor
+
+    def put(self, key, out):
+        # Called by bql.execute_phrase with the compiled query.
+        if not out.dynamic:
+            _string, version = key
+            self._plan = (version, out)
+
 class IBayesDBTracer(object):
     """BayesDB articulated tracing interface.
 
@@ -513,6 +832,18 @@ class TracingCursor(object):
             self._tracer.error(self._qid, e)
             raise
 
+    def fetch_columns(self):
+        try:
+            ans = self._cursor.fetch_columns()
+            self._tracer.finished(self._qid)
+            return ans
+        except Exception as e:
+            self._tracer.error(self._qid, e)
+            raise
+
+    def fetch_numpy(self):
+        return bql.columns_numpy(self.fetch_columns())
+
     @property
     def connection(self):
         return self._cursor.connection
@@ -25,7 +25,10 @@ language) are executed directly.
 
 import itertools
 
+from collections import OrderedDict
+
 import apsw
+import numpy
 
 import bayeslite.ast as ast
 import bayeslite.bqlfn as bqlfn
@@ -35,14 +38,109 @@ import bayeslite.txn as txn
 
 from bayeslite.exception import BQLError
 from bayeslite.guess import bayesdb_guess_stattypes
+from bayeslite.guess import bayesdb_guess_stattypes_counts
 from bayeslite.read_csv import bayesdb_read_csv_file
+from bayeslite.sqlite3_util import sqlite3_description
 from bayeslite.sqlite3_util import sqlite3_quote_name
 from bayeslite.util import casefold
 from bayeslite.util import cursor_value
 
 
-def execute_phrase(bdb, phrase, bindings=()):
-    """Execute the BQL AST phrase `phrase` and return a cursor of results."""
+# Phrases that may change populations, variables, or generators, after
+# which the in-memory catalog must be reloaded.
+_CATALOG_PHRASES = (
+    ast.AlterTab,
+    ast.CreatePop,
+    ast.DropPop,
+    ast.AlterPop,
+    ast.CreateGen,
+    ast.DropGen,
+    ast.AlterGen,
+)
+
+# Number of compiled queries kept for reuse by each BayesDB.
+PLAN_CACHE_SIZE = 256
+
+class BQLPlanCache(object):
+    """Least-recently-used cache of compiled BQL queries.
+
+    Maps the BQL text of a query and the version of the catalog it was
+    compiled against, as given by :func:`core.bayesdb_catalog_version`,
+    to its :class:`compiler.Output`.  Only queries whose compiled SQL
+    does not depend on the data are kept.
+    """
+
+    def __init__(self, size=None):
+        if size is None:
+            size = PLAN_CACHE_SIZE
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._plans = OrderedDict()
+
+    def get(self, key):
+        """Return the compiled query for `key`, or None."""
+        out = self._plans.pop(key, None)
+        if out is not None:
+            self.hits += 1
+            self._plans[key] = out
+        return out
+
+    def put(self, key, out):
+        """Count a query compiled for `key`, and keep it if reusable."""
+        self.misses += 1
+        if out.dynamic or self.size <= 0:
+            return
+        self._plans.pop(key, None)
+        self._plans[key] = out
+        while len(self._plans) > self.size:
+            self._plans.popitem(last=False)
+
+    def clear(self):
+        self._plans.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._plans),
+            'size': self.size,
+        }
+
+def execute_plan(bdb, out):
+    """Execute the query compiled into `out` from a plan cache.
+
+    Returns None if an earlier execution of it has not yet unwound, in
+    which case it must be compiled afresh.
+    """
+    assert not out.dynamic
+    if out.busy(bdb):
+        return None
+    winders, unwinders = out.getwindings()
+    return execute_wound(bdb, winders, unwinders, out.getvalue(),
+        out.getbindings())
+
+def execute_phrase(bdb, phrase, bindings=(), plan_key=None, plans=None):
+    """Execute the BQL AST phrase `phrase` and return a cursor of results.
+
+    If `plan_key` is given, and `phrase` is a query, its compiled form is
+    offered to `plans`, by default the plan cache of `bdb`, under
+    `plan_key` and the version of the catalog it was compiled against.
+    """
+    if plans is None:
+        plans = bdb._plans
+    core.bayesdb_validate_catalog(bdb)
+    unparametrized = phrase
+    if isinstance(phrase, ast.Parametrized):
+        unparametrized = phrase.phrase
+    if isinstance(unparametrized, _CATALOG_PHRASES):
+        try:
+            return _execute_phrase(bdb, phrase, bindings, None, plans)
+        finally:
+            core.bayesdb_invalidate_catalog(bdb)
+    return _execute_phrase(bdb, phrase, bindings, plan_key, plans)
+
+def _execute_phrase(bdb, phrase, bindings, plan_key, plans):
     if isinstance(phrase, ast.Parametrized):
         n_numpar = phrase.n_numpar
         nampar_map = phrase.nampar_map
@@ -56,10 +154,15 @@ def execute_phrase(bdb, phrase, bindings=()):
     if ast.is_query(phrase):
         # Compile the query in the transaction in case we need to
         # execute subqueries to determine column lists.  Compiling is
-        # a quick tree descent, so this should be fast.
-        out = compiler.Output(n_numpar, nampar_map, bindings)
+        # a quick tree descent, so this should be fast.  Row functions
+        # applied to every row are evaluated in batches by deferred
+        # winders when the cursor is first stepped.
+        out = compiler.Output(n_numpar, nampar_map, bindings, batch=True)
         with bdb.savepoint():
             compiler.compile_query(bdb, phrase, out)
+            if plan_key is not None:
+                catalog = core.bayesdb_catalog(bdb)
+                plans.put((plan_key, catalog.version), out)
         winders, unwinders = out.getwindings()
         return execute_wound(bdb, winders, unwinders, out.getvalue(),
             out.getbindings())
@@ -86,7 +189,7 @@ def execute_phrase(bdb, phrase, bindings=()):
                     raise BQLError(bdb,
                         'Name already defined as table: %s' %
                         (repr(phrase.name),))
-            out = compiler.Output(n_numpar, nampar_map, bindings)
+            out = compiler.Output(n_numpar, nampar_map, bindings, batch=True)
             qt = sqlite3_quote_name(phrase.name)
             temp = 'TEMP ' if phrase.temp else ''
             ifnotexists = 'IF NOT EXISTS ' if phrase.ifnotexists else ''
@@ -227,12 +330,8 @@ def execute_phrase(bdb, phrase, bindings=()):
             qtt = sqlite3_quote_name(temptable)
             cursor = bdb.sql_execute('SELECT * FROM %s' % (qt,))
             column_names = [d[0] for d in cursor.description]
-            rows = cursor.fetchall()
-            stattypes = bayesdb_guess_stattypes(column_names, rows)
-            distinct_value_counts = [
-                len(set([row[i] for row in rows]))
-                for i in range(len(column_names))
-            ]
+            stattypes, distinct_value_counts = \
+                bayesdb_guess_stattypes_counts(column_names, cursor)
             out.winder('''
                 CREATE TEMP TABLE %s (
                     column TEXT,
@@ -355,9 +454,8 @@ def execute_phrase(bdb, phrase, bindings=()):
                     if cmd.stattype is None:
                         cursor = bdb.sql_execute(
                             'SELECT %s FROM %s' % (qc, qt))
-                        rows = cursor.fetchall()
                         [stattype, reason] = bayesdb_guess_stattypes(
-                            [cmd.name], rows)[0]
+                            [cmd.name], cursor)[0]
                         # Fail if trying to model a key.
                         if stattype == 'key':
                             raise BQLError(bdb,
@@ -717,6 +815,9 @@ def execute_phrase(bdb, phrase, bindings=()):
         if stattype != 'numerical':
             raise BQLError(bdb,
                 'Target variable is not numerical: %r' % (phrase.target,))
+        # The regression is computed by a winder each time the compiled
+        # REGRESS is executed.
+        out = compiler.Output(n_numpar, nampar_map, bindings)
         # Build the given variables.
         if any(isinstance(col, ast.SelColAll) for col in phrase.givens):
             # Using * is not allowed to be mixed with other variables.
@@ -727,7 +828,6 @@ def execute_phrase(bdb, phrase, bindings=()):
         else:
             if any(isinstance(col, ast.SelColSub) for col in phrase.givens):
                 # Subexpression needs special compiling.
-                out = compiler.Output(n_numpar, nampar_map, bindings)
                 bql_compiler = compiler.BQLCompiler_None()
                 givens = compiler.expand_select_columns(
                     bdb, phrase.givens, True, bql_compiler, out)
@@ -748,40 +848,45 @@ def execute_phrase(bdb, phrase, bindings=()):
         colnos = [colno_target] + list(colno_givens_unique)
         nsamp = 100 if phrase.nsamp is None else phrase.nsamp.value.value
         modelnos = None if phrase.modelnos is None else str(phrase.modelnos)
-        rows = bqlfn.bayesdb_simulate(
-            bdb, population_id, generator_id, modelnos, constraints,
-            colnos, numpredictions=nsamp)
         # Retrieve the stattypes.
         stattypes = [
             core.bayesdb_variable_stattype(
                 bdb, population_id, generator_id, colno_given)
             for colno_given in colno_givens_unique
         ]
-        # Separate the target values from the given values.
-        target_values = [row[0] for row in rows]
-        given_values = [row[1:] for row in rows]
         given_names = [
             core.bayesdb_variable_name(bdb, population_id, generator_id, given)
             for given in colno_givens_unique
         ]
-        # Compute the coefficients. The import to regress_ols is here since the
-        # feature depends on pandas + sklearn, so avoid module-wide import.
-        from bayeslite.regress import regress_ols
-        coefficients = regress_ols(
-            target_values, given_values, given_names, stattypes)
-        # Store the results in a winder.
-        temptable = bdb.temp_table_name()
+        temptable = out.temp_table_name(bdb)
         qtt = sqlite3_quote_name(temptable)
-        out = compiler.Output(0, {}, {})
+        def regress(bdb, _bindings):
+            rows = bqlfn.bayesdb_simulate(
+                bdb, population_id, generator_id, modelnos, constraints,
+                colnos, numpredictions=nsamp)
+            # Separate the target values from the given values.
+            target_values = [row[0] for row in rows]
+            given_values = [row[1:] for row in rows]
+            # Compute the coefficients. The import to regress_ols is here
+            # since the feature depends on pandas + sklearn, so avoid
+            # module-wide import.
+            from bayeslite.regress import regress_ols
+            coefficients = regress_ols(
+                target_values, given_values, given_names, stattypes)
+            for variable, coef in coefficients:
+                bdb.sql_execute('''
+                    INSERT INTO %s VALUES (?, ?)
+                ''' % (qtt), (variable, coef,))
+        # Store the results in a winder.
         out.winder('''
             CREATE TEMP TABLE %s (variable TEXT, coefficient REAL);
         ''' % (qtt,), ())
-        for variable, coef in coefficients:
-            out.winder('''
-                INSERT INTO %s VALUES (?, ?)
-            ''' % (qtt), (variable, coef,))
+        out.computed_winder(regress)
         out.write('SELECT * FROM %s ORDER BY variable' % (qtt,))
         out.unwinder('DROP TABLE %s' % (qtt,), ())
+        if plan_key is not None:
+            catalog = core.bayesdb_catalog(bdb)
+            plans.put((plan_key, catalog.version), out)
         winders, unwinders = out.getwindings()
         return execute_wound(
             bdb, winders, unwinders, out.getvalue(), out.getbindings())
@@ -843,10 +948,9 @@ def _create_population(bdb, phrase):
         qt = sqlite3_quote_name(phrase.table)
         qcns = ','.join(map(sqlite3_quote_name, pop_guess))
         cursor = bdb.sql_execute('SELECT %s FROM %s' % (qcns, qt))
-        rows = cursor.fetchall()
         # XXX This function returns a stattype called `key`, which we will add
         # to the pop_ignore_vars.
-        pop_guess_stattypes = bayesdb_guess_stattypes(pop_guess, rows)
+        pop_guess_stattypes = bayesdb_guess_stattypes(pop_guess, cursor)
         pop_guess_vars = zip(pop_guess, [st[0] for st in pop_guess_stattypes])
         migrate = [(col, st) for col, st in pop_guess_vars if st=='key']
         for col, st in migrate:
@@ -952,11 +1056,16 @@ def empty_cursor(bdb):
 def execute_wound(bdb, winders, unwinders, sql, bindings):
     if len(winders) == 0 and len(unwinders) == 0:
         return bdb.sql_execute(sql, bindings)
+    deferred = [(thunk, d) for thunk, d in winders if callable(thunk) and d]
+    winders = [(w, b) for w, b in winders if not (callable(w) and b)]
     with bdb.savepoint():
-        for (wsql, wbindings) in winders:
-            bdb.sql_execute(wsql, wbindings)
+        compiler.bayesdb_run_winders(bdb, winders)
         try:
-            return WoundCursor(bdb, bdb.sql_execute(sql, bindings), unwinders)
+            if deferred:
+                cursor = DeferredCursor(bdb, deferred, sql, bindings)
+            else:
+                cursor = bdb.sql_execute(sql, bindings)
+            return WoundCursor(bdb, cursor, unwinders)
         except:
             for (usql, ubindings) in unwinders:
                 bdb.sql_execute(usql, ubindings)
@@ -992,6 +1101,22 @@ class BayesDBCursor(object):
     def fetchall(self):
         with txn.bayesdb_caching(self._bdb):
             return self._cursor.fetchall()
+    def fetch_columns(self):
+        """Fetch all remaining rows as one NumPy array per column.
+
+        Each column is a :class:`numpy.ma.MaskedArray` masked where
+        the value is NULL, of int64 dtype if every value is an integer
+        that fits, of float64 dtype if every value is a number, and of
+        object dtype otherwise.
+        """
+        with txn.bayesdb_caching(self._bdb):
+            return cursor_columns(self._cursor, len(self._description))
+    def fetch_numpy(self):
+        """Fetch all remaining rows as a two-dimensional float64 array.
+
+        NULL values become NaN.  Every value must be a number or NULL.
+        """
+        return columns_numpy(self.fetch_columns())
     @property
     def connection(self):
         return self._bdb
@@ -1002,6 +1127,139 @@ class BayesDBCursor(object):
     def description(self):
         return self._description
 
+# Number of rows fetched into a batch of tuples at a time while
+# building column arrays.
+FETCH_CHUNK_SIZE = 4096
+
+def cursor_columns(cursor, ncols):
+    """Fetch all rows of `cursor` into `ncols` masked column arrays.
+
+    Rows are taken :data:`FETCH_CHUNK_SIZE` at a time and copied into
+    arrays that double in size as they fill, so only one chunk of row
+    tuples is alive at once.
+    """
+    columns = [_ColumnBuilder() for _ in xrange(ncols)]
+    while True:
+        rows = list(itertools.islice(cursor, FETCH_CHUNK_SIZE))
+        if not rows:
+            break
+        for column, values in zip(columns, zip(*rows)):
+            column.extend(values)
+    return [column.finish() for column in columns]
+
+def columns_numpy(columns):
+    """Stack masked column arrays into a float64 array, NaN for NULL."""
+    for i, column in enumerate(columns):
+        if column.dtype == numpy.object_:
+            raise ValueError('Non-numeric values in column %d' % (i,))
+    array = numpy.empty((len(columns[0]) if columns else 0, len(columns)))
+    for i, column in enumerate(columns):
+        array[:, i] = column.astype(numpy.float64).filled(numpy.nan)
+    return array
+
+class _ColumnBuilder(object):
+    # Accumulate a column in an array whose dtype widens as needed
+    # from int64 to float64 to object, with a parallel NULL mask.
+    def __init__(self):
+        self._dtype = None      # None until a non-NULL value
+        self._data = None
+        self._mask = numpy.zeros(0, dtype=bool)
+        self._n = 0
+
+    def extend(self, values):
+        k = len(values)
+        mask = numpy.fromiter((v is None for v in values), dtype=bool,
+            count=k)
+        if mask.all():
+            chunk = None
+            dtype = self._dtype
+        else:
+            values = list(values)
+            if mask.any():
+                fill = 0 if self._dtype != numpy.object_ else None
+                values = [fill if v is None else v for v in values]
+            chunk, dtype = _column_chunk(values, mask, self._dtype)
+        self._reserve(self._n + k, dtype)
+        if chunk is not None:
+            self._data[self._n:self._n + k] = chunk
+        self._mask[self._n:self._n + k] = mask
+        self._n += k
+
+    def _reserve(self, n, dtype):
+        capacity = len(self._mask)
+        if capacity < n:
+            capacity = max(n, 2*capacity)
+            mask = numpy.zeros(capacity, dtype=bool)
+            mask[:self._n] = self._mask[:self._n]
+            self._mask = mask
+        if dtype is None:
+            return
+        if self._data is None or dtype != self._dtype or \
+                len(self._data) < capacity:
+            if dtype == numpy.object_:
+                data = numpy.empty(capacity, dtype=dtype)  # all None
+            else:
+                data = numpy.zeros(capacity, dtype=dtype)
+            if self._data is not None:
+                data[:self._n] = self._data[:self._n]
+                if dtype == numpy.object_:
+                    data[:self._n][self._mask[:self._n]] = None
+            self._data = data
+            self._dtype = dtype
+
+    def finish(self):
+        if self._data is None:
+            data = numpy.zeros(self._n, dtype=numpy.float64)
+        else:
+            data = self._data[:self._n]
+        return numpy.ma.MaskedArray(data, mask=self._mask[:self._n].copy())
+
+def _column_chunk(values, mask, dtype):
+    # Convert the values of one chunk of a column to an array of dtype
+    # at least as wide as `dtype'.  Masked positions hold a filler.
+    types = set(map(type, values))
+    if dtype != numpy.object_ and types <= set([int, long]):
+        try:
+            return numpy.array(values, dtype=numpy.int64), \
+                numpy.int64 if dtype is None else dtype
+        except OverflowError:
+            pass
+    elif dtype != numpy.object_ and types <= set([int, long, float]):
+        return numpy.array(values, dtype=numpy.float64), numpy.float64
+    chunk = numpy.empty(len(values), dtype=numpy.object_)
+    chunk[:] = values
+    chunk[mask] = None
+    return chunk, numpy.object_
+
+class DeferredCursor(object):
+    """Cursor for a query executed after deferred winders.
+
+    The query is only prepared to find its description until the
+    cursor is first stepped, when the winders are run and the query is
+    executed, so that errors in either are reported by the cursor.
+    """
+    def __init__(self, bdb, winders, sql, bindings):
+        self._bdb = bdb
+        self._winders = winders
+        self._sql = sql
+        self._bindings = bindings
+        self._cursor = None
+        self.description = sqlite3_description(bdb._sqlite3, sql, bindings)
+    def _execute(self):
+        if self._cursor is None:
+            with self._bdb.savepoint():
+                compiler.bayesdb_run_winders(self._bdb, self._winders)
+            self._cursor = self._bdb.sql_execute(self._sql, self._bindings)
+        return self._cursor
+    def __iter__(self):
+        return self
+    def next(self):
+        return self._execute().next()
+    def fetchone(self):
+        return self._execute().fetchone()
+    def fetchall(self):
+        return self._execute().fetchall()
+
 class WoundCursor(BayesDBCursor):
     def __init__(self, bdb, cursor, unwinders):
         self._unwinders = unwinders
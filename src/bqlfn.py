@@ -14,9 +14,13 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import itertools
 import json
 import math
+import multiprocessing
+import multiprocessing.pool
 import numpy
+import os
 
 import bayeslite.core as core
 import bayeslite.stats as stats
@@ -284,15 +288,34 @@ define_correlation_p('cyclic', 'numerical', correlation_p_pearsonr2)
 def bql_column_dependence_probability(
         bdb, population_id, generator_id, modelnos, colno0, colno1):
     modelnos = _retrieve_modelnos(modelnos)
-    def generator_depprob(generator_id):
-        backend = core.bayesdb_generator_backend(bdb, generator_id)
-        depprob_list = backend.column_dependence_probability(
-            bdb, generator_id, modelnos, colno0, colno1)
-        return stats.arithmetic_mean(depprob_list)
     generator_ids = _retrieve_generator_ids(bdb, population_id, generator_id)
-    depprobs = map(generator_depprob, generator_ids)
+    depprob_lists = _map_generators(bdb, generator_ids,
+        'column_dependence_probability', modelnos, colno0, colno1)
+    depprobs = map(stats.arithmetic_mean, depprob_lists)
     return stats.arithmetic_mean(depprobs)
 
+def bql_column_dependence_probability_matrix(
+        bdb, population_id, generator_id, modelnos, colnos):
+    """Return the dependence probability of every pair of `colnos`.
+
+    The result is a list of rows, one for each of `colnos`, of the
+    dependence probabilities with each of `colnos`, averaged over
+    models and generators as in
+    :func:`bql_column_dependence_probability`.
+    """
+    modelnos = _retrieve_modelnos(modelnos)
+    generator_ids = _retrieve_generator_ids(bdb, population_id, generator_id)
+    matrices = [
+        [map(stats.arithmetic_mean, row) for row in matrix]
+        for matrix in _map_generators(bdb, generator_ids,
+            'column_dependence_probability_matrix', modelnos, colnos)
+    ]
+    return [
+        [stats.arithmetic_mean([m[i][j] for m in matrices])
+            for j in xrange(len(colnos))]
+        for i in xrange(len(colnos))
+    ]
+
 # Two-column function:  MUTUAL INFORMATION [OF <col0> WITH <col1>]
 def bql_column_mutual_information(
         bdb, population_id, generator_id, modelnos, colnos0, colnos1,
@@ -316,13 +339,10 @@ def _bql_column_mutual_information(
         raise ValueError('Odd constraint arguments: %s.' % (constraint_args))
     constraints = zip(constraint_args[::2], constraint_args[1::2]) \
         if constraint_args else None
-    def generator_mutinf(generator_id):
-        backend = core.bayesdb_generator_backend(bdb, generator_id)
-        return backend.column_mutual_information(
-            bdb, generator_id, modelnos, colnos0, colnos1,
-            constraints=constraints, numsamples=numsamples)
     generator_ids = _retrieve_generator_ids(bdb, population_id, generator_id)
-    mutinfs = map(generator_mutinf, generator_ids)
+    mutinfs = _map_generators(bdb, generator_ids,
+        'column_mutual_information', modelnos, colnos0, colnos1,
+        constraints=constraints, numsamples=numsamples)
     return mutinfs
 
 # One-column function: PROBABILITY DENSITY OF <col>=<value> GIVEN <constraints>
@@ -390,21 +410,14 @@ def _bql_logpdf(bdb, population_id, generator_id, modelnos, targets,
     # weight?).
     rowid, constraints = _retrieve_rowid_constraints(
         bdb, population_id, constraints)
-    def logpdf(generator_id, backend):
-        return backend.logpdf_joint(
-            bdb, generator_id, modelnos, rowid, targets, constraints)
-    def loglikelihood(generator_id, backend):
-        if not constraints:
-            return 0
-        return backend.logpdf_joint(
-            bdb, generator_id, modelnos, rowid, constraints, [])
     generator_ids = _retrieve_generator_ids(bdb, population_id, generator_id)
-    backends = [
-        core.bayesdb_generator_backend(bdb, g)
-        for g in generator_ids
-    ]
-    loglikelihoods = map(loglikelihood, generator_ids, backends)
-    logpdfs = map(logpdf, generator_ids, backends)
+    if constraints:
+        loglikelihoods = _map_generators(bdb, generator_ids, 'logpdf_joint',
+            modelnos, rowid, constraints, [])
+    else:
+        loglikelihoods = [0] * len(generator_ids)
+    logpdfs = _map_generators(bdb, generator_ids, 'logpdf_joint',
+        modelnos, rowid, targets, constraints)
     return logavgexp_weighted(loglikelihoods, logpdfs)
 
 ### BayesDB row functions
@@ -415,16 +428,59 @@ def bql_row_similarity(
     if target_rowid is None:
         raise BQLError(bdb, 'No such target row for SIMILARITY')
     modelnos = _retrieve_modelnos(modelnos)
-    def generator_similarity(generator_id):
-        backend = core.bayesdb_generator_backend(bdb, generator_id)
-        # XXX Change [colno] to colno by updating BayesDB_Backend.
-        similarity_list = backend.row_similarity(
-            bdb, generator_id, modelnos, rowid, target_rowid, [colno])
-        return stats.arithmetic_mean(similarity_list)
     generator_ids = _retrieve_generator_ids(bdb, population_id, generator_id)
-    similarities = map(generator_similarity, generator_ids)
+    # XXX Change [colno] to colno by updating BayesDB_Backend.
+    similarity_lists = _map_generators(bdb, generator_ids, 'row_similarity',
+        modelnos, rowid, target_rowid, [colno])
+    similarities = map(stats.arithmetic_mean, similarity_lists)
     return stats.arithmetic_mean(similarities)
 
+def bql_row_similarity_batch(
+        bdb, population_id, generator_id, modelnos, rowids, target_rowid,
+        colno):
+    """Return SIMILARITY TO `target_rowid` of each of `rowids`.
+
+    Batched form of :func:`bql_row_similarity` for evaluating the row
+    function at every row of the population, with one backend call per
+    generator rather than one per row.
+    """
+    if not rowids:
+        return []
+    if target_rowid is None:
+        raise BQLError(bdb, 'No such target row for SIMILARITY')
+    modelnos = _retrieve_modelnos(modelnos)
+    queries = [(rowid, target_rowid) for rowid in rowids]
+    generator_ids = _retrieve_generator_ids(bdb, population_id, generator_id)
+    similarities = [
+        map(stats.arithmetic_mean, similarity_lists)
+        for similarity_lists in _map_generators(bdb, generator_ids,
+            'row_similarity_many', modelnos, queries, [colno])
+    ]
+    return [
+        stats.arithmetic_mean([s[i] for s in similarities])
+        for i in xrange(len(rowids))
+    ]
+
+def bql_row_similarity_blocks(
+        bdb, population_id, generator_id, modelnos, rowids, colno,
+        block_size=256):
+    """Yield the SIMILARITY matrix of `rowids` in the context of `colno`.
+
+    Pairwise form of :func:`bql_row_similarity`:  yields the rows of
+    the matrix in blocks of at most `block_size` rows, as NumPy arrays
+    of shape ``(n, len(rowids))``, averaged over generators.
+    """
+    modelnos = _retrieve_modelnos(modelnos)
+    generator_ids = _retrieve_generator_ids(bdb, population_id, generator_id)
+    generator_blocks = [
+        core.bayesdb_generator_backend(bdb, generator_id).row_similarity_blocks(
+            bdb, generator_id, modelnos, rowids, [colno],
+            block_size=block_size)
+        for generator_id in generator_ids
+    ]
+    for blocks in itertools.izip(*generator_blocks):
+        yield sum(blocks) / len(blocks)
+
 # Row function:  PREDICTIVE RELEVANCE TO (<target_row>)
 #  [<AND HYPOTHETICAL ROWS WITH VALUES ((...))] IN THE CONTEXT OF <column>
 def bql_row_predictive_relevance(
@@ -446,13 +502,9 @@ def bql_row_predictive_relevance(
     hypotheticals = [zip(row[::2], row[1::2]) for row in rows_list]
     if len(rowid_query) == 0 and len(hypotheticals) == 0:
         raise BQLError(bdb, 'No matching rows for PREDICTIVE RELEVANCE.')
-    def generator_similarity(generator_id):
-        backend = core.bayesdb_generator_backend(bdb, generator_id)
-        return backend.predictive_relevance(
-            bdb, generator_id, modelnos, rowid_target, rowid_query,
-            hypotheticals, colno)
     generator_ids = _retrieve_generator_ids(bdb, population_id, generator_id)
-    sims = map(generator_similarity, generator_ids)
+    sims = _map_generators(bdb, generator_ids, 'predictive_relevance',
+        modelnos, rowid_target, rowid_query, hypotheticals, colno)
     return stats.arithmetic_mean([stats.arithmetic_mean(s) for s in sims])
 
 # Row function:  PREDICTIVE PROBABILITY OF <targets> [GIVEN <constraints>]
@@ -475,16 +527,45 @@ def bql_row_column_predictive_probability(
     if len(cgpm_targets) == 0:
         return None
     cgpm_constraints = retrieve_values(constraints)
-    def generator_predprob(generator_id):
-        backend = core.bayesdb_generator_backend(bdb, generator_id)
-        return backend.logpdf_joint(
-            bdb, generator_id, modelnos, fresh_rowid, cgpm_targets,
-            cgpm_constraints)
     generator_ids = _retrieve_generator_ids(bdb, population_id, generator_id)
-    predprobs = map(generator_predprob, generator_ids)
+    predprobs = _map_generators(bdb, generator_ids, 'logpdf_joint',
+        modelnos, fresh_rowid, cgpm_targets, cgpm_constraints)
     r = logmeanexp(predprobs)
     return ieee_exp(r)
 
+def bql_row_column_predictive_probability_batch(
+        bdb, population_id, generator_id, modelnos, rowids, targets,
+        constraints):
+    """Return PREDICTIVE PROBABILITY of `targets` at each of `rowids`.
+
+    Batched form of :func:`bql_row_column_predictive_probability`: the
+    cell values of all rows are read in a single query, and each
+    generator evaluates the rows in one backend call.
+    """
+    if not rowids:
+        return []
+    modelnos = _retrieve_modelnos(modelnos)
+    fresh_rowid = core.bayesdb_population_fresh_row_id(bdb, population_id)
+    colnos = targets + constraints
+    queries = []
+    for row in core.bayesdb_population_cell_values(
+            bdb, population_id, rowids, colnos):
+        cells = [(c,v) for (c,v) in zip(colnos, row) if v is not None]
+        cgpm_targets = [(c,v) for (c,v) in cells if c in targets]
+        cgpm_constraints = [(c,v) for (c,v) in cells if c in constraints]
+        queries.append((fresh_rowid, cgpm_targets, cgpm_constraints))
+    # If all targets have NULL values, the result is None; don't ask.
+    indices = [i for i, query in enumerate(queries) if query[1]]
+    results = [None] * len(rowids)
+    if not indices:
+        return results
+    generator_ids = _retrieve_generator_ids(bdb, population_id, generator_id)
+    predprobs = _map_generators(bdb, generator_ids, 'logpdf_joint_many',
+        modelnos, [queries[i] for i in indices])
+    for k, i in enumerate(indices):
+        results[i] = ieee_exp(logmeanexp([p[k] for p in predprobs]))
+    return results
+
 ### Predict and simulate
 
 def bql_predict(
@@ -495,7 +576,7 @@ def bql_predict(
     modelnos = _retrieve_modelnos(modelnos)
     if generator_id is None:
         generator_ids = core.bayesdb_population_generators(bdb, population_id)
-        index = bdb.np_prng.randint(0, high=len(generator_ids))
+        index = _choose_generator(bdb, rowid, colno, len(generator_ids))
         generator_id = generator_ids[index]
     backend = core.bayesdb_generator_backend(bdb, generator_id)
     return backend.predict(
@@ -509,7 +590,7 @@ def bql_predict_confidence(
     # how to aggregate imputations across different hypotheses.
     if generator_id is None:
         generator_ids = core.bayesdb_population_generators(bdb, population_id)
-        index = bdb.np_prng.randint(0, high=len(generator_ids))
+        index = _choose_generator(bdb, rowid, colno, len(generator_ids))
         generator_id = generator_ids[index]
     modelnos = _retrieve_modelnos(modelnos)
     backend = core.bayesdb_generator_backend(bdb, generator_id)
@@ -518,6 +599,13 @@ def bql_predict_confidence(
     # XXX Whattakludge!
     return json.dumps({'value': value, 'confidence': confidence})
 
+def _choose_generator(bdb, rowid, colno, n):
+    # Draw from the stream for this cell, before any generator is chosen,
+    # not from bdb.np_prng, so that the choice does not depend on which
+    # cells were predicted before.
+    prng = bdb.prng_stream(None, None, rowid, colno)
+    return prng.weakrandom_uniform(n)
+
 # XXX Whattakludge!
 def bql_json_get(bdb, blob, key):
     return json.loads(blob)[key]
@@ -538,11 +626,6 @@ def bayesdb_simulate(
     modelnos = _retrieve_modelnos(modelnos)
     rowid, constraints = _retrieve_rowid_constraints(
         bdb, population_id, constraints)
-    def loglikelihood(generator_id, backend):
-        if not constraints:
-            return 0
-        return backend.logpdf_joint(
-            bdb, generator_id, modelnos, rowid, constraints, [])
     def simulate(generator_id, backend, n):
         return backend.simulate_joint(
             bdb, generator_id, modelnos, rowid, colnos, constraints,
@@ -553,7 +636,11 @@ def bayesdb_simulate(
         for generator_id in generator_ids
     ]
     if len(generator_ids) > 1:
-        loglikelihoods = map(loglikelihood, generator_ids, backends)
+        if constraints:
+            loglikelihoods = _map_generators(bdb, generator_ids,
+                'logpdf_joint', modelnos, rowid, constraints, [])
+        else:
+            loglikelihoods = [0] * len(generator_ids)
         likelihoods = map(math.exp, loglikelihoods)
         total_likelihood = sum(likelihoods)
         if total_likelihood == 0:
@@ -563,8 +650,10 @@ def bayesdb_simulate(
             likelihood / total_likelihood
             for likelihood in likelihoods
         ]
-        countses = bdb.np_prng.multinomial(
-            numpredictions, probabilities, size=1)
+        # Split the samples among the generators with the stream for the
+        # row and columns, before any generator is chosen.
+        prng = bdb.np_prng_stream(None, None, rowid, *colnos)
+        countses = prng.multinomial(numpredictions, probabilities, size=1)
         counts = countses[0]
     elif len(generator_ids) == 1:
         counts = [numpredictions]
@@ -580,6 +669,119 @@ def bayesdb_simulate(
 def bql_rand(bdb):
     return bdb.np_prng.uniform()
 
+### Evaluating generators concurrently
+
+# Number of threads evaluating the generators of a population.
+GENERATOR_THREADS = 8
+
+def _map_generators(bdb, generator_ids, method, *args, **kwargs):
+    """Return what query `method` of each generator returns, in order.
+
+    Calls ``backend.method(bdb, generator_id, *args, **kwargs)`` for
+    each generator.  If there are several, those whose backends prepare
+    the call with :meth:`~BayesDB_Backend.prepare_concurrent` run
+    concurrently in threads or worker processes, while the rest are
+    called here in turn.  Either way the results are combined in the
+    order of `generator_ids`, so they do not depend on which finished
+    first.
+    """
+    backends = [
+        core.bayesdb_generator_backend(bdb, generator_id)
+        for generator_id in generator_ids
+    ]
+    if len(generator_ids) < 2:
+        return [
+            getattr(backend, method)(bdb, generator_id, *args, **kwargs)
+            for generator_id, backend in zip(generator_ids, backends)
+        ]
+    # Prepare every call here, where the query holds the connection,
+    # before any runs, so that none of them issues SQL concurrently.
+    executor = _generator_executor(bdb)
+    tasks = [
+        backend.prepare_concurrent(bdb, generator_id,
+            executor.memo(generator_id), method, *args, **kwargs)
+        for generator_id, backend in zip(generator_ids, backends)
+    ]
+    pending = [
+        executor.submit(generator_id, *task) if task is not None else None
+        for generator_id, task in zip(generator_ids, tasks)
+    ]
+    results = [
+        getattr(backend, method)(bdb, generator_id, *args, **kwargs)
+        if result is None else None
+        for generator_id, backend, result
+        in zip(generator_ids, backends, pending)
+    ]
+    for i, result in enumerate(pending):
+        if result is not None:
+            results[i] = executor.result(generator_ids[i], result)
+    return results
+
+def _generator_executor(bdb):
+    executor = bdb._generator_executor
+    if executor is None or executor.pid != os.getpid():
+        executor = bdb._generator_executor = _GeneratorExecutor()
+    return executor
+
+class _GeneratorExecutor(object):
+    """Threads and worker processes evaluating the generators of a BayesDB.
+
+    Created when first needed and closed with the BayesDB.  Threads
+    are shared; each generator gets a worker process of its own, so
+    that the worker can keep what the backend sent it, e.g. a loaded
+    model, between calls.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._threads = None
+        self._processes = {}
+        self._memos = {}
+
+    def memo(self, generator_id):
+        """Return the memo of the worker process of `generator_id`."""
+        return self._memos.setdefault(generator_id, {})
+
+    def submit(self, generator_id, executor, function, args):
+        if executor == 'thread':
+            if self._threads is None:
+                self._threads = multiprocessing.pool.ThreadPool(
+                    GENERATOR_THREADS)
+            return self._threads.apply_async(function, args)
+        elif executor == 'process':
+            if generator_id not in self._processes:
+                self._processes[generator_id] = multiprocessing.Pool(1)
+            return self._processes[generator_id].apply_async(function, args)
+        else:
+            raise ValueError('Unknown executor: %r' % (executor,))
+
+    def result(self, generator_id, result):
+        try:
+            return result.get()
+        except Exception:
+            # Whatever the worker process of the generator kept may not
+            # match its memo any more, so start afresh.
+            if generator_id in self._processes:
+                self._close_pool(self._processes.pop(generator_id))
+            self._memos.pop(generator_id, None)
+            raise
+
+    def close(self):
+        if self.pid != os.getpid():
+            # Inherited by a forked process:  the pools are not ours.
+            return
+        if self._threads is not None:
+            self._close_pool(self._threads)
+            self._threads = None
+        for pool in self._processes.itervalues():
+            self._close_pool(pool)
+        self._processes.clear()
+        self._memos.clear()
+
+    def _close_pool(self, pool):
+        pool.terminate()
+        pool.join()
+
 ### Helper functions functions
 
 def _retrieve_rowid_constraints(bdb, population_id, constraints):
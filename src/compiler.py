@@ -26,11 +26,20 @@ To compile a parsed BQL query:
    were actually used in the query.
 6. Use :func:`bayesdb_wind` or similar to bracket the execution of the
    SQL query with wind/unwind commands.
+
+Unless :attr:`Output.dynamic` is set, the compiled SQL text and its
+winders depend only on the query and the catalog, not on the data or
+on the values of the parameters, and :meth:`Output.rebind` may reuse
+them with other values.  Winders that depend on the data or on the
+parameters are computed afresh for each execution by thunks.
 """
 
 import StringIO
 import contextlib
+import copy
+import itertools
 import json
+import numpy
 
 import bayeslite.ast as ast
 import bayeslite.bqlfn as bqlfn
@@ -50,7 +59,9 @@ class Output(object):
     for parameters and subqueries.
     """
 
-    def __init__(self, n_numpar, nampar_map, bindings):
+    def __init__(self, n_numpar, nampar_map, bindings, batch=None):
+        if batch is None:
+            batch = False
         self._stringio = StringIO.StringIO()
         # Below, `number' means 1-based, and `index' means 0-based.  n
         # is a source language number; m, an output sqlite3 number; i,
@@ -62,11 +73,39 @@ class Output(object):
         self._renumber = {}             # map of input number -> output number
         self._select = []               # map of output index -> input index
         self._winders = []              # list of pre-query (sql, bindings)
+                                        # or (thunk, deferred)
         self._unwinders = []            # list of post-query (sql, bindings)
+        self._temptables = []           # temporary tables of the winders
+        self._parent = None             # accumulator we are a subquery of
+        self.batch = batch              # evaluate row functions in batches
+        self.dynamic = False            # output depends on data
 
     def subquery(self):
         """Return an output accumulator for a subquery."""
-        return Output(self._n_numpar, self._nampar_map, self._bindings)
+        subout = Output(self._n_numpar, self._nampar_map, self._bindings,
+            batch=self.batch)
+        subout._parent = self
+        return subout
+
+    def mark_dynamic(self):
+        """Note that the output depends on data read while compiling.
+
+        Also marks every accumulator this is a subquery of.
+        """
+        out = self
+        while out is not None:
+            out.dynamic = True
+            out = out._parent
+
+    def rebind(self, bindings):
+        """Return a copy of the accumulated output for other `bindings`.
+
+        Only meaningful if the output is not :attr:`dynamic`, or if
+        `bindings` are the ones it was compiled with.
+        """
+        out = copy.copy(self)
+        out._bindings = bindings
+        return out
 
     def getvalue(self):
         """Return the accumulated output."""
@@ -99,6 +138,9 @@ class Output(object):
                     continue
                 missing.remove(name_folded)
                 n = self._nampar_map[name_folded]
+                if n not in self._renumber:
+                    # Not used in this subquery.
+                    continue
                 m = self._renumber[n]
                 j = m - 1
                 assert bindings_list[j] is None
@@ -143,7 +185,39 @@ class Output(object):
             raise TypeError('Invalid query bindings: %s' % (self._bindings,))
 
     def getwindings(self):
-        return self._winders, self._unwinders
+        """Return the winders and unwinders of the accumulated output.
+
+        Each winder is a ``(<sql>, <bindings>)`` tuple, or a ``(<thunk>,
+        <deferred>)`` tuple with a thunk to call with `bdb`, computing
+        the winder for the bindings of the output.
+        """
+        bindings = self._bindings
+        def bind(thunk):
+            return lambda bdb: thunk(bdb, bindings)
+        winders = [
+            (bind(sql), arg) if callable(sql) else (sql, arg)
+            for sql, arg in self._winders
+        ]
+        return winders, self._unwinders
+
+    def temp_table_name(self, bdb):
+        """Return the name of a new temporary table for the winders.
+
+        The table must be created by a winder and dropped by an
+        unwinder of the output.
+        """
+        temptable = bdb.temp_table_name()
+        self._temptables.append(temptable)
+        return temptable
+
+    def busy(self, bdb):
+        """True if an execution of the output has not yet unwound.
+
+        The output must then not be executed again until it has, lest
+        its winders create temporary tables that already exist.
+        """
+        return any(core.bayesdb_has_table(bdb, temptable)
+            for temptable in self._temptables)
 
     def write(self, text):
         """Accumulate `text` in the output of :meth:`getvalue`."""
@@ -182,6 +256,25 @@ class Output(object):
 
     def winder(self, sql, bindings):
         self._winders.append((sql, bindings))
+    def computed_winder(self, thunk):
+        """Call `thunk(bdb, bindings)` before the query.
+
+        `bindings` are those the query is executed with, which may not
+        be those it was compiled with, so that work depending on them
+        or on the data, e.g. simulating rows, is done afresh for each
+        execution of a compiled query.
+        """
+        self._winders.append((thunk, False))
+    def deferred_winder(self, thunk):
+        """Call `thunk(bdb, bindings)` once the query results are wanted.
+
+        Like :meth:`computed_winder`, but the query is prepared after
+        the other winders, and `thunk` is called only when its cursor is
+        first stepped, so that costly work, e.g. evaluating a row
+        function in a batch, fails like the query does and not while it
+        is being prepared.
+        """
+        self._winders.append((thunk, True))
     def unwinder(self, sql, bindings):
         self._unwinders.append((sql, bindings))
 
@@ -194,8 +287,7 @@ def bayesdb_wind(bdb, winders, unwinders):
     """
     if 0 < len(winders) or 0 < len(unwinders):
         with bdb.savepoint():
-            for (sql, bindings) in winders:
-                bdb.sql_execute(sql, bindings)
+            bayesdb_run_winders(bdb, winders)
             try:
                 yield
             finally:
@@ -204,6 +296,14 @@ def bayesdb_wind(bdb, winders, unwinders):
     else:
         yield
 
+def bayesdb_run_winders(bdb, winders):
+    """Perform queries `winders`, calling any deferred ones in order."""
+    for (sql, bindings) in winders:
+        if callable(sql):
+            sql(bdb)
+        else:
+            bdb.sql_execute(sql, bindings)
+
 def compile_query(bdb, query, out):
     """Compile `query`, writing output to `output`.
 
@@ -475,8 +575,16 @@ def compile_estimate(bdb, estimate, out):
                 (estimate.generator,))
         generator_id = core.bayesdb_get_generator(
             bdb, population_id, estimate.generator)
-    bql_compiler = BQLCompiler_1Row(population_id, generator_id,
-        estimate.modelnos)
+    # Row functions are evaluated at every row of the table unless a
+    # WHERE clause filters the rows or a LIMIT without ORDER BY stops
+    # early, in which case batching would compute values nobody needs.
+    if out.batch and estimate.condition is None and \
+            (estimate.limit is None or estimate.order is not None):
+        bql_compiler = BQLCompiler_1Row_Batch(population_id, generator_id,
+            estimate.modelnos)
+    else:
+        bql_compiler = BQLCompiler_1Row(population_id, generator_id,
+            estimate.modelnos)
     named = True
     columns = expand_select_columns(
         bdb, estimate.columns, named, bql_compiler, out)
@@ -613,6 +721,7 @@ def subquery_columns(bdb, subquery, out):
     subquery = subout.getvalue()
     subbindings = subout.getbindings()
     subwinders, subunwinders = subout.getwindings()
+    out.mark_dynamic()
     with bayesdb_wind(bdb, subwinders, subunwinders):
         yield bdb.sql_execute(subquery, subbindings)
 
@@ -642,8 +751,6 @@ def compile_simulate(bdb, simulate, out):
     assert all(isinstance(c, ast.SelColExp) for c in simulate.columns)
     assert all(isinstance(c.expression, ast.ExpCol) for c in simulate.columns)
     with bdb.savepoint():
-        temptable = bdb.temp_table_name()
-        assert not core.bayesdb_has_table(bdb, temptable)
         if not core.bayesdb_has_population(bdb, simulate.population):
             raise BQLError(bdb,
                 'No such population: %s' % (simulate.population,))
@@ -657,7 +764,6 @@ def compile_simulate(bdb, simulate, out):
             generator_id = core.bayesdb_get_generator(
                 bdb, population_id, simulate.generator)
         modelnos = None if simulate.modelnos is None else str(simulate.modelnos)
-        qtt = sqlite3_quote_name(temptable)
         column_names = [c.expression.column for c in simulate.columns]
         qcns = map(sqlite3_quote_name, column_names)
         for column_name in column_names:
@@ -683,13 +789,6 @@ def compile_simulate(bdb, simulate, out):
         for _column_name, expression in simulate.constraints:
             subout.write(', ')
             compile_nobql_expression(bdb, expression, subout)
-        winders, unwinders = subout.getwindings()
-        with bayesdb_wind(bdb, winders, unwinders):
-            cursor = bdb.sql_execute(subout.getvalue(),
-                subout.getbindings()).fetchall()
-        assert len(cursor) == 1
-        nsamples = cursor[0][0]
-        assert isinstance(nsamples, int)
         def map_var(var):
             if casefold(var) not in core.bayesdb_rowid_tokens(bdb):
                 if not core.bayesdb_has_variable(bdb, population_id,
@@ -702,23 +801,27 @@ def compile_simulate(bdb, simulate, out):
                     bdb, population_id, generator_id, var)
             else:
                 return casefold(var)
-        def map_constraint(((var, _expression), value)):
-            return (map_var(var), value)
-        constraints = \
-            map(map_constraint, zip(simulate.constraints, cursor[0][1:]))
+        constraint_vars = [map_var(var) for var, _exp in simulate.constraints]
         colnos = map(map_var, column_names)
-        schema = ','.join(qcns)
-        out.winder('CREATE TEMP TABLE %s (%s)' % (qtt, schema), ())
-        insert_sql = '''
-            INSERT INTO %s (%s) VALUES (%s)
-        ''' % (qtt, ','.join(qcns), ','.join('?' for qcn in qcns))
-        for row in bqlfn.bayesdb_simulate(
+        # Evaluate the number of samples and the constraints, and
+        # simulate, each time the query is executed, so that a compiled
+        # SIMULATE may be executed again with other bindings.
+        def rows(bindings):
+            values = subout.rebind(bindings)
+            winders, unwinders = values.getwindings()
+            with bayesdb_wind(bdb, winders, unwinders):
+                cursor = bdb.sql_execute(values.getvalue(),
+                    values.getbindings()).fetchall()
+            assert len(cursor) == 1
+            nsamples = cursor[0][0]
+            assert isinstance(nsamples, int)
+            constraints = zip(constraint_vars, cursor[0][1:])
+            return bqlfn.bayesdb_simulate(
                 bdb, population_id, generator_id, modelnos,
                 constraints, colnos, numpredictions=nsamples,
-                accuracy=simulate.accuracy
-            ):
-            out.winder(insert_sql, row)
-        out.unwinder('DROP TABLE %s' % (qtt,), ())
+                accuracy=simulate.accuracy)
+        qtt = materialize_values(bdb, ','.join(qcns), qcns, rows, out,
+            deferred=False)
         out.write('SELECT * FROM %s' % (qtt,))
 
 def compile_simulate_models(bdb, simmodels, bql_compiler, out):
@@ -934,8 +1037,34 @@ def compile_estpaircols(bdb, estpaircols, out):
                 (estpaircols.generator,))
         generator_id = core.bayesdb_get_generator(
             bdb, population_id, estpaircols.generator)
-    bql_compiler = BQLCompiler_2Col(population_id, generator_id,
-        estpaircols.modelnos, colno0_exp, colno1_exp)
+    # As in compile_estpairrow, evaluate DEPENDENCE PROBABILITY for all
+    # pairs at once only if the query visits every pair of variables,
+    # and then only for the variables it ranges over.
+    if out.batch and estpaircols.condition is None and \
+            (estpaircols.limit is None or estpaircols.order is not None):
+        colnosout = out.subquery()
+        colnosout.write('SELECT colno FROM bayesdb_variable'
+            ' WHERE population_id = %d' % (population_id,))
+        if generator_id is None:
+            colnosout.write(' AND generator_id IS NULL')
+        else:
+            colnosout.write(' AND (generator_id IS NULL OR generator_id = %d)'
+                % (generator_id,))
+        if estpaircols.subcolumns is not None:
+            colnosout.write(' AND colno IN ')
+            with compiling_paren(bdb, colnosout, '(', ')'):
+                compile_column_lists(bdb, population_id, generator_id,
+                    estpaircols.subcolumns, None, colnosout)
+        colnosout.write(' ORDER BY colno')
+        def colnos():
+            # The column lists are compiled to literal numbers.
+            cursor = bdb.sql_execute(colnosout.getvalue())
+            return [colno for (colno,) in cursor]
+        bql_compiler = BQLCompiler_2Col_Batch(population_id, generator_id,
+            estpaircols.modelnos, colno0_exp, colno1_exp, colnos)
+    else:
+        bql_compiler = BQLCompiler_2Col(population_id, generator_id,
+            estpaircols.modelnos, colno0_exp, colno1_exp)
     out.write('SELECT'
         ' %d AS population_id, v0.name AS name0, v1.name AS name1' %
         (population_id,))
@@ -1019,8 +1148,22 @@ def compile_estpairrow(bdb, estpairrow, out):
             bdb, population_id, estpairrow.generator)
     rowid0_exp = 'r0._rowid_'
     rowid1_exp = 'r1._rowid_'
-    bql_compiler = BQLCompiler_2Row(population_id, generator_id,
-        estpairrow.modelnos, rowid0_exp, rowid1_exp)
+    # As in compile_estimate, evaluate SIMILARITY for all pairs at once
+    # only if the query visits every pair of rows.
+    if out.batch and estpairrow.condition is None and \
+            (estpairrow.limit is None or estpairrow.order is not None):
+        bql_compiler = BQLCompiler_2Row_Batch(population_id, generator_id,
+            estpairrow.modelnos, rowid0_exp, rowid1_exp)
+    else:
+        bql_compiler = BQLCompiler_2Row(population_id, generator_id,
+            estpairrow.modelnos, rowid0_exp, rowid1_exp)
+    # With ORDER BY SIMILARITY ... LIMIT, range over only the pairs that
+    # may make the cut instead of materializing the whole matrix.
+    qtop = None
+    if isinstance(bql_compiler, BQLCompiler_2Row_Batch) and \
+            estpairrow.order is not None and estpairrow.limit is not None:
+        qtop = bql_compiler.restrict_order(bdb, estpairrow.order,
+            estpairrow.limit, out)
     out.write('SELECT %s AS rowid0, %s AS rowid1,' % (rowid0_exp, rowid1_exp))
     named = True
     columns = expand_select_columns(
@@ -1029,7 +1172,12 @@ def compile_estpairrow(bdb, estpairrow, out):
     out.write(' AS value')
     table_name = core.bayesdb_population_table(bdb, population_id)
     qt = sqlite3_quote_name(table_name)
-    out.write(' FROM %s AS r0, %s AS r1' % (qt, qt))
+    if qtop is not None:
+        assert estpairrow.condition is None
+        out.write(' FROM %s AS top, %s AS r0, %s AS r1' % (qtop, qt, qt))
+        out.write(' WHERE r0._rowid_ = top.rowid0 AND r1._rowid_ = top.rowid1')
+    else:
+        out.write(' FROM %s AS r0, %s AS r1' % (qt, qt))
     if estpairrow.condition is not None:
         out.write(' WHERE ')
         compile_expression(bdb, estpairrow.condition, bql_compiler, out)
@@ -1148,78 +1296,8 @@ class BQLCompiler_1Row(BQLCompiler_Const):
         modelnos = self.modelnos
         rowid_col = '_rowid_'   # XXX Don't hard-code this.
         if isinstance(bql, ast.ExpBQLPredProb):
-            if not bql.targets:
-                raise BQLError(bdb, 'Predictive probability at row'
-                    ' needs targets.')
-            duplicates = [t for t in bql.targets if t in bql.constraints]
-            if duplicates:
-                raise BQLError(bdb,
-                    'Duplicate identifiers in targets and constraints: %s.'
-                    % (duplicates,))
-            def report_unknown_variables(colnos):
-                """Throws a BQLError if c in colnos is not in the population."""
-                unknown = [
-                    colno for colno in colnos
-                    if not core.bayesdb_has_variable(
-                        bdb, population_id, generator_id, colno)
-                ]
-                if unknown:
-                    population = core.bayesdb_population_name(
-                        bdb, population_id)
-                    raise BQLError(bdb,
-                        'No such variables in population %s: %s' %
-                        (population, unknown))
-            # If * in targets, use all variables except those in constraints.
-            if ast.ColListAll() in bql.targets:
-                if len(bql.targets) > 1:
-                    raise BQLError(bdb,'Cannot use (*) with other targets.')
-                # Use generator_id as not to retrieve latent variables.
-                constraints = [c.columns[0] for c in bql.constraints]
-                report_unknown_variables(constraints)
-                colnos_all = core.bayesdb_variable_numbers(
-                    bdb, population_id, None)
-                colnos_constraints = [
-                    core.bayesdb_variable_number(
-                        bdb, population_id, generator_id, constraint)
-                    for constraint in constraints
-                ]
-                colnos_targets = [
-                    colno for colno in colnos_all
-                    if colno not in colnos_constraints
-                ]
-            # If * in constraints, use all variables except those in targets.
-            elif ast.ColListAll() in bql.constraints:
-                if len(bql.constraints) > 1:
-                    raise BQLError(bdb,'Cannot use (*) with other constraints.')
-                colnos_all = core.bayesdb_variable_numbers(
-                    bdb, population_id, None)
-                targets = [c.columns[0] for c in bql.targets]
-                report_unknown_variables(targets)
-                colnos_targets = [
-                    core.bayesdb_variable_number(
-                        bdb, population_id, generator_id, target)
-                    for target in targets
-                ]
-                colnos_constraints = [
-                    colno for colno in colnos_all
-                    if colno not in colnos_targets
-                ]
-            # If no *, use the variables exactly as specified in the query.
-            else:
-                targets = [c.columns[0] for c in bql.targets]
-                constraints = [c.columns[0] for c in bql.constraints]
-                report_unknown_variables(targets)
-                report_unknown_variables(constraints)
-                colnos_targets = [
-                    core.bayesdb_variable_number(
-                        bdb, population_id, generator_id, target)
-                    for target in targets
-                ]
-                colnos_constraints = [
-                    core.bayesdb_variable_number(
-                        bdb, population_id, generator_id, constraint)
-                    for constraint in constraints
-                ]
+            colnos_targets, colnos_constraints = predictive_probability_colnos(
+                bdb, population_id, generator_id, bql)
             out.write('bql_row_column_predictive_probability(%d, %s, %s' %(
                 population_id, nullor(generator_id), nullorq(modelnos)))
             out.write(', %s, \'%s\', \'%s\')' % (
@@ -1253,6 +1331,338 @@ class BQLCompiler_1Row(BQLCompiler_Const):
         else:
             super(BQLCompiler_1Row, self).compile_bql(bdb, bql, out)
 
+def predictive_probability_colnos(bdb, population_id, generator_id, bql):
+    """Return target and constraint colnos of PREDICTIVE PROBABILITY `bql`."""
+    if not bql.targets:
+        raise BQLError(bdb, 'Predictive probability at row'
+            ' needs targets.')
+    duplicates = [t for t in bql.targets if t in bql.constraints]
+    if duplicates:
+        raise BQLError(bdb,
+            'Duplicate identifiers in targets and constraints: %s.'
+            % (duplicates,))
+    def report_unknown_variables(colnos):
+        """Throws a BQLError if c in colnos is not in the population."""
+        unknown = [
+            colno for colno in colnos
+            if not core.bayesdb_has_variable(
+                bdb, population_id, generator_id, colno)
+        ]
+        if unknown:
+            population = core.bayesdb_population_name(
+                bdb, population_id)
+            raise BQLError(bdb,
+                'No such variables in population %s: %s' %
+                (population, unknown))
+    # If * in targets, use all variables except those in constraints.
+    if ast.ColListAll() in bql.targets:
+        if len(bql.targets) > 1:
+            raise BQLError(bdb,'Cannot use (*) with other targets.')
+        # Use generator_id as not to retrieve latent variables.
+        constraints = [c.columns[0] for c in bql.constraints]
+        report_unknown_variables(constraints)
+        colnos_all = core.bayesdb_variable_numbers(
+            bdb, population_id, None)
+        colnos_constraints = [
+            core.bayesdb_variable_number(
+                bdb, population_id, generator_id, constraint)
+            for constraint in constraints
+        ]
+        colnos_targets = [
+            colno for colno in colnos_all
+            if colno not in colnos_constraints
+        ]
+    # If * in constraints, use all variables except those in targets.
+    elif ast.ColListAll() in bql.constraints:
+        if len(bql.constraints) > 1:
+            raise BQLError(bdb,'Cannot use (*) with other constraints.')
+        colnos_all = core.bayesdb_variable_numbers(
+            bdb, population_id, None)
+        targets = [c.columns[0] for c in bql.targets]
+        report_unknown_variables(targets)
+        colnos_targets = [
+            core.bayesdb_variable_number(
+                bdb, population_id, generator_id, target)
+            for target in targets
+        ]
+        colnos_constraints = [
+            colno for colno in colnos_all
+            if colno not in colnos_targets
+        ]
+    # If no *, use the variables exactly as specified in the query.
+    else:
+        targets = [c.columns[0] for c in bql.targets]
+        constraints = [c.columns[0] for c in bql.constraints]
+        report_unknown_variables(targets)
+        report_unknown_variables(constraints)
+        colnos_targets = [
+            core.bayesdb_variable_number(
+                bdb, population_id, generator_id, target)
+            for target in targets
+        ]
+        colnos_constraints = [
+            core.bayesdb_variable_number(
+                bdb, population_id, generator_id, constraint)
+            for constraint in constraints
+        ]
+    return colnos_targets, colnos_constraints
+
+class BQLCompiler_1Row_Batch(BQLCompiler_1Row):
+    """1-row compiler evaluating row functions at every row in one batch.
+
+    Used for ESTIMATE queries that visit every row of the population
+    table.  PREDICTIVE PROBABILITY and SIMILARITY TO are computed for
+    all rows when the query is first stepped, materialized in a
+    temporary table, and joined to the population table by rowid,
+    instead of calling into Python once per row from SQLite.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(BQLCompiler_1Row_Batch, self).__init__(*args, **kwargs)
+        # Temporary table of the values of each row function, keyed by
+        # its compiled arguments, so that the values are computed once
+        # even if the query mentions the function several times, e.g.
+        # in ORDER BY.
+        self._row_tables = {}
+
+    @override(IBQLCompiler)
+    def compile_bql(self, bdb, bql, out):
+        assert ast.is_bql(bql)
+        population_id = self.population_id
+        generator_id = self.generator_id
+        modelnos = None if self.modelnos is None else str(self.modelnos)
+        if isinstance(bql, ast.ExpBQLPredProb):
+            colnos_targets, colnos_constraints = predictive_probability_colnos(
+                bdb, population_id, generator_id, bql)
+            def batch(rowids):
+                return bqlfn.bql_row_column_predictive_probability_batch(
+                    bdb, population_id, generator_id, modelnos, rowids,
+                    colnos_targets, colnos_constraints)
+            key = ('predprob', tuple(colnos_targets),
+                tuple(colnos_constraints))
+            self._row_values(bdb, key, batch, out)
+        elif isinstance(bql, ast.ExpBQLSim) and bql.ofcondition is None:
+            colno = similarity_context_colno(bdb, population_id,
+                generator_id, bql, self, out)
+            if colno is None:
+                # Not a single context variable -- let the scalar
+                # function report it or cope with it row by row.
+                super(BQLCompiler_1Row_Batch, self).compile_bql(bdb, bql, out)
+                return
+            target_rowid = self._similarity_target(bdb, bql, out)
+            def batch(rowids):
+                return bqlfn.bql_row_similarity_batch(
+                    bdb, population_id, generator_id, modelnos, rowids,
+                    target_rowid, colno)
+            key = ('similarity', target_rowid, colno)
+            self._row_values(bdb, key, batch, out)
+        else:
+            super(BQLCompiler_1Row_Batch, self).compile_bql(bdb, bql, out)
+
+    def _row_values(self, bdb, key, batch, out):
+        if key not in self._row_tables:
+            self._row_tables[key] = materialize_row_values(
+                bdb, self.population_id, batch, out)
+        qtt = self._row_tables[key]
+        table_name = core.bayesdb_population_table(bdb, self.population_id)
+        qt = sqlite3_quote_name(table_name)
+        out.write('(SELECT value FROM %s WHERE rowid = %s._rowid_)'
+            % (qtt, qt))
+
+    def _similarity_target(self, bdb, bql, out):
+        # Evaluate the target row condition as the scalar subquery
+        # would: the first matching row, or None if there is none.
+        bql_compiler = BQLCompiler_1Row(
+            self.population_id, self.generator_id, self.modelnos)
+        table_name = core.bayesdb_population_table(bdb, self.population_id)
+        qt = sqlite3_quote_name(table_name)
+        subout = out.subquery()
+        subout.write('SELECT _rowid_ FROM %s WHERE ' % (qt,))
+        compile_expression(bdb, bql.tocondition, bql_compiler, subout)
+        winders, unwinders = subout.getwindings()
+        out.mark_dynamic()
+        with bayesdb_wind(bdb, winders, unwinders):
+            cursor = bdb.sql_execute(subout.getvalue(), subout.getbindings())
+            rows = cursor.fetchall()
+        return rows[0][0] if rows else None
+
+def population_rowids(bdb, population_id):
+    table_name = core.bayesdb_population_table(bdb, population_id)
+    qt = sqlite3_quote_name(table_name)
+    cursor = bdb.sql_execute('SELECT _rowid_ FROM %s' % (qt,))
+    return [rowid for (rowid,) in cursor]
+
+def similarity_context_colno(bdb, population_id, generator_id, bql,
+        bql_compiler, out):
+    """Return the context variable of SIMILARITY `bql`, or None.
+
+    None means the context is not a single variable, and the scalar
+    function must report it or cope with it row by row.
+    """
+    assert len(bql.column) == 1
+    if isinstance(bql.column[0], ast.ColListAll):
+        raise BQLError(bdb, 'Cannot use all variables for CONTEXT.')
+    subout = out.subquery()
+    compile_column_lists(bdb, population_id, generator_id, bql.column,
+        bql_compiler, subout)
+    colnos = subout.getvalue().split(', ')
+    if len(colnos) != 1 or colnos[0] == '':
+        return None
+    return int(colnos[0])
+
+# Maximum number of rows per INSERT when materializing batched values,
+# fewer if needed to keep the parameter count within SQLite's default
+# limit of SQLITE_MAX_VARIABLES.
+ROW_VALUES_CHUNK = 256
+SQLITE_MAX_VARIABLES = 999
+
+def materialize_row_values(bdb, population_id, batch, out):
+    """Store values computed by `batch` for every row in a temporary table.
+
+    `batch(rowids)` is called with the rowids of the population table
+    when the query is first stepped, and returns their values.  The
+    values are stored in a temporary table, created and dropped around
+    the query.  Returns the quoted name of the table, keyed by rowid.
+    """
+    def rows(_bindings):
+        rowids = population_rowids(bdb, population_id)
+        values = batch(rowids)
+        assert len(rowids) == len(values)
+        return zip(rowids, values)
+    return materialize_values(bdb, 'rowid INTEGER PRIMARY KEY, value',
+        ['rowid', 'value'], rows, out)
+
+def compile_pair_values(bdb, colnos, batch, out):
+    """Store a matrix of values for pairs of columns in a temporary table.
+
+    Like :func:`materialize_row_values`, but `colnos()` and then
+    `batch(colnos)` are called when the query is first stepped, the
+    latter returning a matrix of values for each pair of `colnos`.
+    Returns the quoted name of the table, keyed by (colno0, colno1).
+    """
+    def rows(_bindings):
+        colnos_ = colnos()
+        matrix = batch(colnos_)
+        assert len(colnos_) == len(matrix)
+        return [
+            (colno0, colno1, value)
+            for colno0, row in zip(colnos_, matrix)
+            for colno1, value in zip(colnos_, row)
+        ]
+    return materialize_values(bdb,
+        'colno0 INTEGER, colno1 INTEGER, value, PRIMARY KEY (colno0, colno1)',
+        ['colno0', 'colno1', 'value'], rows, out)
+
+def materialize_matrix_values(bdb, population_id, matrix_blocks, out,
+        top=None, descending=None):
+    """Store a matrix of values for pairs of rows in a temporary table.
+
+    When the query is first stepped, `matrix_blocks(rowids)` is called
+    with the rowids of the population table, and yields consecutive
+    blocks of rows of the matrix as NumPy arrays, each stored before
+    the next is computed.
+
+    If `top` is not None, `top(bindings)` returns the number of highest
+    values, or lowest if not `descending`, to keep for the bindings of
+    the query, with NULL lowest as SQLite orders it, or None to keep
+    all.  Pairs tied with the last one kept are kept too.  Returns the
+    quoted name of the table, keyed by (rowid0, rowid1).
+    """
+    def rows(bindings):
+        rowids = population_rowids(bdb, population_id)
+        n = None if top is None else top(bindings)
+        if n is None:
+            return matrix_rows(rowids, matrix_blocks(rowids))
+        return top_matrix_rows(rowids, matrix_blocks(rowids), n, descending)
+    return materialize_values(bdb,
+        'rowid0 INTEGER, rowid1 INTEGER, value, PRIMARY KEY (rowid0, rowid1)',
+        ['rowid0', 'rowid1', 'value'], rows, out)
+
+def matrix_rows(rowids, blocks):
+    """Yield (rowid0, rowid1, value) for every entry of a blocked matrix."""
+    i = 0
+    for block in blocks:
+        for values in block.tolist():
+            rowid0 = rowids[i]
+            i += 1
+            for rowid1, value in zip(rowids, values):
+                yield (rowid0, rowid1, value)
+
+def top_matrix_rows(rowids, blocks, n, descending):
+    """Return (rowid0, rowid1, value) for the `n` best entries of a matrix.
+
+    Entries are ranked by value, highest first if `descending` and
+    lowest first otherwise, with NaN lowest, and entries tied with the
+    `n`th best are included, so that any ORDER BY with these values as
+    its first term and LIMIT `n` picks from them alone.  Only the best
+    entries so far are kept while the blocks are consumed.
+    """
+    if n == 0:
+        return []
+    worst = -numpy.inf if descending else numpy.inf
+    threshold = -numpy.inf
+    scores = numpy.zeros(0)
+    values = numpy.zeros(0)
+    i0s = numpy.zeros(0, dtype=int)
+    i1s = numpy.zeros(0, dtype=int)
+    i = 0
+    for block in blocks:
+        score = numpy.where(numpy.isnan(block), worst,
+            block if descending else -block)
+        r, c = numpy.nonzero(score >= threshold)
+        scores = numpy.concatenate((scores, score[r, c]))
+        values = numpy.concatenate((values, block[r, c]))
+        i0s = numpy.concatenate((i0s, i + r))
+        i1s = numpy.concatenate((i1s, c))
+        if n < len(scores):
+            threshold = numpy.partition(scores, len(scores) - n)[-n]
+            keep = threshold <= scores
+            scores = scores[keep]
+            values = values[keep]
+            i0s = i0s[keep]
+            i1s = i1s[keep]
+        i += len(block)
+    order = numpy.lexsort((i1s, i0s))
+    return [
+        (rowids[i0], rowids[i1], value)
+        for i0, i1, value in zip(i0s[order].tolist(), i1s[order].tolist(),
+            values[order].tolist())
+    ]
+
+def materialize_values(bdb, schema, columns, rows, out, deferred=None):
+    """Store `rows` in a temporary table for the duration of the query.
+
+    `rows(bindings)` is called with the bindings of the query when it
+    is first stepped, or when it is executed if `deferred` is false,
+    and may return any iterable, which is consumed in chunks.  Returns
+    the quoted name of the table, which is created and filled by
+    winders and dropped by unwinders of `out`.
+    """
+    if deferred is None:
+        deferred = True
+    temptable = out.temp_table_name(bdb)
+    assert not core.bayesdb_has_table(bdb, temptable)
+    qtt = sqlite3_quote_name(temptable)
+    placeholders = '(%s)' % (', '.join('?' for _column in columns),)
+    chunk_size = max(1,
+        min(ROW_VALUES_CHUNK, SQLITE_MAX_VARIABLES // len(columns)))
+    def insert(bdb, bindings):
+        it = iter(rows(bindings))
+        while True:
+            chunk = list(itertools.islice(it, chunk_size))
+            if not chunk:
+                break
+            insert_sql = 'INSERT INTO %s (%s) VALUES %s' % (qtt,
+                ', '.join(columns), ', '.join(placeholders for _r in chunk))
+            bdb.sql_execute(insert_sql, [x for row in chunk for x in row])
+    out.winder('CREATE TEMP TABLE %s (%s)' % (qtt, schema), ())
+    if deferred:
+        out.deferred_winder(insert)
+    else:
+        out.computed_winder(insert)
+    out.unwinder('DROP TABLE %s' % (qtt,), ())
+    return qtt
+
 class BQLCompiler_1Row_Infer(BQLCompiler_1Row):
     @override(IBQLCompiler)
     def implicit_reference_var_colno_exp(self, bdb):
@@ -1366,6 +1776,94 @@ class BQLCompiler_2Row(IBQLCompiler):
         else:
             assert False, 'Invalid BQL function: %s' % (repr(bql),)
 
+class BQLCompiler_2Row_Batch(BQLCompiler_2Row):
+    """2-row compiler evaluating SIMILARITY for all pairs in one batch.
+
+    Used for ESTIMATE ... FROM PAIRWISE queries that visit every pair
+    of rows.  The similarity matrix is computed block by block when the
+    query is first stepped, streamed into a temporary table keyed by
+    pairs of rowids, and looked up for the current pair of rows.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(BQLCompiler_2Row_Batch, self).__init__(*args, **kwargs)
+        # Temporary table of the matrix for each context variable, so
+        # that the matrix is computed once even if the query mentions
+        # it several times, e.g. in ORDER BY.
+        self._similarity_tables = {}
+
+    def restrict_order(self, bdb, order, limit, out):
+        """Store only the pairs of rows that `order` and `limit` can select.
+
+        If the first ORDER BY term is a SIMILARITY computed in a batch,
+        no pair ranked by it below the LIMIT plus OFFSET best can be in
+        the results whatever the other terms are, so only a running top
+        of the matrix, ties included, is stored.  Returns the quoted
+        name of the table of those pairs, which the query must range
+        over instead of all pairs of rows, or None if it needs them all.
+        """
+        bql = order[0].expression
+        if not (isinstance(bql, ast.ExpBQLSim) and
+                bql.ofcondition is None and bql.tocondition is None):
+            return None
+        colno = similarity_context_colno(bdb, self.population_id,
+            self.generator_id, bql, self, out)
+        if colno is None:
+            return None
+        limitout = out.subquery()
+        limitout.write('SELECT ')
+        compile_expression(bdb, limit.limit, self, limitout)
+        limitout.write(', ')
+        if limit.offset is None:
+            limitout.write('0')
+        else:
+            compile_expression(bdb, limit.offset, self, limitout)
+        def top(bindings):
+            cursor = bdb.sql_execute(limitout.getvalue(),
+                limitout.rebind(bindings).getbindings())
+            n, offset = cursor.fetchall()[0]
+            # Leave anything but a nonnegative integer LIMIT, which
+            # SQLite takes to mean no limit or rejects, to SQLite.
+            if not (isinstance(n, (int, long)) and
+                    isinstance(offset, (int, long))) or n < 0:
+                return None
+            return n + max(offset, 0)
+        descending = order[0].sense == ast.ORD_DESC
+        assert colno not in self._similarity_tables
+        self._similarity_tables[colno] = self._similarity_table(bdb, colno,
+            out, top=top, descending=descending)
+        return self._similarity_tables[colno]
+
+    @override(IBQLCompiler)
+    def compile_bql(self, bdb, bql, out):
+        assert ast.is_bql(bql)
+        if isinstance(bql, ast.ExpBQLSim) and \
+                bql.ofcondition is None and bql.tocondition is None:
+            colno = similarity_context_colno(bdb, self.population_id,
+                self.generator_id, bql, self, out)
+            if colno is None:
+                super(BQLCompiler_2Row_Batch, self).compile_bql(bdb, bql, out)
+                return
+            if colno not in self._similarity_tables:
+                self._similarity_tables[colno] = self._similarity_table(
+                    bdb, colno, out)
+            qtt = self._similarity_tables[colno]
+            out.write('(SELECT value FROM %s'
+                ' WHERE rowid0 = %s AND rowid1 = %s)'
+                % (qtt, self.rowid0_exp, self.rowid1_exp))
+        else:
+            super(BQLCompiler_2Row_Batch, self).compile_bql(bdb, bql, out)
+
+    def _similarity_table(self, bdb, colno, out, top=None, descending=None):
+        population_id = self.population_id
+        generator_id = self.generator_id
+        modelnos = None if self.modelnos is None else str(self.modelnos)
+        def blocks(rowids):
+            return bqlfn.bql_row_similarity_blocks(
+                bdb, population_id, generator_id, modelnos, rowids, colno)
+        return materialize_matrix_values(bdb, population_id, blocks, out,
+            top=top, descending=descending)
+
 class BQLCompiler_1Col(BQLCompiler_Const):
     def __init__(self, population_id, generator_id, modelnos, colno_exp):
         assert isinstance(population_id, int)
@@ -1472,6 +1970,44 @@ class BQLCompiler_2Col(BQLCompiler_Const):
         else:
             super(BQLCompiler_2Col, self).compile_bql(bdb, bql, out)
 
+class BQLCompiler_2Col_Batch(BQLCompiler_2Col):
+    """2-column compiler evaluating pairwise functions in one batch.
+
+    Used for ESTIMATE ... FROM PAIRWISE VARIABLES queries that visit
+    every pair of variables:  DEPENDENCE PROBABILITY is computed for
+    every pair of the variables given by `colnos()` at once when the
+    query is first stepped, and each pair is served from the resulting
+    matrix, materialized in a temporary table.
+    """
+
+    def __init__(self, population_id, generator_id, modelnos,
+            colno0_exp, colno1_exp, colnos):
+        super(BQLCompiler_2Col_Batch, self).__init__(population_id,
+            generator_id, modelnos, colno0_exp, colno1_exp)
+        self.colnos = colnos
+        # Temporary table of the matrix, so that it is computed once
+        # even if the query mentions it several times, e.g. in ORDER BY.
+        self._depprob_table = None
+
+    @override(IBQLCompiler)
+    def compile_bql(self, bdb, bql, out):
+        assert ast.is_bql(bql)
+        population_id = self.population_id
+        generator_id = self.generator_id
+        modelnos = None if self.modelnos is None else str(self.modelnos)
+        if isinstance(bql, ast.ExpBQLDepProb) and \
+                bql.column0 is None and bql.column1 is None:
+            def batch(colnos):
+                return bqlfn.bql_column_dependence_probability_matrix(
+                    bdb, population_id, generator_id, modelnos, colnos)
+            if self._depprob_table is None:
+                self._depprob_table = compile_pair_values(bdb, self.colnos,
+                    batch, out)
+            out.write('(SELECT value FROM %s WHERE colno0 = %s AND colno1 = %s)'
+                % (self._depprob_table, self.colno0_exp, self.colno1_exp))
+        else:
+            super(BQLCompiler_2Col_Batch, self).compile_bql(bdb, bql, out)
+
 def compile_pdf_joint(bdb, population_id, generator_id, modelnos,
         targets, constraints, bql_compiler, out):
     out.write('bql_pdf_joint(%d, %s, %s' % (population_id,
@@ -1631,6 +2167,7 @@ def compile_predictive_relevance_conditions(bdb, population_id, generator_id,
         compile_expression(bdb, tocondition, bql_compiler, subout)
         subbindings = subout.getbindings()
         subwinders, subunwinders = subout.getwindings()
+        out.mark_dynamic()
         with bayesdb_wind(bdb, subwinders, subunwinders):
             subquery = 'SELECT _rowid_ FROM %s WHERE %s'\
                 % (qt, subout.getvalue())
@@ -1699,6 +2236,7 @@ def compile_column_lists(bdb, population_id, generator_id, column_lists,
             subquery = subout.getvalue()
             subbindings = subout.getbindings()
             subwinders, subunwinders = subout.getwindings()
+            out.mark_dynamic()
             with bayesdb_wind(bdb, subwinders, subunwinders):
                 columns = bdb.sql_execute(subquery, subbindings).fetchall()
             subfirst = True
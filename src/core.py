@@ -41,11 +41,143 @@ generator, and may be identified uniquely by ``(generator_id,
 modelno)`` or ``(generator_name, modelno)``.
 """
 
+import itertools
+
 from bayeslite.exception import BQLError
 from bayeslite.sqlite3_util import sqlite3_quote_name
 from bayeslite.util import casefold
 from bayeslite.util import cursor_value
 
+# Tables whose contents are mirrored in the in-memory catalog.  Any
+# write to one of these drops the catalog; see bayesdb_catalog.
+_CATALOG_TABLES = frozenset([
+    'bayesdb_population',
+    'bayesdb_variable',
+    'bayesdb_generator',
+    'bayesdb_rowid_tokens',
+])
+
+# Numbers identifying each catalog loaded, never reused in the process.
+_catalog_versions = itertools.count(1)
+
+class BayesDBCatalog(object):
+    """In-memory snapshot of the populations, variables, and generators.
+
+    Do not construct directly; use :func:`bayesdb_catalog`, which
+    loads the catalog once per connection and reloads it after any
+    change to the underlying ``bayesdb_*`` tables.
+    """
+
+    def __init__(self, bdb):
+        self.data_version = _data_version(bdb)
+        self.version = next(_catalog_versions)
+        self.populations = {}           # id -> (name, tabname)
+        self.population_ids = {}        # casefold(name) -> id
+        self.generators = {}            # id -> (name, backend, population_id)
+        self.generator_ids = {}         # casefold(name) -> id
+        self.variables = {}             # (population_id, generator_id)
+                                        #   -> {colno: (name, stattype)}
+        self.variable_colnos = {}       # (population_id, generator_id)
+                                        #   -> {casefold(name): colno}
+        self._colnos = {}
+        cursor = bdb.sql_execute('SELECT id, name, tabname'
+            ' FROM bayesdb_population')
+        for population_id, name, tabname in cursor:
+            self.populations[population_id] = (name, tabname)
+            self.population_ids[casefold(name)] = population_id
+        cursor = bdb.sql_execute('SELECT id, name, backend, population_id'
+            ' FROM bayesdb_generator')
+        for generator_id, name, backend, population_id in cursor:
+            self.generators[generator_id] = (name, backend, population_id)
+            self.generator_ids[casefold(name)] = generator_id
+        cursor = bdb.sql_execute('SELECT population_id, generator_id,'
+            ' colno, name, stattype FROM bayesdb_variable')
+        for population_id, generator_id, colno, name, stattype in cursor:
+            key = (population_id, generator_id)
+            self.variables.setdefault(key, {})[colno] = (name, stattype)
+            self.variable_colnos.setdefault(key, {})[casefold(name)] = colno
+        cursor = bdb.sql_execute('SELECT token FROM bayesdb_rowid_tokens')
+        self.rowid_tokens = [token for (token,) in cursor]
+
+    def population_generators(self, population_id):
+        return sorted(generator_id
+            for generator_id, (_n, _b, generator_population_id)
+            in self.generators.iteritems()
+            if generator_population_id == population_id)
+
+    def variable(self, population_id, generator_id, colno):
+        """Return ``(name, stattype)`` of a variable, or None."""
+        variable = self.variables.get((population_id, None), {}).get(colno)
+        if variable is None and generator_id is not None:
+            latents = self.variables.get((population_id, generator_id), {})
+            variable = latents.get(colno)
+        return variable
+
+    def variable_number(self, population_id, generator_id, name):
+        """Return the colno of a variable by name, or None."""
+        name = casefold(name)
+        colno = self.variable_colnos.get((population_id, None), {}).get(name)
+        if colno is None and generator_id is not None:
+            latents = self.variable_colnos.get(
+                (population_id, generator_id), {})
+            colno = latents.get(name)
+        return colno
+
+    def variable_numbers(self, population_id, generator_id):
+        key = (population_id, generator_id)
+        if key not in self._colnos:
+            colnos = self.variables.get((population_id, None), {}).keys()
+            if generator_id is not None:
+                colnos += self.variables.get(
+                    (population_id, generator_id), {}).keys()
+            self._colnos[key] = sorted(colnos)
+        return list(self._colnos[key])
+
+def bayesdb_catalog(bdb):
+    """Return the in-memory catalog of `bdb`, loading it if necessary.
+
+    The catalog is dropped whenever a row of one of the catalog tables
+    is written through `bdb`, whenever a savepoint or transaction is
+    rolled back, after every schema-changing BQL phrase, and at the
+    start of a BQL phrase if another connection has committed changes
+    to the database in the interim.
+    """
+    if bdb._catalog is None:
+        bdb._catalog = BayesDBCatalog(bdb)
+        def update_hook(_op, _dbname, table, _rowid):
+            if table in _CATALOG_TABLES:
+                bayesdb_invalidate_catalog(bdb)
+        bdb._sqlite3.setupdatehook(update_hook)
+    return bdb._catalog
+
+def bayesdb_catalog_version(bdb):
+    """Return a number identifying the loaded catalog of `bdb`, or None.
+
+    None if the catalog is not loaded.  Otherwise the number changes
+    whenever the catalog is reloaded, so anything derived from the
+    catalog may be reused while the number stays the same.
+    """
+    if bdb._catalog is None:
+        return None
+    return bdb._catalog.version
+
+def bayesdb_invalidate_catalog(bdb):
+    """Drop the in-memory catalog of `bdb` so it is reloaded on next use."""
+    if bdb._catalog is not None:
+        bdb._catalog = None
+        bdb._sqlite3.setupdatehook(None)
+
+def bayesdb_validate_catalog(bdb):
+    """Drop the in-memory catalog if another connection has changed `bdb`."""
+    if bdb._catalog is not None:
+        if _data_version(bdb) != bdb._catalog.data_version:
+            bayesdb_invalidate_catalog(bdb)
+
+def _data_version(bdb):
+    # Bookkeeping, like savepoints, so bypass the SQL tracer.
+    cursor = bdb._sqlite3.cursor().execute('PRAGMA data_version')
+    return cursor_value(cursor)
+
 def bayesdb_has_table(bdb, name):
     """True if there is a table named `name` in `bdb`.
 
@@ -191,8 +323,7 @@ def bayesdb_table_populations(bdb, table):
 
 def bayesdb_has_population(bdb, name):
     """True if there is a population named `name` in `bdb`."""
-    sql = 'SELECT COUNT(*) FROM bayesdb_population WHERE name = ?'
-    return 0 != cursor_value(bdb.sql_execute(sql, (name,)))
+    return casefold(name) in bayesdb_catalog(bdb).population_ids
 
 def bayesdb_get_population(bdb, name):
     """Return the id of the population named `name` in `bdb`.
@@ -203,44 +334,35 @@ def bayesdb_get_population(bdb, name):
     `bdb` must have a population named `name`.  If you're not sure,
     call :func:`bayesdb_has_population` first.
     """
-    sql = 'SELECT id FROM bayesdb_population WHERE name = ?'
-    cursor = bdb.sql_execute(sql, (name,))
     try:
-        row = cursor.next()
-    except StopIteration:
+        population_id = bayesdb_catalog(bdb).population_ids[casefold(name)]
+    except KeyError:
         raise ValueError('No such population: %r' % (repr(name),))
     else:
-        assert isinstance(row[0], int)
-        return row[0]
+        assert isinstance(population_id, int)
+        return population_id
 
 def bayesdb_population_name(bdb, population_id):
     """Return the name of the population with given `population_id`."""
-    sql = 'SELECT name FROM bayesdb_population WHERE id = ?'
-    cursor = bdb.sql_execute(sql, (population_id,))
     try:
-        row = cursor.next()
-    except StopIteration:
+        name, _tabname = bayesdb_catalog(bdb).populations[population_id]
+    except KeyError:
         raise ValueError('No such population id: %r' % (repr(population_id),))
     else:
-        return row[0]
+        return name
 
 def bayesdb_population_table(bdb, population_id):
     """Return the name of table of the population with id `id`."""
-    sql = 'SELECT tabname FROM bayesdb_population WHERE id = ?'
-    cursor = bdb.sql_execute(sql, (population_id,))
     try:
-        row = cursor.next()
-    except StopIteration:
+        _name, tabname = bayesdb_catalog(bdb).populations[population_id]
+    except KeyError:
         raise ValueError('No such population id: %r' % (repr(population_id),))
     else:
-        return row[0]
+        return tabname
 
 def bayesdb_population_generators(bdb, population_id):
     """Return list of generators for population_id."""
-    cursor = bdb.sql_execute('''
-        SELECT id FROM bayesdb_generator WHERE population_id = ?
-    ''', (population_id,))
-    return [generator_id for (generator_id,) in cursor]
+    return bayesdb_catalog(bdb).population_generators(population_id)
 
 def bayesdb_population_is_implicit(bdb, population_id):
     """True if the population with id `id` is implicit."""
@@ -297,23 +419,17 @@ def bayesdb_has_variable(bdb, population_id, generator_id, name):
     generator_id is None for manifest variables and the id of a
     generator for variables that may be latent.
     """
-    cursor = bdb.sql_execute('''
-        SELECT COUNT(*) FROM bayesdb_variable
-            WHERE population_id = ?
-                AND (generator_id IS NULL OR generator_id = ?)
-                AND name = ?
-    ''', (population_id, generator_id, name))
-    return cursor_value(cursor) != 0
+    catalog = bayesdb_catalog(bdb)
+    return catalog.variable_number(population_id, generator_id, name) \
+        is not None
 
 def bayesdb_variable_number(bdb, population_id, generator_id, name):
     """Return the column number of a population variable."""
-    cursor = bdb.sql_execute('''
-        SELECT colno FROM bayesdb_variable
-            WHERE population_id = ?
-                AND (generator_id IS NULL OR generator_id = ?)
-                AND name = ?
-    ''', (population_id, generator_id, name))
-    return cursor_value(cursor)
+    catalog = bayesdb_catalog(bdb)
+    colno = catalog.variable_number(population_id, generator_id, name)
+    if colno is None:
+        raise ValueError('Empty cursor')
+    return colno
 
 def bayesdb_variable_names(bdb, population_id, generator_id):
     """Return a list of the names of columns modeled in `population_id`."""
@@ -323,36 +439,23 @@ def bayesdb_variable_names(bdb, population_id, generator_id):
 
 def bayesdb_variable_numbers(bdb, population_id, generator_id):
     """Return a list of the numbers of columns modeled in `population_id`."""
-    cursor = bdb.sql_execute('''
-        SELECT colno FROM bayesdb_variable
-            WHERE population_id = ?
-                AND (generator_id IS NULL OR generator_id = ?)
-            ORDER BY colno ASC
-    ''', (population_id, generator_id))
-    return [colno for (colno,) in cursor]
+    catalog = bayesdb_catalog(bdb)
+    return catalog.variable_numbers(population_id, generator_id)
 
 def bayesdb_variable_name(bdb, population_id, generator_id, colno):
     """Return the name a population variable."""
-    cursor = bdb.sql_execute('''
-        SELECT name FROM bayesdb_variable
-            WHERE population_id = ?
-                AND (generator_id IS NULL OR generator_id = ?)
-                AND colno = ?
-    ''', (population_id, generator_id, colno))
-    return cursor_value(cursor)
+    variable = bayesdb_catalog(bdb).variable(
+        population_id, generator_id, colno)
+    if variable is None:
+        raise ValueError('Empty cursor')
+    name, _stattype = variable
+    return name
 
 def bayesdb_variable_stattype(bdb, population_id, generator_id, colno):
     """Return the statistical type of a population variable."""
-    sql = '''
-        SELECT stattype FROM bayesdb_variable
-            WHERE population_id = ?
-                AND (generator_id IS NULL OR generator_id = ?)
-                AND colno = ?
-    '''
-    cursor = bdb.sql_execute(sql, (population_id, generator_id, colno))
-    try:
-        row = cursor.next()
-    except StopIteration:
+    variable = bayesdb_catalog(bdb).variable(
+        population_id, generator_id, colno)
+    if variable is None:
         population = bayesdb_population_name(bdb, population_id)
         sql = '''
             SELECT COUNT(*)
@@ -371,9 +474,8 @@ def bayesdb_variable_stattype(bdb, population_id, generator_id, colno):
         else:
             raise ValueError('Variable not modeled in population %s: %d'
                 % (population, colno))
-    else:
-        assert len(row) == 1
-        return row[0]
+    _name, stattype = variable
+    return stattype
 
 def bayesdb_add_latent(bdb, population_id, generator_id, var, stattype):
     """Add a generator's latent variable to a population.
@@ -424,6 +526,31 @@ def bayesdb_population_cell_value(bdb, population_id, rowid, colno):
         value = row[0]
     return value
 
+def bayesdb_population_cell_values(bdb, population_id, rowids, colnos):
+    """Return values stored in `colnos` of each of `rowids`.
+
+    The result is a list with one list of values per rowid, in the
+    order of `colnos`.  Latent variables read as None, as in
+    :func:`bayesdb_population_cell_value`.
+    """
+    manifest = [colno for colno in colnos if 0 <= colno]
+    table_name = bayesdb_population_table(bdb, population_id)
+    qt = sqlite3_quote_name(table_name)
+    qvs = [
+        sqlite3_quote_name(bayesdb_variable_name(bdb, population_id, None, c))
+        for c in manifest
+    ]
+    values_sql = 'SELECT %s FROM %s' % (', '.join(['_rowid_'] + qvs), qt)
+    rows = dict((row[0], row[1:]) for row in bdb.sql_execute(values_sql))
+    def row_values(rowid):
+        if rowid not in rows:
+            population = bayesdb_population_name(bdb, population_id)
+            raise BQLError(bdb, 'No such individual in population %r: %d'
+                % (population, rowid))
+        values = dict(zip(manifest, rows[rowid]))
+        return [values.get(colno) for colno in colnos]
+    return map(row_values, rowids)
+
 def bayesdb_population_fresh_row_id(bdb, population_id):
     """Return one plus maximum rowid in base table of given `population_id`."""
     table_name = bayesdb_population_table(bdb, population_id)
@@ -441,16 +568,7 @@ def bayesdb_has_generator(bdb, population_id, name):
     defined for that population. Otherwise, when `population_id` is None, the
     `name` may be of any generator.
     """
-    if population_id is None:
-        sql = 'SELECT COUNT(*) FROM bayesdb_generator WHERE name = ?'
-        cursor = bdb.sql_execute(sql, (name,))
-    else:
-        sql = '''
-            SELECT COUNT(*) FROM bayesdb_generator
-                WHERE name = ? AND population_id = ?
-        '''
-        cursor = bdb.sql_execute(sql, (name, population_id))
-    return 0 != cursor_value(cursor)
+    return _catalog_generator_id(bdb, population_id, name) is not None
 
 def bayesdb_get_generator(bdb, population_id, name):
     """Return the id of the generator named `name` in `bdb`.
@@ -461,48 +579,45 @@ def bayesdb_get_generator(bdb, population_id, name):
     `bdb` must have a generator named `name`.  If you're not sure,
     call :func:`bayesdb_has_generator` first.
     """
-    if population_id is None:
-        sql = 'SELECT id FROM bayesdb_generator WHERE name = ?'
-        cursor = bdb.sql_execute(sql, (name,))
-    else:
-        sql = '''
-            SELECT id FROM bayesdb_generator
-                WHERE name = ? AND population_id = ?
-        '''
-        cursor = bdb.sql_execute(sql, (name, population_id))
-    try:
-        row = cursor.next()
-    except StopIteration:
+    generator_id = _catalog_generator_id(bdb, population_id, name)
+    if generator_id is None:
         raise ValueError('No such generator: %s' % (repr(name),))
-    else:
-        assert isinstance(row[0], int)
-        return row[0]
+    assert isinstance(generator_id, int)
+    return generator_id
+
+def _catalog_generator_id(bdb, population_id, name):
+    catalog = bayesdb_catalog(bdb)
+    generator_id = catalog.generator_ids.get(casefold(name))
+    if generator_id is None or population_id is None:
+        return generator_id
+    _name, _backend, generator_population_id = \
+        catalog.generators[generator_id]
+    if generator_population_id != population_id:
+        return None
+    return generator_id
 
 def bayesdb_generator_name(bdb, generator_id):
     """Return the name of the generator with given `generator_id`."""
-    sql = 'SELECT name FROM bayesdb_generator WHERE id = ?'
-    cursor = bdb.sql_execute(sql, (generator_id,))
     try:
-        row = cursor.next()
-    except StopIteration:
+        name, _backend, _population_id = \
+            bayesdb_catalog(bdb).generators[generator_id]
+    except KeyError:
         raise ValueError('No such generator id: %r' % (repr(generator_id),))
     else:
-        return row[0]
+        return name
 
 def bayesdb_generator_backend(bdb, generator_id):
     """Return the backend of the generator with given `generator_id`."""
-    sql = 'SELECT backend FROM bayesdb_generator WHERE id = ?'
-    cursor = bdb.sql_execute(sql, (generator_id,))
     try:
-        row = cursor.next()
-    except StopIteration:
+        name, backend, _population_id = \
+            bayesdb_catalog(bdb).generators[generator_id]
+    except KeyError:
         raise ValueError('No such generator: %s' % (repr(generator_id),))
     else:
-        if row[0] not in bdb.backends:
-            name = bayesdb_generator_name(bdb, generator_id)
+        if backend not in bdb.backends:
             raise ValueError('Backend of generator %s not registered: %s' %
-                (repr(name), repr(row[0])))
-        return bdb.backends[row[0]]
+                (repr(name), repr(backend)))
+        return bdb.backends[backend]
 
 def bayesdb_generator_table(bdb, generator_id):
     """Return name of table of the generator with given `generator_id`."""
@@ -511,15 +626,13 @@ def bayesdb_generator_table(bdb, generator_id):
 
 def bayesdb_generator_population(bdb, generator_id):
     """Return id of population of the generator with given `generator_id`."""
-    sql = 'SELECT population_id FROM bayesdb_generator WHERE id = ?'
-    cursor = bdb.sql_execute(sql, (generator_id,))
     try:
-        row = cursor.next()
-    except StopIteration:
+        _name, _backend, population_id = \
+            bayesdb_catalog(bdb).generators[generator_id]
+    except KeyError:
         raise ValueError('No such generator: %s' % (repr(generator_id),))
     else:
-        assert len(row) == 1
-        return row[0]
+        return population_id
 
 def bayesdb_generator_is_implicit(bdb, generator_id):
     """True if the generator with given `generator_id` is implicit."""
@@ -578,10 +691,7 @@ def bayesdb_population_row_values(bdb, population_id, rowid):
 
 def bayesdb_rowid_tokens(bdb):
     """Return list of built-in tokens that identify rowids (e.g. oid)."""
-    tokens = bdb.sql_execute('''
-        SELECT token FROM bayesdb_rowid_tokens
-    ''').fetchall()
-    return [t[0] for t in tokens]
+    return list(bayesdb_catalog(bdb).rowid_tokens)
 
 def bayesdb_has_stattype(bdb, stattype):
     """True if `stattype` is registered in `bdb` instance."""
@@ -32,6 +32,18 @@ from bayeslite.sqlite3_util import sqlite3_quote_name
 from bayeslite.util import casefold
 from bayeslite.util import unique
 
+# Number of rows up to which stattypes are guessed exactly from all
+# values held in memory.
+GUESS_EXACT_ROWS = 100000
+
+# Number of distinct values per column counted exactly when guessing
+# from summaries, beyond which the counts are estimated.
+GUESS_EXACT_COUNT = 10000
+
+# Number of most numerous values per column tracked once the counts
+# are estimated.
+GUESS_TOP_K = 64
+
 def bayesdb_guess_population(bdb, population, table,
         ifnotexists=None, **kwargs):
     """Heuristically guess a population schema for `table`.
@@ -62,9 +74,8 @@ def bayesdb_guess_population(bdb, population, table,
         qt = sqlite3_quote_name(table)
         cursor = bdb.sql_execute('SELECT * FROM %s' % (qt,))
         column_names = [d[0] for d in cursor.description]
-        rows = cursor.fetchall()
         stattypes = [st[0] for st in
-            bayesdb_guess_stattypes(column_names, rows, **kwargs)]
+            bayesdb_guess_stattypes(column_names, cursor, **kwargs)]
         # Convert the `key` column to an `ignore`.
         replace = lambda s: 'ignore' if s == 'key' else s
         column_names, stattypes = unzip([
@@ -89,13 +100,34 @@ def unzip(l):                   # ???
         ys.append(y)
     return xs, ys
 
-def bayesdb_guess_stattypes(column_names, rows, null_values=None,
-        numcat_count=None, numcat_ratio=None, distinct_ratio=None,
-        nullify_ratio=None, overrides=None):
+def bayesdb_guess_stattypes(column_names, rows, **kwargs):
     """Heuristically guess statistical types for the data in `rows`.
 
     Return a list of (statistical type, reason) corresponding to the columns
-    named in the list `column_names`.
+    named in the list `column_names`.  The keyword arguments are as for
+    :func:`bayesdb_guess_stattypes_counts`.
+    """
+    return bayesdb_guess_stattypes_counts(column_names, rows, **kwargs)[0]
+
+def bayesdb_guess_stattypes_counts(column_names, rows, null_values=None,
+        numcat_count=None, numcat_ratio=None, distinct_ratio=None,
+        nullify_ratio=None, overrides=None, exact_rows=None):
+    """Heuristically guess statistical types for the data in `rows`.
+
+    Return a pair of a list of (statistical type, reason) and a list of
+    the numbers of distinct values, corresponding to the columns named
+    in the list `column_names`.
+
+    `rows` may be any iterable, such as a cursor, and is traversed
+    only once.  If it has at most `exact_rows` rows, they are kept in
+    memory and the types are guessed from all the values exactly.
+    Otherwise, the rows are summarized one at a time, in bounded
+    memory per column: exact counts of up to :data:`GUESS_EXACT_COUNT`
+    distinct values, then a HyperLogLog estimate of the number of
+    distinct values and a space-saving sketch of the most numerous
+    ones; whether all values parse as integers or as numbers; and the
+    number of null values.  The same heuristics are then applied to
+    the summaries.
 
     :param set null_values: values to nullify.
     :param int numcat_count: number of distinct values below which
@@ -112,6 +144,9 @@ def bayesdb_guess_stattypes(column_names, rows, null_values=None,
         nullified (set to 1 to turn off).
     :param list overrides: list of ``(name, stattype)``, overriding
         any guessed statistical type for columns by those names
+    :param int exact_rows: number of rows above which to guess from
+        summaries instead of exactly, :data:`GUESS_EXACT_ROWS` by
+        default
 
     In addition to statistical types, the overrides may specify
     ``key`` or ``ignore``.
@@ -130,6 +165,14 @@ def bayesdb_guess_stattypes(column_names, rows, null_values=None,
         nullify_ratio = 0.9
     if overrides is None:
         overrides = []
+    if exact_rows is None:
+        exact_rows = GUESS_EXACT_ROWS
+    kwargs = dict(
+        distinct_ratio=distinct_ratio,
+        nullify_ratio=nullify_ratio,
+        numcat_count=numcat_count,
+        numcat_ratio=numcat_ratio,
+    )
 
     # Build a set of the column names.
     column_name_set = set()
@@ -167,9 +210,12 @@ def bayesdb_guess_stattypes(column_names, rows, null_values=None,
             'Duplicate columns overridden: %s'
             % (repr(list(duplicates)),))
 
-    # Sanity-check the inputs.
+    # Sanity-check the inputs, keeping up to exact_rows rows.
     ncols = len(column_names)
     assert ncols == len(unique(map(casefold, column_names)))
+    rows = iter(rows)
+    kept = []
+    summaries = None
     for ri, row in enumerate(rows):
         if len(row) < ncols:
             raise ValueError(
@@ -179,7 +225,27 @@ def bayesdb_guess_stattypes(column_names, rows, null_values=None,
             raise ValueError(
                 'Row %d: Too many columns: %d > %d'
                 % (ri, len(row), ncols))
+        if summaries is not None:
+            for summary, v in zip(summaries, row):
+                summary.add(v)
+        elif len(kept) < exact_rows:
+            kept.append(row)
+        else:
+            # Too many rows to keep: summarize them instead.
+            summaries = [ColumnSummary(null_values) for _ in column_names]
+            for kept_row in kept:
+                for summary, v in zip(summaries, kept_row):
+                    summary.add(v)
+            del kept[:]
+            for summary, v in zip(summaries, row):
+                summary.add(v)
+    if summaries is None:
+        return _guess_rows(
+            column_names, kept, null_values, override_map, kwargs)
+    else:
+        return _guess_summaries(column_names, summaries, override_map, kwargs)
 
+def _guess_rows(column_names, rows, null_values, override_map, kwargs):
     # Find a key first, if it has been specified as an override.
     key = None
     duplicate_keys = set()
@@ -212,38 +278,59 @@ def bayesdb_guess_stattypes(column_names, rows, null_values=None,
         else:
             column = nullify(null_values, rows, ci)
             [stattype, reason] = guess_column_stattype(
-                column,
-                distinct_ratio=distinct_ratio,
-                nullify_ratio=nullify_ratio,
-                numcat_count=numcat_count,
-                numcat_ratio=numcat_ratio,
-                have_key=(key is not None)
-            )
+                column, have_key=(key is not None), **kwargs)
+            if stattype == 'key':
+                key = column_name
+        stattypes.append([stattype, reason])
+    counts = [len(set(row[ci] for row in rows))
+        for ci in xrange(len(column_names))]
+    return stattypes, counts
+
+def _guess_summaries(column_names, summaries, override_map, kwargs):
+    # As _guess_rows, but from the column summaries.
+    key = None
+    duplicate_keys = set()
+    for column_name, summary in zip(column_names, summaries):
+        if casefold(column_name) in override_map:
+            if override_map[casefold(column_name)] == 'key':
+                if key is not None:
+                    duplicate_keys.add(column_name)
+                    continue
+                if not summary.keyable_p(()):
+                    raise ValueError(
+                        'Column non-unique but specified as key: %s'
+                        % (repr(column_name),))
+                key = column_name
+    if 0 < len(duplicate_keys):
+        raise ValueError(
+            'Multiple columns overridden as keys: %s'
+            % (repr(list(duplicate_keys)),))
+    stattypes = []
+    for column_name, summary in zip(column_names, summaries):
+        if casefold(column_name) in override_map:
+            stattype = override_map[casefold(column_name)]
+            reason = 'User override.'
+        else:
+            [stattype, reason] = guess_summary_stattype(
+                summary, have_key=(key is not None), **kwargs)
             if stattype == 'key':
                 key = column_name
         stattypes.append([stattype, reason])
-    return stattypes
+    counts = [summary.count_distinct_raw() for summary in summaries]
+    return stattypes, counts
 
 def guess_column_stattype(column, reason='', **kwargs):
     counts = count_values(column)
     if None in counts:
         del counts[None]
     if len(counts) < 2:
-        return [
-            'ignore',
-            '%s There is only one unique value.' % (reason,)
-        ]
+        return _only_one_value(reason)
     (most_numerous_key, most_numerous_count) = sorted(
         counts.items(), key=lambda item: item[1], reverse=True)[0]
     if most_numerous_count / float(len(column)) > kwargs['nullify_ratio']:
         column = [None if v == most_numerous_key else v for v in column]
         return guess_column_stattype(
-            column,
-            '%s More than %d percent of the values are the same, so the '
-                'statistical type was guessed based on the remainder of the '
-                'values.' % (reason, int(100 * kwargs['nullify_ratio']),),
-            **kwargs
-        )
+            column, _nullified_reason(reason, kwargs), **kwargs)
     numericable = True
     ints = integerify(column)
     if ints:
@@ -254,14 +341,35 @@ def guess_column_stattype(column, reason='', **kwargs):
             column = floats
         else:
             numericable = False
-    if not kwargs['have_key'] and keyable_p(column):
+    return _guess_stattype(reason,
+        keyable=not kwargs['have_key'] and keyable_p(column),
+        numericable=numericable,
+        numerical=numericable and numerical_p(
+            column, kwargs['numcat_count'], kwargs['numcat_ratio']),
+        ndistinct=len(counts),
+        n=len(column),
+        **kwargs)
+
+def _only_one_value(reason):
+    return [
+        'ignore',
+        '%s There is only one unique value.' % (reason,)
+    ]
+
+def _nullified_reason(reason, kwargs):
+    return '%s More than %d percent of the values are the same, so the ' \
+        'statistical type was guessed based on the remainder of the ' \
+        'values.' % (reason, int(100 * kwargs['nullify_ratio']),)
+
+def _guess_stattype(reason, keyable, numericable, numerical, ndistinct, n,
+        **kwargs):
+    if keyable:
         return [
             'key',
             '%s This was the first column in the table with all distinct '
             'integers or strings.' % (reason,)
         ]
-    elif numericable and \
-        numerical_p(column, kwargs['numcat_count'], kwargs['numcat_ratio']):
+    elif numerical:
         return [
             'numerical',
             '%s There are at least %d unique numerical values, '
@@ -270,8 +378,8 @@ def guess_column_stattype(column, reason='', **kwargs):
                 % (reason, kwargs['numcat_count'],
                     int(100 * kwargs['numcat_ratio']))
         ]
-    elif (len(counts) > kwargs['numcat_count'] and
-        len(counts) / float(len(column)) > kwargs['distinct_ratio']):
+    elif (ndistinct > kwargs['numcat_count'] and
+        ndistinct / float(n) > kwargs['distinct_ratio']):
         return [
             'ignore',
             '%s There are more than %d distinct values and they account '
@@ -297,6 +405,250 @@ def guess_column_stattype(column, reason='', **kwargs):
             ]
 
 
+def guess_summary_stattype(summary, reason='', excluded=(), **kwargs):
+    # As guess_column_stattype, with the values in `excluded' nullified.
+    ndistinct = summary.count_distinct() - len(excluded)
+    if ndistinct < 2:
+        return _only_one_value(reason)
+    (most_numerous_key, most_numerous_count) = \
+        summary.most_numerous(excluded)
+    if most_numerous_count / float(summary.n) > kwargs['nullify_ratio']:
+        return guess_summary_stattype(
+            summary, _nullified_reason(reason, kwargs),
+            excluded + (most_numerous_key,), **kwargs)
+    numericable = summary.numericable_p(excluded)
+    return _guess_stattype(reason,
+        keyable=not kwargs['have_key'] and summary.keyable_p(excluded),
+        numericable=numericable,
+        numerical=numericable and summary.numerical_p(
+            excluded, kwargs['numcat_count'], kwargs['numcat_ratio']),
+        ndistinct=ndistinct,
+        n=summary.n,
+        **kwargs)
+
+class ColumnSummary(object):
+    """One-pass summary of a column for guessing its stattype.
+
+    Holds what :func:`guess_column_stattype` computes from the whole
+    column, in memory bounded independently of the number of values.
+    Methods taking `excluded` answer as if those values, among the
+    most numerous, had been nullified.
+    """
+
+    def __init__(self, null_values):
+        self.null_values = null_values
+        self.n = 0
+        self.nulls = 0
+        self.null_seen = set()
+        self.counts = {}        # exact counts, until too many values
+        self.distinct = None    # then a HyperLogLog
+        self.top = None         # and a space-saving top-k sketch
+        self.numbers = DistinctCounter()
+        self.float_class = False
+        self.int_failures = _Failures()
+        self.float_failures = _Failures()
+        self.nonintegral = _Failures()
+
+    def add(self, v):
+        self.n += 1
+        if v is None or v in self.null_values:
+            self.nulls += 1
+            self.null_seen.add(v)
+            return
+        if isinstance(v, float):
+            self.float_class = True
+        if self.counts is not None:
+            count = self.counts.get(v, 0)
+            self.counts[v] = count + 1
+            if 0 < count:
+                # Already parsed.
+                return
+            if GUESS_EXACT_COUNT < len(self.counts):
+                self.distinct = HyperLogLog()
+                for w in self.counts:
+                    self.distinct.add(w)
+                self.top = SpaceSaving(GUESS_TOP_K)
+                top = sorted(self.counts.iteritems(),
+                    key=lambda item: item[1], reverse=True)
+                for w, count in top[:GUESS_TOP_K]:
+                    self.top.counts[w] = count
+                self.counts = None
+        else:
+            self.distinct.add(v)
+            self.top.add(v)
+        try:
+            int(v)
+        except (ValueError, TypeError):
+            self.int_failures.add(v)
+        try:
+            x = float(v)
+        except (ValueError, TypeError):
+            self.float_failures.add(v)
+        else:
+            if math.isnan(x):
+                self.nonintegral.add(v)
+                return
+            if not x.is_integer():
+                self.nonintegral.add(v)
+            self.numbers.add(x)
+
+    def count_distinct(self):
+        """Return the number of distinct non-null values."""
+        if self.counts is not None:
+            return len(self.counts)
+        return self.distinct.count()
+
+    def count_distinct_raw(self):
+        """Return the number of distinct values, counting nulls."""
+        return self.count_distinct() + len(self.null_seen)
+
+    def most_numerous(self, excluded):
+        """Return the most numerous value not in `excluded`, and its count."""
+        counts = self.counts if self.counts is not None else self.top.counts
+        return max(((v, c) for v, c in counts.iteritems()
+                if v not in excluded),
+            key=lambda item: item[1])
+
+    def numericable_p(self, excluded):
+        """True if all values not in `excluded` parse as numbers."""
+        if self.nulls == 0 and not excluded and not self.float_class and \
+                self.int_failures.empty_p(()):
+            return True
+        return self.float_failures.empty_p(excluded)
+
+    def keyable_p(self, excluded):
+        """True if all values are distinct, non-null integers or strings."""
+        if self.nulls or excluded:
+            return False
+        if self.numericable_p(excluded):
+            return self.nonintegral.empty_p(()) and \
+                self.numbers.all_distinct_p(self.n)
+        if self.counts is not None:
+            return len(self.counts) == self.n
+        return self.distinct.all_distinct_p(self.n)
+
+    def numerical_p(self, excluded, count_cutoff, ratio_cutoff):
+        """As :func:`numerical_p`, for a numericable column."""
+        nu = self.numbers.count()
+        for v in excluded:
+            try:
+                x = float(v)
+            except (ValueError, TypeError):
+                continue
+            if not math.isnan(x):
+                nu -= 1
+        if nu <= count_cutoff:
+            return False
+        if float(nu) / float(self.n) <= ratio_cutoff:
+            return False
+        return True
+
+class _Failures(object):
+    # Up to two distinct values that failed a test, enough to tell
+    # whether they are all among one or two excluded values.
+    def __init__(self):
+        self.values = set()
+        self.many = False
+
+    def add(self, v):
+        if not self.many and v not in self.values:
+            if len(self.values) < 2:
+                self.values.add(v)
+            else:
+                self.many = True
+
+    def empty_p(self, excluded):
+        return not self.many and all(v in excluded for v in self.values)
+
+class DistinctCounter(object):
+    """Count distinct values exactly, or estimate once there are many."""
+
+    def __init__(self):
+        self.values = set()
+        self.sketch = None
+
+    def add(self, v):
+        if self.sketch is not None:
+            self.sketch.add(v)
+        else:
+            self.values.add(v)
+            if GUESS_EXACT_COUNT < len(self.values):
+                self.sketch = HyperLogLog()
+                for w in self.values:
+                    self.sketch.add(w)
+                self.values = None
+
+    def count(self):
+        if self.sketch is not None:
+            return self.sketch.count()
+        return len(self.values)
+
+    def all_distinct_p(self, n):
+        if self.sketch is not None:
+            return self.sketch.all_distinct_p(n)
+        return len(self.values) == n
+
+class HyperLogLog(object):
+    """HyperLogLog estimate of the number of distinct hashable values.
+
+    With 2^`p` registers, the relative standard error is about
+    1.04/sqrt(2^`p`), 0.8% for the default p = 14.
+    """
+
+    _M64 = (1 << 64) - 1
+
+    def __init__(self, p=14):
+        self.p = p
+        self.registers = bytearray(1 << p)
+
+    def add(self, v):
+        # Python's hash is the identity on small integers, so mix it
+        # with the SplitMix64 finalizer before using its bits.
+        x = hash(v) & self._M64
+        x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & self._M64
+        x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & self._M64
+        x ^= x >> 31
+        q = 64 - self.p
+        i = x >> q
+        rank = q - (x & ((1 << q) - 1)).bit_length() + 1
+        if self.registers[i] < rank:
+            self.registers[i] = rank
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213/(1 + 1.079/m)
+        estimate = alpha*m*m/sum(2.0**-r for r in self.registers)
+        if estimate <= 2.5*m:
+            zeros = self.registers.count('\0')
+            if zeros:
+                estimate = m*math.log(float(m)/zeros)
+        return int(round(estimate))
+
+    def all_distinct_p(self, n):
+        # Within three standard errors of n.
+        return n*(1 - 3*1.04/math.sqrt(len(self.registers))) <= self.count()
+
+class SpaceSaving(object):
+    """Space-saving sketch of the `k` most numerous values.
+
+    Each count overestimates the true count by at most the smallest
+    count in the sketch.
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.counts = {}
+
+    def add(self, v):
+        counts = self.counts
+        if v in counts:
+            counts[v] += 1
+        elif len(counts) < self.k:
+            counts[v] = 1
+        else:
+            w = min(counts, key=counts.__getitem__)
+            counts[v] = counts.pop(w) + 1
+
 def nullify(null_values, rows, ci):
     return [row[ci] if row[ci] not in null_values else None for row in rows]
 
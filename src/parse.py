@@ -16,7 +16,9 @@
 
 """BQL parser front end."""
 
-import StringIO
+import copy
+
+from collections import OrderedDict
 
 import bayeslite.ast as ast
 import bayeslite.grammar as grammar
@@ -58,17 +60,41 @@ def parse_bql_phrases(scanner):
     if semantics.failed:
         raise BQLParseError(['parse failed mysteriously!'])
 
+# Number of strings whose parses are kept for reuse.
+PARSE_CACHE_SIZE = 256
+
+# Parsed strings, mapped to lists of ``(phrase, pos)``, most recently
+# used last.  Phrases contain lists, which callers may modify, so each
+# caller gets a copy of its own.
+_parse_cache = OrderedDict()
+
 def parse_bql_string_pos(string):
     """Yield ``(phrase, pos)`` for each BQL phrase in `string`.
 
     `phrase` is the parsed AST.  `pos` is zero-based index of the code
     point at which `phrase` starts.
+
+    Strings parsed in full without error are remembered, and not parsed
+    again while they stay among the :data:`PARSE_CACHE_SIZE` most
+    recently parsed.
     """
-    scanner = scan.BQLScanner(StringIO.StringIO(string), '(string)')
-    phrases = parse_bql_phrases(scanner)
-    # XXX Don't dig out internals of scanner: fix plex to have a
-    # public API for finding the current position.
-    return ((phrase, scanner.cur_pos) for phrase in phrases)
+    if isinstance(string, basestring):
+        phrase_pos = _parse_cache.pop(string, None)
+        if phrase_pos is not None:
+            _parse_cache[string] = phrase_pos
+            return iter(copy.deepcopy(phrase_pos))
+    return _parse_bql_string_pos(string)
+
+def _parse_bql_string_pos(string):
+    scanner = scan.BQLRegexpScanner(string)
+    phrase_pos = []
+    for phrase in parse_bql_phrases(scanner):
+        phrase_pos.append((copy.deepcopy(phrase), scanner.cur_pos))
+        yield (phrase, scanner.cur_pos)
+    if isinstance(string, basestring):
+        _parse_cache[string] = phrase_pos
+        while PARSE_CACHE_SIZE < len(_parse_cache):
+            _parse_cache.popitem(last=False)
 
 def parse_bql_string_pos_1(string):
     """Return ``(phrase, pos)`` for the first BQL phrase in `string`.
@@ -88,7 +114,7 @@ def bql_string_complete_p(string):
 
     False if empty or if the last BQL phrase is incomplete.
     """
-    scanner = scan.BQLScanner(StringIO.StringIO(string), '(string)')
+    scanner = scan.BQLRegexpScanner(string)
     semantics = BQLSemantics()
     parser = grammar.Parser(semantics)
     nonsemi = False
@@ -14,15 +14,35 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import collections
 import csv
+import itertools
+import math
+import multiprocessing
+import os
+import StringIO
+import time
 
 import bayeslite.core as core
 
 from bayeslite.sqlite3_util import sqlite3_quote_name
 from bayeslite.util import casefold
 
+# Number of rows inserted by each executemany call.
+CSV_BATCH_SIZE = 10000
+
+# Number of rows examined to choose column affinities for a new table.
+CSV_SAMPLE_SIZE = 1000
+
+# Approximate size in bytes of each chunk parsed by a worker process.
+CSV_CHUNK_SIZE = 4*1024*1024
+
+# Files at least this many bytes long are parsed in parallel by
+# default.
+CSV_PARALLEL_SIZE = 64*1024*1024
+
 def bayesdb_read_csv_file(bdb, table, pathname, header=False, create=False,
-        ifnotexists=False):
+        ifnotexists=False, progress=None, processes=None):
     """Read CSV data from a file into a table.
 
     :param bayeslite.BayesDB bdb: BayesDB instance
@@ -31,13 +51,23 @@ def bayesdb_read_csv_file(bdb, table, pathname, header=False, create=False,
     :param bool header: if true, first line specifies column names
     :param bool create: if true and `table` does not exist, create it
     :param bool ifnotexists: if true and `table` exists, do it anyway
+    :param progress: if not `None`, called as ``progress(n, seconds)``
+        after each batch of rows, as for :func:`bayesdb_read_csv`
+    :param int processes: number of processes to parse the file with,
+        or `None` to use one per CPU if the file is at least
+        :data:`CSV_PARALLEL_SIZE` bytes long and one otherwise
     """
+    if processes is None:
+        if os.path.getsize(pathname) < CSV_PARALLEL_SIZE:
+            processes = 1
+        else:
+            processes = multiprocessing.cpu_count()
     with open(pathname, 'rU') as f:
         bayesdb_read_csv(bdb, table, f, header=header, create=create,
-            ifnotexists=ifnotexists)
+            ifnotexists=ifnotexists, progress=progress, processes=processes)
 
 def bayesdb_read_csv(bdb, table, f, header=False,
-        create=False, ifnotexists=False):
+        create=False, ifnotexists=False, progress=None, processes=1):
     """Read CSV data from a line iterator into a table.
 
     :param bayeslite.BayesDB bdb: BayesDB instance
@@ -46,6 +76,18 @@ def bayesdb_read_csv(bdb, table, f, header=False,
     :param bool header: if true, first line specifies column names
     :param bool create: if true and `table` does not exist, create it
     :param bool ifnotexists: if true and `table` exists, do it anyway
+    :param progress: if not `None`, called as ``progress(n, seconds)``
+        after each batch of rows with the number of rows read so far
+        and the seconds elapsed, e.g. to report rows per second
+    :param int processes: if more than one, `f` must be a file, which
+        is split into chunks of about :data:`CSV_CHUNK_SIZE` bytes at
+        record boundaries and parsed by that many worker processes
+
+    Rows are inserted in batches with a single prepared statement.
+    If the table is created, each column is given INTEGER, REAL, or
+    TEXT affinity according to the values in the first
+    :data:`CSV_SAMPLE_SIZE` rows, or NUMERIC affinity if they are
+    mixed or empty.
     """
     if not header:
         if create:
@@ -59,12 +101,16 @@ def bayesdb_read_csv(bdb, table, f, header=False,
                 raise ValueError('Table already exists: %s' % (repr(table),))
         elif not create:
             raise ValueError('No such table: %s' % (repr(table),))
-        reader = csv.reader(f)
+        if processes <= 1:
+            reader = csv.reader(f)
         line = 1
         if header:
             row = None
             try:
-                row = reader.next()
+                if processes <= 1:
+                    row = reader.next()
+                else:
+                    row = csv.reader(_csv_records(f, 0)).next()
             except StopIteration:
                 raise IOError('Missing header in CSV file')
             line += 1
@@ -85,37 +131,183 @@ def bayesdb_read_csv(bdb, table, f, header=False,
             if 0 < len(duplicates):
                 raise IOError('Duplicate columns in CSV: %s' %
                     (repr(list(duplicates)),))
-            if create and not core.bayesdb_has_table(bdb, table):
-                qt = sqlite3_quote_name(table)
-                qcns = map(sqlite3_quote_name, column_names)
-                schema = ','.join('%s NUMERIC' % (qcn,) for qcn in qcns)
-                bdb.sql_execute('CREATE TABLE %s(%s)' % (qt, schema))
-                core.bayesdb_table_guarantee_columns(bdb, table)
-            else:
-                core.bayesdb_table_guarantee_columns(bdb, table)
-                unknown = set(name for name in column_names
-                    if not core.bayesdb_table_has_column(bdb, table, name))
-                if len(unknown) != 0:
-                    raise IOError('Unknown columns: %s' % (list(unknown),))
         else:
             assert not create
             assert not ifnotexists
             column_names = core.bayesdb_table_column_names(bdb, table)
         ncols = len(column_names)
-        qt = sqlite3_quote_name(table)
-        qcns = map(sqlite3_quote_name, column_names)
-        # XXX Would be nice if we could prepare this statement before
-        # reading any rows in order to check whether there are missing
-        # nonnull columns with no default value.  However, the only
-        # way to prepare a statement in the Python wrapper is to
-        # execute a cursor, which also binds and steps the statement.
-        sql = 'INSERT INTO %s (%s) VALUES (%s)' % \
-            (qt, ','.join(qcns), ','.join('?' for _qcn in qcns))
-        for row in reader:
-            if len(row) < ncols:
-                raise IOError('Line %d: Too few columns: %d < %d' %
-                    (line, len(row), ncols))
-            if len(row) > ncols:
-                raise IOError('Line %d: Too many columns: %d > %d' %
-                    (line, len(row), ncols))
-            bdb.sql_execute(sql, [unicode(v, 'utf8').strip() for v in row])
+        if processes <= 1:
+            batches = _csv_batches(reader, ncols, line)
+        else:
+            batches = _csv_parallel_batches(f, ncols, line, processes)
+        try:
+            _csv_insert(bdb, table, column_names, create, batches, progress)
+        finally:
+            batches.close()
+
+def _csv_insert(bdb, table, column_names, create, batches, progress):
+    qt = sqlite3_quote_name(table)
+    qcns = map(sqlite3_quote_name, column_names)
+    if create and not core.bayesdb_has_table(bdb, table):
+        first = next(batches, [])
+        batches = itertools.chain([first], batches)
+        affinities = _csv_affinities(first[:CSV_SAMPLE_SIZE], len(qcns))
+        schema = ','.join('%s %s' % (qcn, affinity)
+            for qcn, affinity in zip(qcns, affinities))
+        bdb.sql_execute('CREATE TABLE %s(%s)' % (qt, schema))
+        core.bayesdb_table_guarantee_columns(bdb, table)
+    else:
+        core.bayesdb_table_guarantee_columns(bdb, table)
+        unknown = set(name for name in column_names
+            if not core.bayesdb_table_has_column(bdb, table, name))
+        if len(unknown) != 0:
+            raise IOError('Unknown columns: %s' % (list(unknown),))
+    # XXX Would be nice if we could prepare this statement before
+    # reading any rows in order to check whether there are missing
+    # nonnull columns with no default value.  However, the only
+    # way to prepare a statement in the Python wrapper is to
+    # execute a cursor, which also binds and steps the statement.
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % \
+        (qt, ','.join(qcns), ','.join('?' for _qcn in qcns))
+    start = time.time()
+    nrows = 0
+    for batch in batches:
+        if not batch:
+            continue
+        if bdb.sql_tracer is None:
+            bdb._sqlite3.cursor().executemany(sql, batch)
+        else:
+            # Preserve one trace per inserted row.
+            for bindings in batch:
+                bdb.sql_execute(sql, bindings)
+        nrows += len(batch)
+        if progress is not None:
+            progress(nrows, time.time() - start)
+
+def _csv_batches(reader, ncols, line):
+    while True:
+        batch = []
+        for row in itertools.islice(reader, CSV_BATCH_SIZE):
+            _csv_check_row(row, ncols, line)
+            batch.append([unicode(v, 'utf8').strip() for v in row])
+            line += 1
+        if not batch:
+            break
+        yield batch
+
+def _csv_check_row(row, ncols, line):
+    if len(row) < ncols:
+        raise IOError('Line %d: Too few columns: %d < %d' %
+            (line, len(row), ncols))
+    if len(row) > ncols:
+        raise IOError('Line %d: Too many columns: %d > %d' %
+            (line, len(row), ncols))
+
+def _csv_parallel_batches(f, ncols, line, processes):
+    # Parse chunks in worker processes, but keep only a couple of
+    # chunks per worker in flight so that memory stays bounded however
+    # fast the workers outrun the inserts.  Pool.imap would read the
+    # whole file ahead.
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = collections.deque()
+        def finish():
+            rows, bad = pending.popleft().get()
+            if bad is not None:
+                i, row = bad
+                _csv_check_row(row, ncols, line + i)
+            return rows
+        for chunk in _csv_chunks(f, CSV_CHUNK_SIZE):
+            pending.append(
+                pool.apply_async(_csv_parse_chunk, (chunk, ncols)))
+            if len(pending) >= 2*processes:
+                rows = finish()
+                line += len(rows)
+                yield rows
+        while pending:
+            rows = finish()
+            line += len(rows)
+            yield rows
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _csv_parse_chunk(chunk, ncols):
+    rows = []
+    for row in csv.reader(StringIO.StringIO(chunk)):
+        if len(row) != ncols:
+            return rows, (len(rows), row)
+        rows.append([unicode(v, 'utf8').strip() for v in row])
+    return rows, None
+
+def _csv_chunks(f, size):
+    while True:
+        chunk = list(_csv_records(f, size))
+        if not chunk:
+            break
+        yield ''.join(chunk)
+
+def _csv_records(f, size):
+    # Yield lines of `f' to at least `size' bytes, and then up to the
+    # end of a record.  A newline ends a record unless it is inside
+    # quotes, i.e. unless an odd number of quotes precede it: quotes
+    # are doubled inside quoted fields.  (This does not handle stray
+    # quotes in unquoted fields, which csv.reader takes literally.)
+    # With size 0, yield exactly one record.
+    if 0 < size:
+        data = f.read(size)
+        if not data:
+            return
+        yield data
+        odd = data.count('"') % 2
+    else:
+        odd = 0
+    while True:
+        data = f.readline()
+        if not data:
+            return
+        yield data
+        odd ^= data.count('"') % 2
+        if not odd:
+            return
+
+def _csv_affinities(rows, ncols):
+    # Choose a column affinity from the values in a sample of rows,
+    # conservatively: a column gets INTEGER, REAL, or TEXT affinity
+    # only if every nonempty value in the sample agrees, so that
+    # SQLite stores every sampled value just as NUMERIC would, apart
+    # from integers in a REAL column.  Rows of the wrong length are
+    # reported when they are inserted, not here.
+    kinds = [set() for _ in xrange(ncols)]
+    for row in rows:
+        if len(row) != ncols:
+            continue
+        for i, v in enumerate(row):
+            v = v.strip()
+            if v:
+                kinds[i].add(_csv_value_kind(v))
+    def affinity(k):
+        if k == set(['INTEGER']):
+            return 'INTEGER'
+        elif k == set(['REAL']) or k == set(['INTEGER', 'REAL']):
+            return 'REAL'
+        elif k == set(['TEXT']):
+            return 'TEXT'
+        else:
+            return 'NUMERIC'
+    return [affinity(k) for k in kinds]
+
+def _csv_value_kind(v):
+    try:
+        int(v)
+        return 'INTEGER'
+    except ValueError:
+        pass
+    try:
+        x = float(v)
+    except ValueError:
+        return 'TEXT'
+    # SQLite does not read `nan' or `inf' as numbers.
+    if math.isnan(x) or math.isinf(x):
+        return 'TEXT'
+    return 'REAL'
@@ -16,17 +16,27 @@
 
 """Reading data from pandas dataframes."""
 
+import itertools
+
+import numpy
+import pandas
+
 import bayeslite.core as core
 
 from bayeslite.sqlite3_util import sqlite3_quote_name
 
+# Number of dataframe rows converted and inserted at a time.
+PANDAS_CHUNK_SIZE = 10000
+
 def bayesdb_read_pandas_df(bdb, table, df, create=False, ifnotexists=False,
         index=None):
     """Read data from a pandas dataframe into a table.
 
     :param bayeslite.BayesDB bdb: BayesDB instance
     :param str table: name of table
-    :param pandas.DataFrame df: pandas dataframe
+    :param pandas.DataFrame df: pandas dataframe, or iterable of
+        dataframes with the same columns, such as the reader returned
+        by ``pandas.read_csv(..., chunksize=n)``
     :param bool create: if true and `table` does not exist, create it
     :param bool ifnotexists: if true, and `create` is true` and `table`
         exists, read data into it anyway
@@ -36,25 +46,31 @@ def bayesdb_read_pandas_df(bdb, table, df, create=False, ifnotexists=False,
     convertible to int64, and it is mapped to the table's rowids.  If
     the dataframe's index dtype is not convertible to int64, you must
     specify `index` to give a primary key for the table.
+
+    NaN and other missing values are stored as NULL.
     """
     if not create:
         if ifnotexists:
             raise ValueError('Not creating table whether or not exists!')
+    if isinstance(df, pandas.DataFrame):
+        dfs = iter([df])
+    else:
+        dfs = iter(df)
+        df = next(dfs, None)
+        if df is None:
+            raise ValueError('No dataframes to read!')
+        dfs = itertools.chain([df], dfs)
     column_names = [str(column) for column in df.columns]
     if index is None:
         create_column_names = column_names
         insert_column_names = ['_rowid_'] + column_names
-        try:
-            key_index = df.index.astype('int64')
-        except ValueError:
-            raise ValueError('Must specify index name for non-integral index!')
+        _key_values(df.index)
     else:
         if index in df.columns:
             raise ValueError('Index name collides with column name: %r'
                 % (index,))
         create_column_names = [index] + column_names
         insert_column_names = create_column_names
-        key_index = df.index
     with bdb.savepoint():
         if core.bayesdb_has_table(bdb, table):
             if create and not ifnotexists:
@@ -82,5 +98,42 @@ def bayesdb_read_pandas_df(bdb, table, df, create=False, ifnotexists=False,
         qicns = map(sqlite3_quote_name, insert_column_names)
         sql = 'INSERT INTO %s (%s) VALUES (%s)' % \
             (qt, ','.join(qicns), ','.join('?' for _qicn in qicns))
-        for key, i in zip(key_index, df.index):
-            bdb.sql_execute(sql, (key,) + tuple(df.ix[i]))
+        for df in dfs:
+            if [str(column) for column in df.columns] != column_names:
+                raise ValueError('Dataframe columns changed: %r' %
+                    (list(df.columns),))
+            for start in xrange(0, len(df.index), PANDAS_CHUNK_SIZE):
+                chunk = df.iloc[start:start + PANDAS_CHUNK_SIZE]
+                if index is None:
+                    keys = _key_values(chunk.index)
+                else:
+                    keys = _column_values(chunk.index)
+                columns = [_column_values(chunk.iloc[:, j])
+                    for j in xrange(len(column_names))]
+                rows = zip(keys, *columns)
+                if bdb.sql_tracer is None:
+                    bdb._sqlite3.cursor().executemany(sql, rows)
+                else:
+                    # Preserve one trace per inserted row.
+                    for row in rows:
+                        bdb.sql_execute(sql, row)
+
+def _key_values(index):
+    try:
+        return index.astype('int64').tolist()
+    except (TypeError, ValueError):
+        raise ValueError('Must specify index name for non-integral index!')
+
+def _column_values(column):
+    # Convert a whole column at once to a list of Python values that
+    # SQLite can bind, with None for missing values.  tolist turns
+    # NumPy scalars of numeric dtypes into Python numbers; object
+    # columns may still hold NumPy scalars, which need converting one
+    # by one.
+    values = column.tolist()
+    if column.dtype == numpy.object_:
+        values = [v.item() if isinstance(v, numpy.generic) else v
+            for v in values]
+    for i in numpy.flatnonzero(pandas.isnull(column)):
+        values[i] = None
+    return values
@@ -15,6 +15,7 @@
 #   limitations under the License.
 
 import StringIO
+import re
 
 import bayeslite.grammar as grammar
 import bayeslite.plex as Plex
@@ -320,3 +321,139 @@ class BQLScanner(Plex.Scanner):
         if token is None:       # EOF
             token = 0
         Plex.Scanner.produce(self, token, value)
+
+# Operators and punctuation, each mapped to its token.  Longer operators
+# must be tried before their prefixes; see _operator below.
+operators = {
+    ";": grammar.T_SEMI,
+    "{": grammar.T_LCURLY,
+    "}": grammar.T_RCURLY,
+    "(": grammar.T_LROUND,
+    ")": grammar.T_RROUND,
+    "+": grammar.T_PLUS,
+    "-": grammar.T_MINUS,
+    "*": grammar.T_STAR,
+    "/": grammar.T_SLASH,
+    "%": grammar.T_PERCENT,
+    "=": grammar.T_EQ,
+    "==": grammar.T_EQ,
+    "<": grammar.T_LT,
+    "<>": grammar.T_NEQ,
+    "<=": grammar.T_LEQ,
+    ">": grammar.T_GT,
+    ">=": grammar.T_GEQ,
+    "<<": grammar.T_LSHIFT,
+    ">>": grammar.T_RSHIFT,
+    "!=": grammar.T_NEQ,
+    "|": grammar.T_BITIOR,
+    "||": grammar.T_CONCAT,
+    ",": grammar.T_COMMA,
+    "&": grammar.T_BITAND,
+    "~": grammar.T_BITNOT,
+    ".": grammar.T_DOT,
+}
+
+_name = r'[a-zA-Z_$][a-zA-Z0-9_$]*'
+_operator = '|'.join(re.escape(op)
+    for op in sorted(operators, key=len, reverse=True))
+
+# One alternative for each kind of token, in an order such that the
+# first alternative to match also gives the longest match, as the Plex
+# lexicon of BQLScanner does.  A number immediately followed by a name
+# is a single bad token.  An unterminated string or quoted name runs to
+# the end of input.
+_token_re = re.compile(r'''
+    (?P<ignore>[\f\n\r\t ]+|--[^\n]*)
+  | (?P<number>(?P<hex>0[xX][0-9a-fA-F]+)
+        |(?P<float>(?:[0-9]+\.[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?
+            |[0-9]+[eE][+-]?[0-9]+)
+        |[0-9]+)
+    (?P<bad>%(name)s)?
+  | (?P<numpar>\?[0-9]*)
+  | (?P<nampar>[:@$]%(name)s)
+  | (?P<name>%(name)s)
+  | (?P<operator>%(operator)s)
+  | '(?P<string>(?:[^']|'')*)(?P<string_end>')?
+  | "(?P<qname>(?:[^"]|"")*)(?P<qname_end>")?
+  | (?P<other>.)
+''' % {'name': _name, 'operator': _operator}, re.VERBOSE | re.DOTALL)
+
+class BQLRegexpScanner(object):
+    """BQL scanner for strings, matching one precompiled regexp per token.
+
+    Yields the same tokens as :class:`BQLScanner`, and keeps `cur_pos`,
+    `n_numpar`, and `nampar_map` the same way, but many times faster.
+    """
+
+    def __init__(self, string):
+        if not isinstance(string, basestring):
+            string = str(string)        # e.g., buffer
+        self.string = string
+        self.cur_pos = 0
+        self.n_numpar = 0
+        self.nampar_map = {}
+
+    def read(self):
+        """Return the next token as ``(number, value)``.
+
+        At end of input, return ``(0, '')``, and keep doing so.
+        """
+        string = self.string
+        match = _token_re.match
+        while True:
+            pos = self.cur_pos
+            if len(string) <= pos:
+                return (0, '')
+            m = match(string, pos)
+            self.cur_pos = m.end()
+            kind = m.lastgroup
+            if kind == 'ignore':
+                continue
+            text = m.group()
+            if kind == 'name':
+                return (keywords.get(text) or keywords.get(casefold(text)) or
+                    grammar.L_NAME, text)
+            elif kind == 'operator':
+                return (operators[text], text)
+            elif kind == 'bad' or kind == 'other':
+                return (-1, text)
+            elif kind == 'number':
+                if m.group('float') is not None:
+                    return (grammar.L_FLOAT, float(text))
+                return (grammar.L_INTEGER, int(text, 10))
+            elif kind == 'numpar':
+                return self._numpar(text)
+            elif kind == 'nampar':
+                return self._nampar(casefold(text))
+            elif kind == 'string_end':
+                return (grammar.L_STRING, m.group('string').replace("''", "'"))
+            elif kind == 'qname_end':
+                return (grammar.L_NAME, m.group('qname').replace('""', '"'))
+            else:
+                # Unterminated string or quoted name.
+                assert kind in ('string', 'qname'), kind
+                self.cur_pos = len(string)
+                return (0, '')
+
+    def _numpar(self, text):
+        if text == '?':
+            # Numbered parameters are 1-indexed.
+            self.n_numpar += 1
+            return (grammar.L_NUMPAR, self.n_numpar)
+        if 20 < len(text):              # 2^64 < 10^20
+            return (-1, text)
+        n = int(text[1:])
+        if n == 0:
+            # Numbered parameters are 1-indexed.
+            return (-1, text)
+        self.n_numpar = max(n, self.n_numpar)
+        return (grammar.L_NUMPAR, n)
+
+    def _nampar(self, text):
+        n = self.nampar_map.get(text)
+        if n is None:
+            # Numbered parameters are 1-indexed.
+            self.n_numpar += 1
+            n = self.n_numpar
+            self.nampar_map[text] = n
+        return (grammar.L_NAMPAR, (n, text))
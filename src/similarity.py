@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2017, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Streaming row similarity over whole populations.
+
+``ESTIMATE SIMILARITY ... FROM PAIRWISE`` materializes a value for
+every pair of rows, which is too much for large tables.  The
+functions here stream the similarity matrix block by block instead,
+optionally keeping only the nearest neighbours of each row::
+
+    for rowid, neighbour, similarity in bayesdb_row_similarities(
+            bdb, 'p', 'x', k=10):
+        ...
+"""
+
+import math
+import numpy
+
+import bayeslite.bqlfn as bqlfn
+import bayeslite.compiler as compiler
+import bayeslite.core as core
+
+from bayeslite.exception import BQLError
+
+
+def bayesdb_row_similarities(bdb, population, context, generator=None,
+        modelnos=None, k=None, block_size=256):
+    """Yield the similarity of rows of `population` in context `context`.
+
+    Yields ``(rowid0, rowid1, similarity)`` tuples, with `similarity`
+    None where it is undefined.  If `k` is None, yields every pair of
+    rows, as ``ESTIMATE SIMILARITY IN THE CONTEXT OF <context> FROM
+    PAIRWISE <population>`` would.  Otherwise yields, for each row in
+    turn, the `k` other rows most similar to it, most similar first.
+
+    The matrix is computed `block_size` rows at a time, so memory use
+    grows with the number of rows, not with its square.
+    """
+    if k is not None and k < 0:
+        raise ValueError('Negative number of neighbours: %r' % (k,))
+    with bdb.savepoint():
+        if not core.bayesdb_has_population(bdb, population):
+            raise BQLError(bdb, 'No such population: %s' % (population,))
+        population_id = core.bayesdb_get_population(bdb, population)
+        generator_id = None
+        if generator is not None:
+            if not core.bayesdb_has_generator(bdb, population_id, generator):
+                raise BQLError(bdb, 'No such generator: %r' % (generator,))
+            generator_id = core.bayesdb_get_generator(
+                bdb, population_id, generator)
+        if not core.bayesdb_has_variable(
+                bdb, population_id, generator_id, context):
+            raise BQLError(bdb, 'No such variable in population %r: %r' %
+                (population, context))
+        colno = core.bayesdb_variable_number(
+            bdb, population_id, generator_id, context)
+        rowids = compiler.population_rowids(bdb, population_id)
+    modelnos = None if modelnos is None else str(list(modelnos))
+    blocks = bqlfn.bql_row_similarity_blocks(bdb, population_id,
+        generator_id, modelnos, rowids, colno, block_size=block_size)
+    if k is None:
+        return _pairwise_similarities(rowids, blocks)
+    return _nearest_neighbours(rowids, blocks, k)
+
+def _pairwise_similarities(rowids, blocks):
+    i = 0
+    for block in blocks:
+        for values in block.tolist():
+            rowid0 = rowids[i]
+            i += 1
+            for rowid1, value in zip(rowids, values):
+                yield (rowid0, rowid1, _nan_to_none(value))
+
+def _nearest_neighbours(rowids, blocks, k):
+    # Partition out the k + 1 best candidates of each row, in case the
+    # row itself is among them, and sort only those.
+    m = min(k + 1, len(rowids))
+    i = 0
+    for block in blocks:
+        scores = numpy.where(numpy.isnan(block), -numpy.inf, block)
+        candidates = numpy.argpartition(-scores, m - 1, axis=1)[:, :m]
+        for row, columns in enumerate(candidates):
+            order = numpy.lexsort((columns, -scores[row, columns]))
+            neighbours = [j for j in columns[order] if j != i + row][:k]
+            for j in neighbours:
+                yield (rowids[i + row], rowids[j],
+                    _nan_to_none(float(block[row, j])))
+        i += len(block)
+
+def _nan_to_none(value):
+    return None if math.isnan(value) else value
@@ -94,6 +94,24 @@ def sqlite3_exec_1(db, query, *args):
     assert cursor.fetchone() == None
     return row[0]
 
+def sqlite3_description(db, query, bindings):
+    """Return the description of `query` without executing it.
+
+    The description is a list of (name, declared type) pairs, one for
+    each column of the results, as for the description of a cursor.
+    """
+    description = []
+    def exectrace(cursor, _query, _bindings):
+        description.extend(cursor.getdescription())
+        return False
+    cursor = db.cursor()
+    cursor.setexectrace(exectrace)
+    try:
+        cursor.execute(query, bindings)
+    except apsw.ExecTraceAbort:
+        pass
+    return description
+
 def sqlite3_quote_name(name):
     """Quote `name` as a SQL identifier, e.g. a table or column name.
 
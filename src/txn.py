@@ -16,6 +16,7 @@
 
 import contextlib
 
+from bayeslite.core import bayesdb_invalidate_catalog
 from bayeslite.exception import BayesDBException
 from bayeslite.sqlite3_util import sqlite3_savepoint
 from bayeslite.sqlite3_util import sqlite3_savepoint_rollback
@@ -38,6 +39,10 @@ def bayesdb_savepoint(bdb):
     try:
         with sqlite3_savepoint(bdb._sqlite3):
             yield
+    except:
+        bayesdb_invalidate_catalog(bdb)
+        bayesdb_txn_invalidate(bdb)
+        raise
     finally:
         bayesdb_txn_pop(bdb)
 
@@ -48,6 +53,8 @@ def bayesdb_savepoint_rollback(bdb):
         with sqlite3_savepoint_rollback(bdb._sqlite3):
             yield
     finally:
+        bayesdb_invalidate_catalog(bdb)
+        bayesdb_txn_invalidate(bdb)
         bayesdb_txn_pop(bdb)
 
 @contextlib.contextmanager
@@ -59,6 +66,9 @@ def bayesdb_transaction(bdb):
     try:
         with sqlite3_transaction(bdb._sqlite3):
             yield
+    except:
+        bayesdb_invalidate_catalog(bdb)
+        raise
     finally:
         assert bdb._txn_depth == 1
         bdb._txn_depth = 0
@@ -75,6 +85,7 @@ def bayesdb_rollback_transaction(bdb):
     if bdb._txn_depth == 0:
         raise BayesDBTxnError(bdb, 'Not in a transaction!')
     bdb.sql_execute("ROLLBACK")
+    bayesdb_invalidate_catalog(bdb)
     bdb._txn_depth = 0
     bayesdb_txn_fini(bdb)
 
@@ -110,6 +121,11 @@ def bayesdb_txn_init(bdb):
     assert bdb._cache is None
     bdb._cache = {}
 
+def bayesdb_txn_invalidate(bdb):
+    # Anything remembered in the cache may describe rolled back changes.
+    assert bdb._cache is not None
+    bdb._cache.clear()
+
 def bayesdb_txn_fini(bdb):
     assert bdb._txn_depth == 0
     assert bdb._cache is not None
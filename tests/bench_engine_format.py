@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Compare the JSON and binary formats of CGPM engines.
+
+Usage: ./pythenv.sh python -m bayeslite.tests.bench_engine_format \\
+    [rows [columns [states]]]
+
+Prints the size of each encoding of a synthetic engine and the time
+taken to dump and load it.  Asserts nothing about which is faster.
+"""
+
+import json
+import sys
+import time
+
+from bayeslite.backends.cgpm_engine_format import engine_dumps
+from bayeslite.backends.cgpm_engine_format import engine_loads
+from bayeslite.util import json_dumps
+
+from test_cgpm_engine_format import _metadata
+
+def timed(f, *args):
+    start = time.time()
+    result = f(*args)
+    return result, time.time() - start
+
+def main(argv):
+    sizes = map(int, argv[1:4])
+    n_rows, n_cols, n_states = sizes + [20000, 10, 16][len(sizes):]
+    metadata = _metadata(n_rows, n_cols, n_states)
+    print '%d rows, %d columns, %d states' % (n_rows, n_cols, n_states)
+    for name, dumps, loads in [
+        ('json', json_dumps, json.loads),
+        ('binary', engine_dumps, engine_loads),
+    ]:
+        blob, dump_time = timed(dumps, metadata)
+        _, load_time = timed(loads, blob)
+        print '%-7s %10d bytes, dump %.3fs, load %.3fs' % \
+            (name + ':', len(blob), dump_time, load_time)
+
+if __name__ == '__main__':
+    main(sys.argv)
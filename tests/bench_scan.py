@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Compare the Plex and regexp BQL scanners.
+
+Usage: ./pythenv.sh python -m bayeslite.tests.bench_scan [repeat]
+
+Prints the time each scanner takes to scan the string literals of
+test_parse, and a long IN list, `repeat` times.  Asserts nothing about
+which is faster.
+"""
+
+import sys
+import time
+
+from test_parse import corpus
+from test_parse import scan_plex
+from test_parse import scan_regexp
+
+def main(argv):
+    repeat = int(argv[1]) if 1 < len(argv) else 1
+    strings = corpus()
+    strings.append('select * from t where x in (%s)' %
+        (', '.join(str(i) for i in xrange(10000)),))
+    print '%d strings, %d characters, %d times' % \
+        (len(strings), sum(len(string) for string in strings), repeat)
+    for name, scan in [('plex', scan_plex), ('regexp', scan_regexp)]:
+        start = time.time()
+        for _ in xrange(repeat):
+            for string in strings:
+                scan(string)
+        print '%-7s %.3fs' % (name + ':', time.time() - start)
+
+if __name__ == '__main__':
+    main(sys.argv)
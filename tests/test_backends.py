@@ -221,6 +221,19 @@ def _test_example(bdb, exname):
         # loom does not allow model numbers to be specified in analyze models
         assert exname == 'loom'
 
+    # Test the batched queries against the single queries.
+    rowid = core.bayesdb_population_fresh_row_id(bdb, p_id)
+    queries = [(rowid, [(0, 1.)], []), (rowid, [(0, -1.)], [])]
+    assert metamodel.logpdf_joint_many(bdb, gid, None, queries) == [
+        metamodel.logpdf_joint(bdb, gid, None, r, targets, constraints)
+        for r, targets, constraints in queries
+    ]
+    queries = [(rowid, [0], []), (rowid, [0], [])]
+    samples = metamodel.simulate_joint_many(
+        bdb, gid, None, queries, num_samples=3)
+    assert len(samples) == 2
+    assert all(len(s) == 3 and all(len(x) == 1 for x in s) for s in samples)
+
 def _retest_example(bdb, exname):
     (mm, t, t_sql, data_sql, data, p, g, p_bql, g_bql, g_bqlbad0, g_bqlbad1,
         cleanup) = examples[exname]
@@ -16,11 +16,13 @@
 
 import StringIO
 import apsw
+import numpy
 import pytest
 import struct
 
 import bayeslite
 import bayeslite.ast as ast
+import bayeslite.bql as bql
 import bayeslite.compiler as compiler
 import bayeslite.core as core
 import bayeslite.guess as guess
@@ -1592,300 +1594,96 @@ def test_parametrized():
         assert sqltraced_execute('estimate similarity to (rowid = 1)'
                 ' in the context of (estimate * from columns of p limit 1)'
                 ' from p;') == [
-            'SELECT COUNT(*) FROM bayesdb_population WHERE name = ?',
-            'SELECT id FROM bayesdb_population WHERE name = ?',
-            'SELECT tabname FROM bayesdb_population WHERE id = ?',
-            'SELECT COUNT(*) FROM bayesdb_population WHERE name = ?',
-            'SELECT id FROM bayesdb_population WHERE name = ?',
             'SELECT v.name AS name FROM bayesdb_variable AS v'
                 ' WHERE v.population_id = 1'
                     ' AND v.generator_id IS NULL'
                 ' LIMIT 1',
-            'SELECT colno FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT tabname FROM bayesdb_population'
-                ' WHERE id = ?',
-            'SELECT bql_row_similarity(1, NULL, NULL, _rowid_,'
-                ' (SELECT _rowid_ FROM "t" WHERE ("rowid" = 1)), 0) FROM "t"',
-            'SELECT id FROM bayesdb_generator WHERE population_id = ?',
-            'SELECT backend FROM bayesdb_generator WHERE id = ?',
-            'SELECT cgpm_rowid FROM bayesdb_cgpm_individual'
-                ' WHERE generator_id = ? AND table_rowid = ?',
-            'SELECT cgpm_rowid FROM bayesdb_cgpm_individual '
-                'WHERE generator_id = ? AND table_rowid = ?',
-            'SELECT engine_stamp FROM bayesdb_cgpm_generator '
-                'WHERE generator_id = ?'
-            ]
+            'SELECT _rowid_ FROM "t" WHERE ("rowid" = 1)',
+            'SELECT _rowid_ FROM "t"',
+            'SELECT cgpm_modelno, state_stamp FROM bayesdb_cgpm_state'
+                ' WHERE generator_id = ?',
+            'PRAGMA table_info("bayesdb_temp_1")',
+            'CREATE TEMP TABLE "bayesdb_temp_1"'
+                ' (rowid INTEGER PRIMARY KEY, value)',
+            'INSERT INTO "bayesdb_temp_1" (rowid, value) VALUES'
+                ' (?, ?), (?, ?), (?, ?), (?, ?), (?, ?), (?, ?), (?, ?)',
+            'SELECT (SELECT value FROM "bayesdb_temp_1"'
+                ' WHERE rowid = "t"._rowid_) FROM "t"',
+            'DROP TABLE "bayesdb_temp_1"',
+        ]
 
         assert sqltraced_execute('estimate similarity to (rowid = 1)'
                 ' in the context of (estimate * from columns of p limit ?)'
                 ' from p;',
                 (1,)) == [
-            'SELECT COUNT(*) FROM bayesdb_population'
-                ' WHERE name = ?',
-            'SELECT id FROM bayesdb_population'
-                ' WHERE name = ?',
-            'SELECT tabname FROM bayesdb_population WHERE id = ?',
-            'SELECT COUNT(*) FROM bayesdb_population'
-                ' WHERE name = ?',
-            'SELECT id FROM bayesdb_population'
-                ' WHERE name = ?',
             # ESTIMATE * FROM COLUMNS OF:
             'SELECT v.name AS name'
                 ' FROM bayesdb_variable AS v'
                 ' WHERE v.population_id = 1'
                     ' AND v.generator_id IS NULL'
                 ' LIMIT ?1',
-            'SELECT colno FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT tabname FROM bayesdb_population WHERE id = ?',
-            # ESTIMATE SIMILARITY TO (rowid=1):
-            'SELECT bql_row_similarity(1, NULL, NULL, _rowid_,'
-                ' (SELECT _rowid_ FROM "t" WHERE ("rowid" = 1)), 0) FROM "t"',
-            'SELECT id FROM bayesdb_generator WHERE population_id = ?',
-            'SELECT backend FROM bayesdb_generator WHERE id = ?',
-            'SELECT cgpm_rowid FROM bayesdb_cgpm_individual'
-                ' WHERE generator_id = ? AND table_rowid = ?',
-            'SELECT cgpm_rowid FROM bayesdb_cgpm_individual'
-                ' WHERE generator_id = ? AND table_rowid = ?',
-            'SELECT engine_stamp FROM bayesdb_cgpm_generator'
-                ' WHERE generator_id = ?'
+            # ESTIMATE SIMILARITY TO (rowid=1), batched over all rows:
+            'SELECT _rowid_ FROM "t" WHERE ("rowid" = 1)',
+            'SELECT _rowid_ FROM "t"',
+            'SELECT cgpm_modelno, state_stamp FROM bayesdb_cgpm_state'
+                ' WHERE generator_id = ?',
+            'PRAGMA table_info("bayesdb_temp_2")',
+            'CREATE TEMP TABLE "bayesdb_temp_2"'
+                ' (rowid INTEGER PRIMARY KEY, value)',
+            'INSERT INTO "bayesdb_temp_2" (rowid, value) VALUES'
+                ' (?, ?), (?, ?), (?, ?), (?, ?), (?, ?), (?, ?), (?, ?)',
+            'SELECT (SELECT value FROM "bayesdb_temp_2"'
+                ' WHERE rowid = "t"._rowid_) FROM "t"',
+            'DROP TABLE "bayesdb_temp_2"',
         ]
         assert sqltraced_execute(
                 'create temp table if not exists sim as '
                 'simulate age, RANK, division '
                 'from p given gender = \'F\' limit 4') == [
             'PRAGMA table_info("sim")',
-            'PRAGMA table_info("bayesdb_temp_0")',
-            'SELECT COUNT(*) FROM bayesdb_population WHERE name = ?',
-            'SELECT id FROM bayesdb_population WHERE name = ?',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
+            'PRAGMA table_info("bayesdb_temp_3")',
             'SELECT CAST(4 AS INTEGER), \'F\'',
-            'SELECT token FROM bayesdb_rowid_tokens',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT colno FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT token FROM bayesdb_rowid_tokens',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT colno FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT token FROM bayesdb_rowid_tokens',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT colno FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT token FROM bayesdb_rowid_tokens',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT colno FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT tabname FROM bayesdb_population WHERE id = ?',
             'SELECT MAX(_rowid_) FROM "t"',
-            'SELECT token FROM bayesdb_rowid_tokens',
-            'SELECT token FROM bayesdb_rowid_tokens',
-            'SELECT id FROM bayesdb_generator'
-                ' WHERE population_id = ?',
-            'SELECT backend FROM bayesdb_generator WHERE id = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT tabname FROM bayesdb_population WHERE id = ?',
             'SELECT 1 FROM "t" WHERE oid = ?',
-            'SELECT 1 FROM bayesdb_cgpm_individual'
-                ' WHERE generator_id = ? AND table_rowid = ? LIMIT 1',
-            'SELECT cgpm_rowid FROM bayesdb_cgpm_individual'
-                ' WHERE generator_id = ? AND table_rowid = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ? AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT code FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND value = ?',
             'SELECT engine_stamp FROM bayesdb_cgpm_generator'
                 ' WHERE generator_id = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ? AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ? AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ? AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ? AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'CREATE TEMP TABLE "bayesdb_temp_0"'
+            'SELECT colno, value, code FROM bayesdb_cgpm_category'
+                ' WHERE generator_id = ?',
+            'SELECT engine_json, engine_format, engine_stamp'
+                ' FROM bayesdb_cgpm_generator WHERE generator_id = ?',
+            'SELECT state_blob FROM bayesdb_cgpm_state'
+                ' WHERE generator_id = ?'
+                ' ORDER BY cgpm_modelno ASC',
+            'CREATE TEMP TABLE "bayesdb_temp_3"'
                 ' ("age","RANK","division")',
-            'INSERT INTO "bayesdb_temp_0" ("age","RANK","division")'
+            'INSERT INTO "bayesdb_temp_3" ("age","RANK","division")'
                 ' VALUES (?,?,?)',
-            'INSERT INTO "bayesdb_temp_0" ("age","RANK","division")'
+            'INSERT INTO "bayesdb_temp_3" ("age","RANK","division")'
                 ' VALUES (?,?,?)',
-            'INSERT INTO "bayesdb_temp_0" ("age","RANK","division")'
+            'INSERT INTO "bayesdb_temp_3" ("age","RANK","division")'
                 ' VALUES (?,?,?)',
-            'INSERT INTO "bayesdb_temp_0" ("age","RANK","division")'
+            'INSERT INTO "bayesdb_temp_3" ("age","RANK","division")'
                 ' VALUES (?,?,?)',
             'CREATE TEMP TABLE IF NOT EXISTS "sim" AS'
-                ' SELECT * FROM "bayesdb_temp_0"',
-            'DROP TABLE "bayesdb_temp_0"'
+                ' SELECT * FROM "bayesdb_temp_3"',
+            'DROP TABLE "bayesdb_temp_3"'
         ]
         assert sqltraced_execute(
                 'select * from (simulate age from p '
                 'given gender = \'F\' limit 4)') == [
-            'PRAGMA table_info("bayesdb_temp_1")',
-            'SELECT COUNT(*) FROM bayesdb_population WHERE name = ?',
-            'SELECT id FROM bayesdb_population WHERE name = ?',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
+            'PRAGMA table_info("bayesdb_temp_4")',
             'SELECT CAST(4 AS INTEGER), \'F\'',
-            'SELECT token FROM bayesdb_rowid_tokens',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT colno FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT token FROM bayesdb_rowid_tokens',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT colno FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT tabname FROM bayesdb_population WHERE id = ?',
             'SELECT MAX(_rowid_) FROM "t"',
-            'SELECT token FROM bayesdb_rowid_tokens',
-            'SELECT token FROM bayesdb_rowid_tokens',
-            'SELECT id FROM bayesdb_generator WHERE population_id = ?',
-            'SELECT backend FROM bayesdb_generator WHERE id = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT tabname FROM bayesdb_population WHERE id = ?',
             'SELECT 1 FROM "t" WHERE oid = ?',
-            'SELECT 1 FROM bayesdb_cgpm_individual'
-                ' WHERE generator_id = ? AND table_rowid = ? LIMIT 1',
-            'SELECT cgpm_rowid FROM bayesdb_cgpm_individual'
-                ' WHERE generator_id = ? AND table_rowid = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT code FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND value = ?',
             'SELECT engine_stamp FROM bayesdb_cgpm_generator'
                 ' WHERE generator_id = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'CREATE TEMP TABLE "bayesdb_temp_1" ("age")',
-            'INSERT INTO "bayesdb_temp_1" ("age") VALUES (?)',
-            'INSERT INTO "bayesdb_temp_1" ("age") VALUES (?)',
-            'INSERT INTO "bayesdb_temp_1" ("age") VALUES (?)',
-            'INSERT INTO "bayesdb_temp_1" ("age") VALUES (?)',
-            'SELECT * FROM (SELECT * FROM "bayesdb_temp_1")',
-            'DROP TABLE "bayesdb_temp_1"',
+            'CREATE TEMP TABLE "bayesdb_temp_4" ("age")',
+            'INSERT INTO "bayesdb_temp_4" ("age") VALUES (?)',
+            'INSERT INTO "bayesdb_temp_4" ("age") VALUES (?)',
+            'INSERT INTO "bayesdb_temp_4" ("age") VALUES (?)',
+            'INSERT INTO "bayesdb_temp_4" ("age") VALUES (?)',
+            'SELECT * FROM (SELECT * FROM "bayesdb_temp_4")',
+            'DROP TABLE "bayesdb_temp_4"',
         ]
         bdb.execute('''
             create population q for t (
@@ -1900,17 +1698,23 @@ def test_parametrized():
         bdb.execute('create generator q_cc for q;')
         bdb.execute('initialize 1 model for q_cc;')
         assert sqltraced_execute('analyze q_cc for 1 iteration;') == [
-            'SELECT COUNT(*) FROM bayesdb_generator WHERE name = ?',
-            'SELECT id FROM bayesdb_generator WHERE name = ?',
-            'SELECT backend FROM bayesdb_generator WHERE id = ?',
-            'SELECT engine_json, engine_stamp FROM bayesdb_cgpm_generator'
-                ' WHERE generator_id = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT engine_stamp FROM bayesdb_cgpm_generator'
+            'SELECT engine_json, engine_format, engine_stamp'
+                ' FROM bayesdb_cgpm_generator WHERE generator_id = ?',
+            'SELECT state_blob FROM bayesdb_cgpm_state'
+                ' WHERE generator_id = ?'
+                ' ORDER BY cgpm_modelno ASC',
+            'SELECT engine_format, engine_stamp FROM bayesdb_cgpm_generator'
                 ' WHERE generator_id = ?',
             'UPDATE bayesdb_cgpm_generator'
-                ' SET engine_json = :engine_json, engine_stamp = :engine_stamp'
-                ' WHERE generator_id = :generator_id']
+                ' SET engine_json = :engine_json,'
+                ' engine_format = :engine_format,'
+                ' engine_stamp = :engine_stamp'
+                ' WHERE generator_id = :generator_id',
+            'DELETE FROM bayesdb_cgpm_state WHERE generator_id = ?',
+            'INSERT INTO bayesdb_cgpm_state'
+                ' (generator_id, cgpm_modelno, state_blob, state_stamp,'
+                ' partition_blob)'
+                ' VALUES (?, ?, ?, ?, ?)']
 
 def test_create_table_ifnotexists_as_simulate():
     with test_csv.bayesdb_csv_file(test_csv.csv_data) as (bdb, fname):
@@ -2652,6 +2456,112 @@ def test_tracing_execution_error_smoke():
         assert tracer.finished_calls == 0
         assert tracer.abandoned_calls == 0
 
+def test_plan_cache():
+    with test_core.t1() as (bdb, _population_id, _generator_id):
+        def stats():
+            s = bdb.plan_cache_stats()
+            return (s['hits'], s['misses'])
+        hits, misses = stats()
+        q = 'SELECT age + ? FROM t1 WHERE label = ? ORDER BY id'
+        ages = [row[0] for row in
+            bdb.execute('SELECT age FROM t1 WHERE label = ? ORDER BY id',
+                ('frotz',))]
+        assert stats() == (hits, misses + 1)
+        assert [r[0] for r in bdb.execute(q, (1, 'frotz'))] == \
+            [age + 1 for age in ages]
+        assert stats() == (hits, misses + 2)
+        # The compiled query is reused with the new bindings.
+        assert [r[0] for r in bdb.execute(q, (2, 'frotz'))] == \
+            [age + 2 for age in ages]
+        assert stats() == (hits + 1, misses + 2)
+        with pytest.raises(ValueError):
+            bdb.execute(q, (1,))
+        assert stats() == (hits + 2, misses + 2)
+        # Named parameters too.
+        assert bdb.execute('SELECT :x', {':x': 1}).fetchvalue() == 1
+        assert bdb.execute('SELECT :x', {':x': 2}).fetchvalue() == 2
+        assert stats() == (hits + 3, misses + 3)
+        # Changing the catalog compiles the query afresh.
+        q = 'ESTIMATE age FROM p1 WHERE id = 1'
+        bdb.execute(q).fetchall()
+        bdb.execute(q).fetchall()
+        assert stats() == (hits + 4, misses + 4)
+        bdb.execute('ALTER POPULATION p1 RENAME TO p2')
+        bdb.execute('ALTER POPULATION p2 RENAME TO p1')
+        bdb.execute(q).fetchall()
+        assert stats() == (hits + 4, misses + 5)
+        bdb.execute(q).fetchall()
+        assert stats() == (hits + 5, misses + 5)
+
+def test_prepare():
+    with test_core.t1() as (bdb, _population_id, _generator_id):
+        with pytest.raises(ValueError):
+            bdb.prepare('')
+        with pytest.raises(ValueError):
+            bdb.prepare('SELECT 1; SELECT 2')
+        stmt = bdb.prepare('SELECT age + ? FROM t1 WHERE label = ?')
+        assert stmt.execute((1, 'frotz')).fetchall() == [(9,)]
+        sql = []
+        def trace(string, _bindings):
+            sql.append(' '.join(string.split()))
+        bdb.sql_trace(trace)
+        # Only the compiled query runs.
+        assert stmt.execute((2, 'foo')).fetchall() == [(14,)]
+        assert sql == ['SELECT ("age" + ?1) FROM "t1" WHERE ("label" = ?2)']
+        bdb.sql_untrace(trace)
+        with pytest.raises(ValueError):
+            stmt.execute((1,))
+        # Changing the catalog compiles the query afresh.
+        stmt = bdb.prepare('ESTIMATE age FROM p1 WHERE label = :label')
+        assert stmt.execute({':label': 'foo'}).fetchall() == [(12,)]
+        bdb.execute('ALTER POPULATION p1 RENAME TO p2')
+        with pytest.raises(BQLError):
+            stmt.execute({':label': 'foo'})
+        bdb.execute('ALTER POPULATION p2 RENAME TO p1')
+        assert stmt.execute({':label': 'bar'}).fetchall() == [(14,)]
+        # Commands run each time.
+        stmt = bdb.prepare('CREATE TEMP TABLE IF NOT EXISTS u AS'
+            ' SELECT age FROM t1 WHERE label = ?')
+        stmt.execute(('foo',))
+        stmt.execute(('bar',))
+        assert bdb.execute('SELECT age FROM u').fetchall() == [(12,)]
+
+def test_fetch_columns():
+    with test_core.t1() as (bdb, _population_id, _generator_id):
+        q = 'SELECT id, label, age, weight, NULL AS x FROM t1 ORDER BY id'
+        rows = bdb.execute(q).fetchall()
+        fetch_chunk_size = bql.FETCH_CHUNK_SIZE
+        bql.FETCH_CHUNK_SIZE = 3
+        try:
+            columns = bdb.execute(q).fetch_columns()
+        finally:
+            bql.FETCH_CHUNK_SIZE = fetch_chunk_size
+        assert [c.dtype for c in columns] == [
+            numpy.int64, numpy.object_, numpy.float64, numpy.float64,
+            numpy.float64,
+        ]
+        assert [tuple(row) for row in zip(*[c.tolist() for c in columns])] \
+            == rows
+        assert columns[4].mask.all()
+        array = bdb.execute('SELECT age, weight, NULL FROM t1 ORDER BY id')\
+            .fetch_numpy()
+        assert array.dtype == numpy.float64
+        assert array.shape == (len(rows), 3)
+        for j, k in enumerate([2, 3]):
+            nulls = [row[k] is None for row in rows]
+            assert numpy.isnan(array[:, j]).tolist() == nulls
+            assert array[~numpy.isnan(array[:, j]), j].tolist() == \
+                [row[k] for row in rows if row[k] is not None]
+        assert numpy.isnan(array[:, 2]).all()
+        with pytest.raises(ValueError):
+            bdb.execute('SELECT label FROM t1').fetch_numpy()
+        df = bdb.execute_df(q)
+        assert list(df.columns) == ['id', 'label', 'age', 'weight', 'x']
+        assert df['id'].tolist() == [row[0] for row in rows]
+        assert df['label'].tolist() == [row[1] for row in rows]
+        assert df['age'].isnull().tolist() == [row[2] is None for row in rows]
+        assert numpy.isnan(df['x']).all()
+
 def test_pdf_var():
     with test_core.t1() as (bdb, population_id, _generator_id):
         bdb.execute('initialize 6 models for p1_cc;')
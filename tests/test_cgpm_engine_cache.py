@@ -17,7 +17,15 @@
 from StringIO import StringIO
 
 import bayeslite
+import pytest
 import tempfile
+import time
+
+from bayeslite.backends.cgpm_backend import CGPM_Backend
+from bayeslite.backends.cgpm_engine_format import ENGINE_FORMAT_JSON
+from bayeslite.backends.cgpm_engine_format import ENGINE_FORMAT_STATES
+from bayeslite.exception import BQLError
+from bayeslite.util import json_dumps
 
 import test_csv
 
@@ -107,3 +115,359 @@ def test_engine_stamp_two_clients():
 
             # Engine in cache of bdb0 should be stale, since bdb2 analyzed.
             assert cgpm_backend._engine_latest(bdb0, generator_id) is None
+
+
+def test_engine_legacy_json():
+    """Confirm engines stored as JSON are read, and rewritten by state."""
+    with bayeslite.bayesdb_open(':memory:') as bdb:
+        bayeslite.bayesdb_read_csv(bdb, 't', StringIO(test_csv.csv_data),
+            header=True, create=True)
+        bdb.execute('''
+            CREATE POPULATION p FOR t (
+                age NUMERICAL;
+                gender NOMINAL;
+                salary NUMERICAL;
+                height IGNORE;
+                division NOMINAL;
+                rank NOMINAL;
+            )
+        ''')
+        bdb.execute('CREATE GENERATOR m FOR p;')
+        bdb.execute('INITIALIZE 2 MODELS FOR m;')
+        cgpm_backend = bdb.backends['cgpm']
+        population_id = bayeslite.core.bayesdb_get_population(bdb, 'p')
+        generator_id = bayeslite.core.bayesdb_get_generator(
+            bdb, population_id, 'm')
+        def engine_format():
+            return bdb.sql_execute('''
+                SELECT engine_format FROM bayesdb_cgpm_generator
+                    WHERE generator_id = ?
+            ''', (generator_id,)).fetchvalue()
+        assert engine_format() == ENGINE_FORMAT_STATES
+        # Store the engine as a version 3 database would have.
+        metadata = cgpm_backend._engine(bdb, generator_id).to_metadata()
+        bdb.sql_execute('''
+            UPDATE bayesdb_cgpm_generator
+                SET engine_json = ?, engine_format = ?
+                WHERE generator_id = ?
+        ''', (json_dumps(metadata), ENGINE_FORMAT_JSON, generator_id))
+        bdb.sql_execute('''
+            DELETE FROM bayesdb_cgpm_state WHERE generator_id = ?
+        ''', (generator_id,))
+        cgpm_backend._del_cache_entry(bdb, generator_id, None)
+        bdb.execute('SIMULATE age FROM p LIMIT 1;').fetchall()
+        bdb.execute('ANALYZE m MODELS 1 FOR 1 ITERATION')
+        assert engine_format() == ENGINE_FORMAT_STATES
+        cgpm_backend._del_cache_entry(bdb, generator_id, None)
+        bdb.execute('SIMULATE age FROM p LIMIT 1;').fetchall()
+
+
+def test_engine_states():
+    """Confirm ANALYZE of some models writes, and queries read, only those."""
+    with bayeslite.bayesdb_open(':memory:') as bdb:
+        bayeslite.bayesdb_read_csv(bdb, 't', StringIO(test_csv.csv_data),
+            header=True, create=True)
+        bdb.execute('''
+            CREATE POPULATION p FOR t (
+                age NUMERICAL;
+                gender NOMINAL;
+                salary NUMERICAL;
+                height IGNORE;
+                division NOMINAL;
+                rank NOMINAL;
+            )
+        ''')
+        bdb.execute('CREATE GENERATOR m FOR p;')
+        bdb.execute('INITIALIZE 3 MODELS FOR m;')
+        cgpm_backend = bdb.backends['cgpm']
+        population_id = bayeslite.core.bayesdb_get_population(bdb, 'p')
+        generator_id = bayeslite.core.bayesdb_get_generator(
+            bdb, population_id, 'm')
+        def states():
+            return bdb.sql_execute('''
+                SELECT cgpm_modelno, state_blob, state_stamp
+                    FROM bayesdb_cgpm_state WHERE generator_id = ?
+                    ORDER BY cgpm_modelno
+            ''', (generator_id,)).fetchall()
+        before = states()
+        assert [(m, stamp) for m, _blob, stamp in before] == \
+            [(0, 1), (1, 1), (2, 1)]
+        # Analyzing model 1 rewrites only its state.
+        bdb.execute('ANALYZE m MODELS 1 FOR 1 ITERATION')
+        after = states()
+        assert cgpm_backend._engine_stamp(bdb, generator_id) == 2
+        assert [(m, stamp) for m, _blob, stamp in after] == \
+            [(0, 1), (1, 2), (2, 1)]
+        assert after[0][1] == before[0][1]
+        assert after[2][1] == before[2][1]
+        # Queries of some models load only their states.
+        cgpm_backend._del_cache_entry(bdb, generator_id, None)
+        bdb.execute('''
+            ESTIMATE PROBABILITY DENSITY OF age = 30 BY p
+                MODELED BY m USING MODELS 0, 2
+        ''').fetchall()
+        assert cgpm_backend._get_cache_entry(bdb, generator_id, 'engine') \
+            is None
+        key, stamps, engine = \
+            cgpm_backend._get_cache_entry(bdb, generator_id, 'states')
+        assert sorted(key) == [0, 2]
+        assert stamps == {0: 1, 2: 1}
+        assert engine.num_states() == 2
+        # Analyzing those states in place keeps them cached.
+        bdb.execute('ANALYZE m MODELS 0 FOR 1 ITERATION')
+        key0, _stamps, engine0 = \
+            cgpm_backend._get_cache_entry(bdb, generator_id, 'states')
+        assert key0 == (0,)
+        bdb.execute('''
+            ESTIMATE PROBABILITY DENSITY OF age = 30 BY p
+                MODELED BY m USING MODELS 0
+        ''').fetchall()
+        assert cgpm_backend._get_cache_entry(
+            bdb, generator_id, 'states')[2] is engine0
+        # The whole engine sees every state as last written.
+        bdb.execute('ESTIMATE PROBABILITY DENSITY OF age = 30 BY p')\
+            .fetchall()
+        assert cgpm_backend._engine(bdb, generator_id).num_states() == 3
+
+
+def test_analysis_checkpoints():
+    """Confirm ANALYZE writes each state at every checkpoint."""
+    for multiprocess in [False, 2]:
+        with bayeslite.bayesdb_open(':memory:', builtin_backends=False) \
+                as bdb:
+            cgpm_backend = CGPM_Backend(dict(), multiprocess=multiprocess)
+            bayeslite.bayesdb_register_backend(bdb, cgpm_backend)
+            bayeslite.bayesdb_read_csv(bdb, 't',
+                StringIO(test_csv.csv_data), header=True, create=True)
+            bdb.execute('''
+                CREATE POPULATION p FOR t (
+                    age NUMERICAL;
+                    gender NOMINAL;
+                    salary NUMERICAL;
+                    height IGNORE;
+                    division NOMINAL;
+                    rank NOMINAL;
+                )
+            ''')
+            bdb.execute('CREATE GENERATOR m FOR p;')
+            bdb.execute('INITIALIZE 3 MODELS FOR m;')
+            population_id = bayeslite.core.bayesdb_get_population(bdb, 'p')
+            generator_id = bayeslite.core.bayesdb_get_generator(
+                bdb, population_id, 'm')
+            assert cgpm_backend.analysis_stats(bdb, generator_id) is None
+            bdb.execute('''
+                ANALYZE m MODELS 0, 2 FOR 3 ITERATIONS
+                    CHECKPOINT 1 ITERATION (QUIET)
+            ''')
+            # Each of the two states was written after each iteration.
+            assert cgpm_backend._engine_stamp(bdb, generator_id) == 7
+            stamps = bdb.sql_execute('''
+                SELECT state_stamp FROM bayesdb_cgpm_state
+                    WHERE generator_id = ? ORDER BY cgpm_modelno
+            ''', (generator_id,)).fetchall()
+            assert stamps[1] == (1,)
+            assert max(stamps[0][0], stamps[2][0]) == 7
+            stats = cgpm_backend.analysis_stats(bdb, generator_id)
+            assert sorted(stats) == [0, 2]
+            for stat in stats.itervalues():
+                assert stat['iterations'] == 3
+                assert stat['checkpoints'] == 3
+                assert stat['iterations_per_second'] > 0
+            # Without CHECKPOINT, the states are written together at the end.
+            bdb.execute('ANALYZE m FOR 2 ITERATIONS (QUIET)')
+            assert cgpm_backend._engine_stamp(bdb, generator_id) == 8
+            stats = cgpm_backend.analysis_stats(bdb, generator_id)
+            assert sorted(stats) == [0, 1, 2]
+            for stat in stats.itervalues():
+                assert stat['iterations'] == 2
+                assert stat['checkpoints'] == 0
+
+
+def test_analysis_checkpoint_seconds__ci_slow():
+    """Confirm timed ANALYZE writes each state every CHECKPOINT seconds."""
+    with bayeslite.bayesdb_open(':memory:', builtin_backends=False) as bdb:
+        cgpm_backend = CGPM_Backend(dict(), multiprocess=False)
+        bayeslite.bayesdb_register_backend(bdb, cgpm_backend)
+        bayeslite.bayesdb_read_csv(bdb, 't', StringIO(test_csv.csv_data),
+            header=True, create=True)
+        bdb.execute('''
+            CREATE POPULATION p FOR t (
+                age NUMERICAL;
+                gender NOMINAL;
+                salary NUMERICAL;
+                height IGNORE;
+                division NOMINAL;
+                rank NOMINAL;
+            )
+        ''')
+        bdb.execute('CREATE GENERATOR m FOR p;')
+        bdb.execute('INITIALIZE 2 MODELS FOR m;')
+        population_id = bayeslite.core.bayesdb_get_population(bdb, 'p')
+        generator_id = bayeslite.core.bayesdb_get_generator(
+            bdb, population_id, 'm')
+        start = time.time()
+        bdb.execute('''
+            ANALYZE m MODEL 1 FOR 10000 ITERATIONS OR 3 SECONDS
+                CHECKPOINT 1 SECOND (QUIET)
+        ''')
+        assert 3 <= time.time() - start < 10
+        stats = cgpm_backend.analysis_stats(bdb, generator_id)
+        assert 2 <= stats[1]['checkpoints'] <= 3
+        assert 0 < stats[1]['iterations'] < 10000
+        assert cgpm_backend._engine_stamp(bdb, generator_id) == \
+            1 + stats[1]['checkpoints']
+        # Lovecat cannot checkpoint by seconds.
+        with pytest.raises(BQLError):
+            bdb.execute('''
+                ANALYZE m FOR 1 SECOND CHECKPOINT 1 SECOND (OPTIMIZED)
+            ''')
+
+
+def test_engine_partitions():
+    """Confirm stored partitions answer as the engine would, without it."""
+    with bayeslite.bayesdb_open(':memory:') as bdb:
+        bayeslite.bayesdb_read_csv(bdb, 't', StringIO(test_csv.csv_data),
+            header=True, create=True)
+        bdb.execute('''
+            CREATE POPULATION p FOR t (
+                age NUMERICAL;
+                gender NOMINAL;
+                salary NUMERICAL;
+                height IGNORE;
+                division NOMINAL;
+                rank NOMINAL;
+            )
+        ''')
+        bdb.execute('CREATE GENERATOR m FOR p;')
+        bdb.execute('INITIALIZE 3 MODELS FOR m;')
+        bdb.execute('ANALYZE m FOR 2 ITERATIONS')
+        cgpm_backend = bdb.backends['cgpm']
+        population_id = bayeslite.core.bayesdb_get_population(bdb, 'p')
+        generator_id = bayeslite.core.bayesdb_get_generator(
+            bdb, population_id, 'm')
+        queries = [
+            'ESTIMATE DEPENDENCE PROBABILITY FROM PAIRWISE VARIABLES OF p',
+            '''ESTIMATE DEPENDENCE PROBABILITY FROM PAIRWISE VARIABLES OF p
+                USING MODELS 0, 2''',
+            '''ESTIMATE SIMILARITY TO (rowid = 1) IN THE CONTEXT OF age
+                FROM p''',
+            '''ESTIMATE SIMILARITY IN THE CONTEXT OF salary
+                FROM PAIRWISE p USING MODELS 1''',
+        ]
+        cgpm_backend._del_cache_entry(bdb, generator_id, None)
+        from_partitions = [bdb.execute(q).fetchall() for q in queries]
+        assert cgpm_backend._get_cache_entry(bdb, generator_id, 'engine') \
+            is None
+        assert cgpm_backend._get_cache_entry(bdb, generator_id, 'states') \
+            is None
+        cgpm_backend._engine(bdb, generator_id)
+        from_engine = [bdb.execute(q).fetchall() for q in queries]
+        assert len(from_partitions) == len(from_engine)
+        for rows_p, rows_e in zip(from_partitions, from_engine):
+            assert len(rows_p) == len(rows_e)
+            for row_p, row_e in zip(rows_p, rows_e):
+                assert row_p[:-1] == row_e[:-1]
+                assert abs(row_p[-1] - row_e[-1]) < 1e-12
+
+
+def test_engine_cache_budget():
+    """Confirm the engine cache evicts to stay within its budget."""
+    with bayeslite.bayesdb_open(':memory:') as bdb:
+        bayeslite.bayesdb_read_csv(bdb, 't', StringIO(test_csv.csv_data),
+            header=True, create=True)
+        bdb.execute('''
+            CREATE POPULATION p FOR t (
+                age NUMERICAL;
+                gender NOMINAL;
+                salary NUMERICAL;
+                height IGNORE;
+                division NOMINAL;
+                rank NOMINAL;
+            )
+        ''')
+        bdb.execute('CREATE GENERATOR m0 FOR p;')
+        bdb.execute('CREATE GENERATOR m1 FOR p;')
+        bdb.execute('INITIALIZE 2 MODELS FOR m0;')
+        bdb.execute('INITIALIZE 2 MODELS FOR m1;')
+        cgpm_backend = bdb.backends['cgpm']
+        population_id = bayeslite.core.bayesdb_get_population(bdb, 'p')
+        generator_ids = [
+            bayeslite.core.bayesdb_get_generator(bdb, population_id, name)
+            for name in ['m0', 'm1']
+        ]
+        old_budget = cgpm_backend.set_cache_budget(1)
+        try:
+            stats = bdb.cache_stats()['cgpm']
+            assert stats['budget'] == 1
+            # Loading one engine evicts the other.
+            cgpm_backend._engine(bdb, generator_ids[0])
+            cgpm_backend._engine(bdb, generator_ids[1])
+            assert cgpm_backend._get_cache_entry(
+                bdb, generator_ids[0], 'engine') is None
+            assert cgpm_backend._get_cache_entry(
+                bdb, generator_ids[1], 'engine') is not None
+            stats1 = bdb.cache_stats()['cgpm']
+            assert stats1['misses'] == stats['misses'] + 2
+            assert stats1['evictions'] == stats['evictions'] + 1
+            # The surviving engine is a hit.
+            cgpm_backend._engine(bdb, generator_ids[1])
+            stats2 = bdb.cache_stats()['cgpm']
+            assert stats2['hits'] == stats1['hits'] + 1
+            assert stats2['misses'] == stats1['misses']
+            # Lifting the budget keeps both.
+            cgpm_backend.set_cache_budget(None)
+            cgpm_backend._engine(bdb, generator_ids[0])
+            assert cgpm_backend._get_cache_entry(
+                bdb, generator_ids[1], 'engine') is not None
+            assert bdb.cache_stats()['cgpm']['entries'] >= 2
+        finally:
+            cgpm_backend.set_cache_budget(old_budget)
+
+
+def test_engine_stamp_memo():
+    """Confirm the stamp is queried once per transaction, until it changes."""
+    with bayeslite.bayesdb_open(':memory:') as bdb:
+        bayeslite.bayesdb_read_csv(bdb, 't', StringIO(test_csv.csv_data),
+            header=True, create=True)
+        bdb.execute('''
+            CREATE POPULATION p FOR t (
+                age NUMERICAL;
+                gender NOMINAL;
+                salary NUMERICAL;
+                height IGNORE;
+                division NOMINAL;
+                rank NOMINAL;
+            )
+        ''')
+        bdb.execute('CREATE GENERATOR m FOR p;')
+        bdb.execute('INITIALIZE 2 MODELS FOR m;')
+        cgpm_backend = bdb.backends['cgpm']
+        population_id = bayeslite.core.bayesdb_get_population(bdb, 'p')
+        generator_id = bayeslite.core.bayesdb_get_generator(
+            bdb, population_id, 'm')
+        sql = []
+        def trace(string, _bindings):
+            if 'SELECT engine_stamp' in string:
+                sql.append(string)
+        bdb.sql_trace(trace)
+        with bdb.savepoint():
+            assert cgpm_backend._engine_stamp(bdb, generator_id) == 1
+            assert cgpm_backend._engine_stamp(bdb, generator_id) == 1
+            assert len(sql) == 1
+            # Writing an engine forgets the stamp.
+            bdb.execute('ANALYZE m FOR 1 ITERATIONS')
+            del sql[:]
+            assert cgpm_backend._engine_stamp(bdb, generator_id) == 2
+            assert cgpm_backend._engine_stamp(bdb, generator_id) == 2
+            assert len(sql) == 1
+            # Rolling back a savepoint forgets the stamp.
+            with bdb.savepoint_rollback():
+                bdb.execute('ANALYZE m FOR 1 ITERATIONS')
+                assert cgpm_backend._engine_stamp(bdb, generator_id) == 3
+            assert cgpm_backend._engine_stamp(bdb, generator_id) == 2
+        # Outside a transaction, ask every time.
+        del sql[:]
+        assert cgpm_backend._engine_stamp(bdb, generator_id) == 2
+        assert cgpm_backend._engine_stamp(bdb, generator_id) == 2
+        assert len(sql) == 2
+        bdb.sql_untrace(trace)
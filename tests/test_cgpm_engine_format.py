@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import json
+import math
+import random
+
+import numpy
+import pytest
+
+from bayeslite.backends.cgpm_engine_format import ENGINE_FORMAT_BINARY
+from bayeslite.backends.cgpm_engine_format import ENGINE_FORMAT_JSON
+from bayeslite.backends.cgpm_engine_format import ENGINE_FORMAT_STATES
+from bayeslite.backends.cgpm_engine_format import engine_dumps
+from bayeslite.backends.cgpm_engine_format import engine_format_loads
+from bayeslite.backends.cgpm_engine_format import engine_loads
+from bayeslite.backends.cgpm_engine_format import partition_dumps
+from bayeslite.backends.cgpm_engine_format import partition_loads
+from bayeslite.util import json_dumps
+
+def _metadata(n_rows, n_cols, n_states, seed=0):
+    # Shaped roughly like Engine.to_metadata: data, partitions, and
+    # per-state hyperparameters.
+    prng = random.Random(seed)
+    def cell():
+        return float('nan') if prng.random() < .1 else prng.gauss(0, 1)
+    return {
+        'X': [[cell() for _c in xrange(n_cols)] for _r in xrange(n_rows)],
+        'outputs': range(n_cols),
+        'states': [{
+            'Zv': [[c, prng.randint(0, 3)] for c in xrange(n_cols)],
+            'Zrv': [
+                [v, [prng.randint(0, 9) for _r in xrange(n_rows)]]
+                for v in xrange(4)
+            ],
+            'alpha': prng.random(),
+            'hypers': {str(c): {'m': prng.random(), 'nu': 1.}
+                for c in xrange(n_cols)},
+            'cctypes': ['normal'] * n_cols,
+            'distargs': [None] * n_cols,
+        } for _s in xrange(n_states)],
+    }
+
+def _same(a, b):
+    if isinstance(a, float) and math.isnan(a):
+        return isinstance(b, float) and math.isnan(b)
+    if isinstance(a, list):
+        return isinstance(b, list) and len(a) == len(b) and \
+            all(_same(x, y) for x, y in zip(a, b))
+    if isinstance(a, dict):
+        return isinstance(b, dict) and sorted(a) == sorted(b) and \
+            all(_same(a[k], b[k]) for k in a)
+    return type(a) == type(b) and a == b
+
+def test_engine_format_roundtrip():
+    metadata = _metadata(50, 5, 3)
+    legacy = json.loads(json_dumps(metadata))
+    blob = engine_dumps(metadata)
+    assert _same(engine_loads(blob), legacy)
+    assert _same(engine_format_loads(ENGINE_FORMAT_STATES, buffer(blob)),
+        legacy)
+    assert _same(engine_format_loads(ENGINE_FORMAT_BINARY, buffer(blob)),
+        legacy)
+    assert _same(engine_format_loads(ENGINE_FORMAT_JSON, json_dumps(metadata)),
+        legacy)
+
+def test_engine_format_edge_cases():
+    metadata = {
+        # Placeholder lookalikes survive.
+        '__ndarray__': 0,
+        'a': {'__ndarray__': 1},
+        'b': {'__dict__': [1] * 20},
+        # Only long uniform lists of numbers become arrays.
+        'bools': [True] * 20,
+        'mixed': [1, 2.] * 10,
+        'big': [2**70] * 20,
+        'short': [1, 2, 3],
+        'ragged': [[1] * 10, [2] * 9],
+        'tuple': tuple(xrange(20)),
+        'matrix': [[1, 2]] * 10,
+        'empty': [[]] * 20,
+        'nested': [[[1.5] * 20]],
+    }
+    legacy = json.loads(json_dumps(metadata))
+    assert _same(engine_loads(engine_dumps(metadata)), legacy)
+
+def test_partition_format_roundtrip():
+    rows = numpy.array([[0, 1, 1, -1, 0], [2, 0, 1, 1, 0]])
+    blob = buffer(partition_dumps([4, 1, 7], [1, 0, 1], rows))
+    colnos, views, rows_loaded = partition_loads(blob)
+    assert colnos.tolist() == [4, 1, 7]
+    assert views.tolist() == [1, 0, 1]
+    assert rows_loaded.tolist() == rows.tolist()
+    # Read in place, not copied.
+    assert not rows_loaded.flags.writeable
+    colnos, views, rows_loaded = partition_loads(
+        partition_dumps([], [], numpy.zeros((0, 3))))
+    assert colnos.shape == views.shape == (0,)
+    assert rows_loaded.shape == (0, 3)
+
+def test_engine_format_errors():
+    with pytest.raises(ValueError):
+        engine_loads(json_dumps({}))
+    with pytest.raises(ValueError):
+        engine_loads('BQLCGPM\0\x02')
+    with pytest.raises(ValueError):
+        engine_format_loads(3, engine_dumps({}))
+    with pytest.raises(ValueError):
+        partition_loads(engine_dumps({}))
+
+def test_engine_format_size__ci_():
+    metadata = _metadata(20000, 10, 16)
+    assert len(engine_dumps(metadata)) < len(json_dumps(metadata))
@@ -27,6 +27,7 @@ import bayeslite.bqlfn as bqlfn
 import bayeslite.core as core
 
 from bayeslite.backends.cgpm_backend import CGPM_Backend
+from bayeslite.backends.nig_normal import NIGNormalBackend
 
 from bayeslite import bql_quote_name
 from bayeslite.sqlite3_util import sqlite3_connection
@@ -61,6 +62,38 @@ def test_prng_determinism():
     assert bdb.py_prng.uniform(0, 1) == 0.6156331606142532
     assert bdb.np_prng.uniform(0, 1) == 0.28348770982811367
 
+def test_prng_streams():
+    def draws(bdb, *key):
+        prng = bdb.prng_stream(*key)
+        return [prng.weakrandom32() for _ in range(20)]
+    bdb = bayeslite.bayesdb_open(builtin_backends=False)
+    bdb.execute('SELECT 42')
+    a = draws(bdb, 1, 2, 3)
+    # Drawing from the shared generators or other streams changes nothing.
+    bdb.np_prng.uniform()
+    b = draws(bdb, 1, 2, 4)
+    assert draws(bdb, 1, 2, 3) == a
+    np_a = bdb.np_prng_stream(1, 2, 3).uniform(size=5)
+    assert (bdb.np_prng_stream(1, 2, 3).uniform(size=5) == np_a).all()
+    # Different keys, including None and large values, differ.
+    assert a != b
+    assert draws(bdb, 1, 2) != draws(bdb, 1, 2, None)
+    assert draws(bdb, 1, 2, None) != draws(bdb, 1, 2, 0)
+    assert draws(bdb, 2**40) != draws(bdb, 0)
+    # Each query gets its own streams, reproducible from the seed.
+    stmt = bdb.prepare('SELECT 42')
+    stmt.execute()
+    c = draws(bdb, 1, 2, 3)
+    assert c != a
+    other = bayeslite.bayesdb_open(builtin_backends=False)
+    other.execute('SELECT 0')
+    assert draws(other, 1, 2, 3) == a
+    other.execute('SELECT 1')
+    assert draws(other, 1, 2, 3) == c
+    seeded = bayeslite.bayesdb_open(builtin_backends=False, seed='x' * 32)
+    seeded.execute('SELECT 0')
+    assert draws(seeded, 1, 2, 3) != a
+
 def test_openclose():
     with bayesdb():
         pass
@@ -85,6 +118,44 @@ def test_bad_db_user_version():
             with bayesdb(pathname=f.name):
                 pass
 
+def test_wal_background():
+    with pytest.raises(ValueError):
+        bayeslite.bayesdb_open(builtin_backends=False, wal=True)
+    with tempfile.NamedTemporaryFile(prefix='bayeslite') as f:
+        with bayesdb(backend=NIGNormalBackend(), pathname=f.name, wal=True) \
+                as bdb:
+            assert cursor_value(bdb.sql_execute('PRAGMA journal_mode')) == \
+                'wal'
+            bdb.sql_execute('CREATE TABLE t(x REAL, y REAL)')
+            for i in range(10):
+                bdb.sql_execute('INSERT INTO t VALUES (?, ?)', (i, i*i))
+            bdb.execute('CREATE POPULATION p FOR t(x NUMERICAL; y NUMERICAL)')
+            bdb.execute('CREATE GENERATOR g FOR p USING nig_normal')
+            bdb.execute('INITIALIZE 2 MODELS FOR g')
+            def models():
+                return bdb.sql_execute('''
+                    SELECT mu, sigma FROM bayesdb_nig_normal_model
+                        ORDER BY modelno, colno
+                ''').fetchall()
+            before = models()
+            with bdb.savepoint():
+                with pytest.raises(bayeslite.BayesDBTxnError):
+                    bdb.execute_background('ANALYZE g FOR 1 ITERATION')
+            background = bdb.execute_background('ANALYZE g FOR 1 ITERATION')
+            # Queries carry on meanwhile.
+            bdb.execute('ESTIMATE PROBABILITY DENSITY OF x = 1 BY p')\
+                .fetchall()
+            assert background.wait()
+            assert not background.running()
+            assert models() != before
+            background = bdb.execute_background('ANALYZE h FOR 1 ITERATION')
+            with pytest.raises(bayeslite.BQLError):
+                background.wait()
+        with bayesdb(backend=NIGNormalBackend(), pathname=f.name) as bdb:
+            # WAL mode persists in the file.
+            assert cursor_value(bdb.sql_execute('PRAGMA journal_mode')) == \
+                'wal'
+
 class DotdogBackend(bayeslite.backend.BayesDB_Backend):
     def name(self):
         return 'dotdog'
@@ -572,6 +643,41 @@ def test_bayesdb_population_add_variable():
         assert core.bayesdb_has_variable(bdb, population_id, None, 'q')
         assert core.bayesdb_variable_number(bdb, population_id, None, 'q') == 3
 
+def test_bayesdb_catalog():
+    with tempfile.NamedTemporaryFile(prefix='bayeslite') as f:
+        with bayesdb(pathname=f.name) as bdb:
+            bdb.sql_execute('create table t (a real, b real)')
+            bdb.execute('''
+                create population p for t (a numerical; b numerical)
+            ''')
+            population_id = core.bayesdb_get_population(bdb, 'p')
+            catalog = core.bayesdb_catalog(bdb)
+            assert core.bayesdb_variable_stattype(
+                bdb, population_id, None, 1) == 'numerical'
+            assert core.bayesdb_catalog(bdb) is catalog
+            # Schema-changing phrases drop the catalog.
+            bdb.execute('alter population p set stattype of b to nominal')
+            assert core.bayesdb_catalog(bdb) is not catalog
+            assert core.bayesdb_variable_stattype(
+                bdb, population_id, None, 1) == 'nominal'
+            # Rolled back changes are forgotten.
+            with bdb.savepoint_rollback():
+                bdb.execute('alter population p rename to q')
+                assert core.bayesdb_has_population(bdb, 'q')
+            assert not core.bayesdb_has_population(bdb, 'q')
+            assert core.bayesdb_has_population(bdb, 'p')
+            # Direct writes to the catalog tables drop the catalog.
+            bdb.sql_execute('''
+                update bayesdb_variable set name = 'c' where name = 'b'
+            ''')
+            assert core.bayesdb_variable_name(
+                bdb, population_id, None, 1) == 'c'
+            # Changes committed by other connections are noticed.
+            with bayesdb(pathname=f.name) as bdb1:
+                bdb1.execute('drop population p')
+            bdb.execute('select 0')
+            assert not core.bayesdb_has_population(bdb, 'p')
+
 def test_bayesdb_implicit_population_generator():
     with bayesdb() as bdb:
         # Create table t.
@@ -20,8 +20,11 @@ import pytest
 
 import bayeslite
 
+import bayeslite.guess as guess
+
 from bayeslite.guess import bayesdb_guess_population
 from bayeslite.guess import bayesdb_guess_stattypes
+from bayeslite.guess import bayesdb_guess_stattypes_counts
 from bayeslite.exception import BQLError
 
 def test_guess_stattypes():
@@ -128,6 +131,80 @@ def test_guess_stattypes():
     assert [st[0] for st in bayesdb_guess_stattypes(n, rows)] == \
         ['numerical', 'numerical']
 
+def test_guess_summaries():
+    # Guessing from one-pass summaries agrees with guessing from all
+    # the rows, reasons and counts included.
+    n = ['a', 'b']
+    a_z = range(ord('a'), ord('z') + 1)
+    cases = [
+        [[chr(c), c % 2] for c in a_z],
+        [[chr(c), c % 2] for c in a_z] + [['q', ord('q') % 2]],
+        [[c % 2, chr(c)] for c in a_z] + [[0, 'k']],
+        [[chr(c), i] for i, c in enumerate(a_z)],
+        [[chr(c), math.sqrt(i)] for i, c in enumerate(a_z)],
+        [[chr(c) + chr(d), isqrt(i)] for i, (c, d)
+            in enumerate(itertools.product(a_z, a_z))],
+        [[i, chr(c)] for i, c in enumerate(a_z)],
+        [['none' if c < ord('m') else c, chr(c)] for c in a_z],
+        [[3 if c < ord('y') else 5, chr(c)] for c in a_z],
+        [[math.sqrt(c), c + 0.5] for c in a_z],
+        [[c + 0.5, float(c)] for c in a_z],
+        [[c + 0.5, float(c + 0.5) if c % 2 == 0 else int(c)] for c in a_z],
+        [[str(c), 'x' if c % 3 else None] for c in a_z],
+        [[7 if c < ord('y') else 'N/A', c % 5] for c in a_z] * 3,
+        [[1 if c < ord('y') else 'abc', str(c)] for c in a_z],
+    ]
+    for rows in cases:
+        exact = bayesdb_guess_stattypes_counts(n, rows)
+        assert bayesdb_guess_stattypes_counts(n, iter(rows), exact_rows=0) \
+            == exact
+    rows = [[3 if c < ord('y') else 5, chr(c)] for c in a_z]
+    assert bayesdb_guess_stattypes(n, iter(rows), exact_rows=0,
+            overrides=[('b', 'key')]) == \
+        bayesdb_guess_stattypes(n, rows, overrides=[('b', 'key')])
+    with pytest.raises(ValueError):
+        # Nonunique key.
+        bayesdb_guess_stattypes(n, iter(rows), exact_rows=0,
+            overrides=[('a', 'key')])
+    with pytest.raises(ValueError):
+        # Too many columns in data, even past the rows kept.
+        bayesdb_guess_stattypes(n, rows + [[1, 2, 3]], exact_rows=3)
+    # Past GUESS_EXACT_COUNT distinct values, the counts are estimated
+    # but still find keys and pseudo-keys.
+    exact_count = guess.GUESS_EXACT_COUNT
+    guess.GUESS_EXACT_COUNT = 100
+    try:
+        rows = [[chr(c) + chr(d) + chr(e), isqrt(i), i % 3,
+                'x%d' % (i % 997)]
+            for i, (c, d, e) in enumerate(itertools.product(a_z, a_z, a_z))]
+        stattypes, counts = bayesdb_guess_stattypes_counts(
+            ['k', 'r', 'm', 'p'], iter(rows), exact_rows=0)
+        assert [st[0] for st in stattypes] == \
+            ['key', 'nominal', 'nominal', 'nominal']
+        assert abs(counts[0] - len(rows)) < 0.03*len(rows)
+        assert abs(counts[3] - 997) < 0.03*997
+        assert abs(counts[1] - 133) < 0.03*133
+        assert counts[2] == 3
+    finally:
+        guess.GUESS_EXACT_COUNT = exact_count
+
+def test_hyperloglog():
+    for n in [0, 1, 10, 1000, 100000]:
+        hll = guess.HyperLogLog()
+        for i in xrange(n):
+            hll.add(i)
+            hll.add(str(i))
+        assert abs(hll.count() - 2*n) <= 0.03*2*n
+        assert hll.all_distinct_p(2*n)
+        assert not hll.all_distinct_p(3*n) or n == 0
+
+def test_space_saving():
+    top = guess.SpaceSaving(4)
+    for i in xrange(1000):
+        top.add('a' if i % 2 else i)
+    assert max(top.counts.iteritems(), key=lambda item: item[1])[0] == 'a'
+    assert 500 <= top.counts['a']
+
 def test_guess_population():
     with bayeslite.bayesdb_open() as bdb:
         bdb.sql_execute('CREATE TABLE t(x NUMERIC, y NUMERIC, z NUMERIC)')
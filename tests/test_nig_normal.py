@@ -15,13 +15,17 @@
 #   limitations under the License.
 
 import pytest
+import time
 
+import bayeslite.bqlfn as bqlfn
 import bayeslite.core as core
 
 from bayeslite import BQLError
 from bayeslite import bayesdb_open
 from bayeslite import bayesdb_register_backend
 from bayeslite.backends.nig_normal import NIGNormalBackend
+from bayeslite.backends.nig_normal import logpdf_gaussian
+from bayeslite.math_util import logmeanexp
 
 def test_nig_normal_smoke():
     with bayesdb_open(':memory:') as bdb:
@@ -40,6 +44,293 @@ def test_nig_normal_smoke():
         bdb.execute('drop population p')
         bdb.execute('drop table t')
 
+def test_nig_normal_cache_stats():
+    with bayesdb_open(':memory:', builtin_backends=False) as bdb:
+        bayesdb_register_backend(bdb, NIGNormalBackend())
+        assert bdb.cache_stats() == {'nig_normal': {}}
+
+def test_nig_normal_batch_estimate():
+    with bayesdb_open(':memory:') as bdb:
+        bayesdb_register_backend(bdb, NIGNormalBackend(seed=0))
+        bdb.sql_execute('create table t(x, y)')
+        for x in xrange(600):
+            bdb.sql_execute('insert into t(x, y) values(?, ?)', (x % 7, x))
+        bdb.execute('create population p for t(x numerical; y numerical)')
+        bdb.execute('create generator g for p using nig_normal')
+        bdb.execute('initialize 2 models for g')
+        bdb.execute('analyze g for 1 iteration')
+        # Row functions over every row are batched; WHERE disables
+        # batching, so the results must agree row for row.
+        batched = bdb.execute('''
+            estimate rowid, predictive probability of x given (y) from p
+        ''').fetchall()
+        assert len(batched) == 600
+        assert batched == bdb.execute('''
+            estimate rowid, predictive probability of x given (y) from p
+                where 1
+        ''').fetchall()
+        batched = bdb.execute('''
+            estimate rowid, similarity to (rowid = 3) in the context of x
+                from p order by rowid limit 10
+        ''').fetchall()
+        assert batched == bdb.execute('''
+            estimate rowid, similarity to (rowid = 3) in the context of x
+                from p where 1 limit 10
+        ''').fetchall()
+        # Pairwise dependence probabilities come from one matrix.
+        pairwise = bdb.execute('''
+            estimate dependence probability
+                from pairwise variables of p
+        ''').fetchall()
+        assert len(pairwise) == 4
+        for _pid, name0, name1, depprob in pairwise:
+            assert depprob == bdb.execute('''
+                estimate dependence probability of %s with %s by p
+            ''' % (name0, name1)).fetchvalue()
+        bdb.execute('''
+            create temp table pp as
+                estimate predictive probability of x as pp from p
+        ''')
+        assert bdb.execute('select count(pp) from pp').fetchvalue() == 600
+        # The temporary tables holding the batched values are gone.
+        assert not core.bayesdb_has_table(bdb, 'bayesdb_temp_0')
+        assert bdb.temp_table_name() == 'bayesdb_temp_4'
+        # The batch is computed, and fails, when the cursor is stepped.
+        cursor = bdb.execute('''
+            estimate similarity to (rowid = 1000) in the context of x
+                from p
+        ''')
+        with pytest.raises(BQLError):
+            cursor.fetchall()
+        del cursor
+        assert not core.bayesdb_has_table(bdb, 'bayesdb_temp_5')
+
+def test_nig_normal_batch_estimate_shared():
+    with bayesdb_open(':memory:') as bdb:
+        bayesdb_register_backend(bdb, NIGNormalBackend(seed=0))
+        bdb.sql_execute('create table t(x, y)')
+        for x in xrange(20):
+            bdb.sql_execute('insert into t(x, y) values(?, ?)', (x % 7, x))
+        bdb.execute('create population p for t(x numerical; y numerical)')
+        bdb.execute('create generator g for p using nig_normal')
+        bdb.execute('initialize 1 model for g')
+        created = []
+        def trace(string, _bindings):
+            if string.startswith('CREATE TEMP TABLE'):
+                created.append(string)
+        # A row function mentioned twice is computed once into one
+        # temporary table; different ones each get their own.
+        query = '''
+            estimate rowid, predictive probability of x,
+                    similarity to (rowid = 3) in the context of x
+                from p %s
+                order by predictive probability of x desc,
+                    similarity to (rowid = 3) in the context of x,
+                    predictive probability of y
+        '''
+        bdb.sql_trace(trace)
+        batched = bdb.execute(query % ('',)).fetchall()
+        bdb.sql_untrace(trace)
+        assert len(created) == 3
+        assert batched == bdb.execute(query % ('where 1',)).fetchall()
+
+class MatrixNIGNormalBackend(NIGNormalBackend):
+    """NIG-Normal recording the columns of dependence matrices asked for."""
+
+    def __init__(self, *args, **kwargs):
+        super(MatrixNIGNormalBackend, self).__init__(*args, **kwargs)
+        self.matrix_colnos = []
+
+    def column_dependence_probability_matrix(self, bdb, generator_id,
+            modelnos, colnos):
+        self.matrix_colnos.append(list(colnos))
+        return super(MatrixNIGNormalBackend, self) \
+            .column_dependence_probability_matrix(
+                bdb, generator_id, modelnos, colnos)
+
+def test_nig_normal_depprob_matrix_columns():
+    with bayesdb_open(':memory:') as bdb:
+        backend = MatrixNIGNormalBackend()
+        bayesdb_register_backend(bdb, backend)
+        bdb.sql_execute('create table t(x, y, z)')
+        for x in xrange(10):
+            bdb.sql_execute('insert into t(x, y, z) values(?, ?, ?)',
+                (x, x*x, -x))
+        bdb.execute('''
+            create population p for t(x numerical; y numerical; z numerical)
+        ''')
+        bdb.execute('create generator g for p using nig_normal')
+        bdb.execute('initialize 1 model for g')
+        # The matrix is computed once, when the cursor is stepped, for
+        # the variables of the FOR clause only.
+        cursor = bdb.execute('''
+            estimate dependence probability from pairwise variables of p
+                for x, z order by dependence probability desc
+        ''')
+        assert backend.matrix_colnos == []
+        assert len(cursor.fetchall()) == 4
+        assert backend.matrix_colnos == [[0, 2]]
+        # Queries visiting only some pairs go pair by pair.
+        del backend.matrix_colnos[:]
+        assert len(bdb.execute('''
+            estimate dependence probability from pairwise variables of p
+                where name0 = 'x'
+        ''').fetchall()) == 3
+        assert len(bdb.execute('''
+            estimate dependence probability from pairwise variables of p
+                limit 2
+        ''').fetchall()) == 2
+        assert backend.matrix_colnos == []
+
+def test_nig_normal_prepared_simulate():
+    with bayesdb_open(':memory:') as bdb:
+        bayesdb_register_backend(bdb, NIGNormalBackend(seed=0))
+        bdb.sql_execute('create table t(x, y)')
+        for x in xrange(10):
+            bdb.sql_execute('insert into t(x, y) values(?, ?)', (x, x*x))
+        bdb.execute('create population p for t(x numerical; y numerical)')
+        bdb.execute('create generator g for p using nig_normal')
+        bdb.execute('initialize 1 model for g')
+        sql = []
+        def trace(string, _bindings):
+            sql.append(string)
+        # The compiled query is reused, and its winders simulate afresh
+        # for each execution.
+        stmt = bdb.prepare('simulate x from p given y = ? limit ?')
+        bdb.sql_trace(trace)
+        assert len(stmt.execute((10, 1)).fetchall()) == 1
+        assert len(stmt.execute((20, 3)).fetchall()) == 3
+        bdb.sql_untrace(trace)
+        selects = [q for q in sql if q.startswith('SELECT * FROM')]
+        assert len(selects) == 2
+        assert selects[0] == selects[1]
+        # While a cursor holds its temporary table, it is compiled afresh.
+        cursor = stmt.execute((10, 2))
+        assert len(cursor.fetchall()) == 2
+        assert len(stmt.execute((10, 1)).fetchall()) == 1
+        del cursor
+        # Likewise for row functions evaluated in a batch.
+        stmt = bdb.prepare('''
+            estimate rowid, predictive probability of x from p
+                order by rowid limit ?
+        ''')
+        del sql[:]
+        bdb.sql_trace(trace)
+        assert len(stmt.execute((2,)).fetchall()) == 2
+        assert len(stmt.execute((5,)).fetchall()) == 5
+        bdb.sql_untrace(trace)
+        selects = [q for q in sql if q.startswith('SELECT "rowid"')]
+        assert len(selects) == 2
+        assert selects[0] == selects[1]
+
+def test_nig_normal_simulate_streams():
+    with bayesdb_open(':memory:') as bdb:
+        backend = NIGNormalBackend(seed=0)
+        bayesdb_register_backend(bdb, backend)
+        bdb.sql_execute('create table t(x, y)')
+        for x in xrange(10):
+            bdb.sql_execute('insert into t(x, y) values(?, ?)', (x, x*x))
+        bdb.execute('create population p for t(x numerical; y numerical)')
+        bdb.execute('create generator g for p using nig_normal')
+        bdb.execute('initialize 3 models for g')
+        generator_id = core.bayesdb_get_generator(bdb, None, 'g')
+        # Each row draws from the streams for its generator, model, row,
+        # and columns, so it gets the same samples alone or in a batch.
+        queries = [(rowid, [0, 1], []) for rowid in [3, 1, 2]]
+        many = backend.simulate_joint_many(bdb, generator_id, None, queries,
+            num_samples=2)
+        for (rowid, targets, constraints), samples in zip(queries, many):
+            assert samples == backend.simulate_joint(bdb, generator_id, None,
+                rowid, targets, constraints, num_samples=2)
+        assert many[0] != many[1]
+        # Queries of other columns of the row get other draws.
+        [[x, _y]] = backend.simulate_joint(bdb, generator_id, None, 3,
+            [0, 1], [])
+        assert [[x]] != backend.simulate_joint(bdb, generator_id, None, 3,
+            [0], [])
+
+class ConcurrentNIGNormalBackend(NIGNormalBackend):
+    """NIG-Normal evaluating densities away from the query, if asked."""
+
+    def __init__(self, *args, **kwargs):
+        super(ConcurrentNIGNormalBackend, self).__init__(*args, **kwargs)
+        self.executor = None
+        self.sent = []
+
+    def prepare_concurrent(self, bdb, generator_id, memo, method, *args,
+            **kwargs):
+        if self.executor is None or method != 'logpdf_joint':
+            return None
+        _modelnos, _rowid, targets, _constraints = args
+        params = self._all_mus_sigmas(bdb, generator_id)
+        if self.executor == 'thread':
+            # The first generator finishes last.
+            delay = 0.1 / generator_id
+            return ('thread', _concurrent_logpdf, (params, targets, delay))
+        # Send the parameters to the worker of the generator only once.
+        if memo.get('params') == params:
+            sent = None
+        else:
+            sent = memo['params'] = params
+        self.sent.append(sent is not None)
+        return ('process', _concurrent_logpdf_worker, (sent, targets))
+
+def _concurrent_logpdf(params, targets, delay=0):
+    time.sleep(delay)
+    all_mus, all_sigmas = params
+    return logmeanexp([
+        sum(logpdf_gaussian(x, all_mus[m][colno], all_sigmas[m][colno])
+            for colno, x in targets)
+        for m in sorted(all_mus.keys())
+    ])
+
+_concurrent_worker_params = None
+
+def _concurrent_logpdf_worker(params, targets):
+    global _concurrent_worker_params
+    if params is not None:
+        _concurrent_worker_params = params
+    return _concurrent_logpdf(_concurrent_worker_params, targets)
+
+def test_nig_normal_concurrent_generators():
+    with bayesdb_open(':memory:') as bdb:
+        backend = ConcurrentNIGNormalBackend(seed=0)
+        bayesdb_register_backend(bdb, backend)
+        bdb.sql_execute('create table t(x, y)')
+        for x in xrange(10):
+            bdb.sql_execute('insert into t(x, y) values(?, ?)', (x, x*x))
+        bdb.execute('create population p for t(x numerical; y numerical)')
+        for g in ['g0', 'g1', 'g2']:
+            bdb.execute('create generator %s for p using nig_normal' % (g,))
+            bdb.execute('initialize 2 models for %s' % (g,))
+            bdb.execute('analyze %s for 1 iteration' % (g,))
+        generator_ids = [
+            core.bayesdb_get_generator(bdb, None, g)
+            for g in ['g0', 'g1', 'g2']
+        ]
+        def logpdfs():
+            return bqlfn._map_generators(bdb, generator_ids, 'logpdf_joint',
+                None, None, [(0, 3.5), (1, 12.)], [])
+        query = '''
+            estimate probability density of x = 3.5 given (y = 12) by p
+        '''
+        serial = logpdfs()
+        assert len(set(serial)) == 3
+        expected = bdb.execute(query).fetchall()
+        # Whichever finishes first, the results come in generator order,
+        # and combine to the same estimates.
+        for executor in ['thread', 'process']:
+            backend.executor = executor
+            assert logpdfs() == serial
+            assert bdb.execute(query).fetchall() == expected
+        # Each worker process kept what was sent to it.
+        assert backend.sent == [True] * 3 + [False] * 3 * 2
+        executor = bdb._generator_executor
+        assert sorted(executor._processes) == sorted(generator_ids)
+    assert bdb._generator_executor is None
+    assert executor._threads is None
+    assert executor._processes == {}
+
 def test_nig_normal_latent_numbering():
     with bayesdb_open(':memory:') as bdb:
         bayesdb_register_backend(bdb, NIGNormalBackend())
@@ -14,6 +14,8 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import StringIO
+import ast as python_ast
 import contextlib
 import itertools
 import pytest
@@ -21,6 +23,7 @@ import pytest
 import bayeslite
 import bayeslite.ast as ast
 import bayeslite.parse as parse
+import bayeslite.scan as scan
 
 def parse_bql_string(string):
     phrases = list(parse.parse_bql_string(string))
@@ -1631,3 +1634,62 @@ def test_parse_error_with_context():
     with raises_str(bayeslite.BQLParseError,
                     "Syntax error near [] after [select]"):
         parse_bql_string('select')
+
+def corpus():
+    """Return every string literal in this file, BQL or not."""
+    with open(__file__.replace('.pyc', '.py'), 'rU') as f:
+        tree = python_ast.parse(f.read())
+    return [node.s for node in python_ast.walk(tree)
+        if isinstance(node, python_ast.Str)]
+
+def scan_plex(string):
+    scanner = scan.BQLScanner(StringIO.StringIO(string), '(string)')
+    return scan_tokens(scanner)
+
+def scan_regexp(string):
+    return scan_tokens(scan.BQLRegexpScanner(string))
+
+def scan_tokens(scanner):
+    tokens = []
+    while True:
+        try:
+            token = scanner.read()
+        except ValueError:              # e.g., 0x1f
+            tokens.append('ValueError')
+            break
+        tokens.append((token, scanner.cur_pos))
+        if token[0] == 0:
+            break
+    return tokens, scanner.n_numpar, scanner.nampar_map
+
+def test_scanners_agree():
+    strings = corpus() + [
+        "'unterminated", '"unterminated', "'it''s' \"a\"\"b\"",
+        '?0 ?1 ? ?123456789012345678901 :x @X $x :x $ $$x @ :',
+        '1 1. .5 1.5e5 1e5 1e 1.e 1.5e+ 0x1f 0xg 12abc -- comment\n-',
+        '== <> <= >= << >> != || | < > = ! \v \f',
+        u'select \xe9 from t',
+    ]
+    for string in strings:
+        assert scan_plex(string) == scan_regexp(string), repr(string)
+
+def test_parse_cache():
+    string = 'select * from t where x = :x;'
+    phrases = parse_bql_string(string)
+    assert string in parse._parse_cache
+    assert list(parse.parse_bql_string(string)) == phrases
+    # Each caller gets phrases of its own to modify.
+    [phrase] = parse.parse_bql_string(string)
+    phrase.phrase.columns.append(None)
+    assert list(parse.parse_bql_string(string)) != [phrase]
+    del phrase.phrase.columns[-1]
+    assert list(parse.parse_bql_string(string)) == [phrase]
+    # Errors are not remembered.
+    with pytest.raises(parse.BQLParseError):
+        parse_bql_string('select 0c;')
+    assert 'select 0c;' not in parse._parse_cache
+
+def test_scan_long__ci_():
+    string = 'select * from t where x in (%s)' % \
+        (', '.join(str(i) for i in xrange(10000)),)
+    assert scan_plex(string) == scan_regexp(string)
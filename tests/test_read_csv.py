@@ -19,6 +19,7 @@ import pytest
 import tempfile
 
 import bayeslite
+import bayeslite.read_csv as read_csv
 
 from bayeslite.util import cursor_value
 
@@ -104,8 +105,8 @@ def test_read_csv():
         assert cursor_value(bdb.sql_execute('SELECT sql FROM sqlite_master'
                     ' WHERE name = ?', ('t',))) == \
             'CREATE TABLE "t"' \
-            '("a" NUMERIC,"b" NUMERIC,"c" NUMERIC,"name" NUMERIC,' \
-            '"nick" NUMERIC,"age" NUMERIC,"muppet" NUMERIC,"animal" NUMERIC)'
+            '("a" INTEGER,"b" INTEGER,"c" INTEGER,"name" TEXT,' \
+            '"nick" TEXT,"age" NUMERIC,"muppet" TEXT,"animal" TEXT)'
 
         f = StringIO.StringIO(csv_data)
         bayeslite.bayesdb_read_csv(bdb, 't', f, header=False, create=False,
@@ -142,3 +143,101 @@ def test_read_csv():
             with pytest.raises(IOError):
                 bayeslite.bayesdb_read_csv_file(
                     bdb, 't3', temp.name, header=True, create=True)
+
+def test_read_csv_affinity():
+    csv = 'i,r,m,t,x,e\n' \
+        '1,2.5,3,abc,4,\n' \
+        '-7,8,nine,def,,\n' \
+        '10,1e3,11.5,12,"",\n'
+    with bayeslite.bayesdb_open(builtin_backends=False) as bdb:
+        bayeslite.bayesdb_read_csv(bdb, 't', StringIO.StringIO(csv),
+            header=True, create=True)
+        assert cursor_value(bdb.sql_execute('SELECT sql FROM sqlite_master'
+                    ' WHERE name = ?', ('t',))) == \
+            'CREATE TABLE "t"' \
+            '("i" INTEGER,"r" REAL,"m" NUMERIC,"t" NUMERIC,"x" INTEGER,' \
+            '"e" NUMERIC)'
+        assert bdb.sql_execute('SELECT * FROM t').fetchall() == [
+            (1, 2.5, 3, u'abc', 4, u''),
+            (-7, 8.0, u'nine', u'def', u'', u''),
+            (10, 1000.0, 11.5, 12, u'', u''),
+        ]
+
+def test_read_csv_batches():
+    nrows = 25
+    csv = 'x,y\n' + ''.join('%d,%d\n' % (i, i*i) for i in xrange(nrows))
+    batch_size = read_csv.CSV_BATCH_SIZE
+    read_csv.CSV_BATCH_SIZE = 10
+    try:
+        with bayeslite.bayesdb_open(builtin_backends=False) as bdb:
+            counts = []
+            def progress(n, seconds):
+                assert 0 <= seconds
+                counts.append(n)
+            bayeslite.bayesdb_read_csv(bdb, 't', StringIO.StringIO(csv),
+                header=True, create=True, progress=progress)
+            assert counts == [10, 20, 25]
+            assert bdb.sql_execute('SELECT x, y FROM t').fetchall() == \
+                [(i, i*i) for i in xrange(nrows)]
+            # Tracing still sees each inserted row.
+            traced = []
+            def trace(string, bindings):
+                if string.startswith('INSERT INTO "t"'):
+                    traced.append(bindings)
+            bdb.sql_trace(trace)
+            bayeslite.bayesdb_read_csv(bdb, 't', StringIO.StringIO(csv),
+                header=True, create=False)
+            bdb.sql_untrace(trace)
+            assert traced == \
+                [[unicode(i), unicode(i*i)] for i in xrange(nrows)]
+            # A bad row anywhere rolls back the whole file, and the
+            # error names its line.
+            bad = csv + '1,2,3\n'
+            with pytest.raises(IOError) as exc:
+                bayeslite.bayesdb_read_csv(bdb, 't', StringIO.StringIO(bad),
+                    header=True, create=False)
+            assert str(exc.value) == 'Line %d: Too many columns: 3 > 2' % \
+                (nrows + 2,)
+            with pytest.raises(IOError) as exc:
+                bayeslite.bayesdb_read_csv(bdb, 'u', StringIO.StringIO(bad),
+                    header=True, create=True)
+            assert not bayeslite.core.bayesdb_has_table(bdb, 'u')
+            assert cursor_value(bdb.sql_execute('SELECT COUNT(*) FROM t')) \
+                == 2*nrows
+    finally:
+        read_csv.CSV_BATCH_SIZE = batch_size
+
+def test_read_csv_parallel():
+    rows = [(i, 'x%d' % (i,) if i % 7 else '"multi\nline, ""%d"""' % (i,))
+        for i in xrange(500)]
+    csv = 'n,s\n' + ''.join('%d,%s\n' % row for row in rows)
+    chunk_size = read_csv.CSV_CHUNK_SIZE
+    read_csv.CSV_CHUNK_SIZE = 100
+    try:
+        with bayeslite.bayesdb_open(builtin_backends=False) as bdb:
+            with tempfile.NamedTemporaryFile(prefix='bayeslite') as temp:
+                with open(temp.name, 'w') as f:
+                    f.write(csv)
+                bayeslite.bayesdb_read_csv(bdb, 'serial',
+                    StringIO.StringIO(csv), header=True, create=True)
+                counts = []
+                bayeslite.bayesdb_read_csv_file(bdb, 'parallel', temp.name,
+                    header=True, create=True, processes=2,
+                    progress=lambda n, _seconds: counts.append(n))
+                assert 1 < len(counts)
+                assert counts[-1] == len(rows)
+                serial = bdb.sql_execute('SELECT * FROM serial').fetchall()
+                parallel = \
+                    bdb.sql_execute('SELECT * FROM parallel').fetchall()
+                assert parallel == serial
+                assert parallel[7] == (7, u'multi\nline, "7"')
+                with open(temp.name, 'a') as f:
+                    f.write('1,2,3\n')
+                with pytest.raises(IOError) as exc:
+                    bayeslite.bayesdb_read_csv_file(bdb, 'bad', temp.name,
+                        header=True, create=True, processes=2)
+                assert str(exc.value) == \
+                    'Line %d: Too many columns: 3 > 2' % (len(rows) + 2,)
+                assert not bayeslite.core.bayesdb_has_table(bdb, 'bad')
+    finally:
+        read_csv.CSV_CHUNK_SIZE = chunk_size
@@ -14,12 +14,16 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import StringIO
+
 import apsw
+import numpy
 import pandas
 import pytest
 
 from bayeslite import bayesdb_open
 from bayeslite import bql_quote_name
+from bayeslite import read_pandas
 from bayeslite.core import bayesdb_has_table
 from bayeslite.read_pandas import bayesdb_read_pandas_df
 
@@ -69,3 +73,31 @@ def test_nonintegral_index():
         df = pandas.DataFrame([(1,2,'foo'),(4,5,6),(7,8,9),(10,11,12)],
             index=[42, 78, 62, 43])
         do_test(bdb, 't', df, index='eland')
+
+def test_missing_and_numpy_values():
+    with bayesdb_open() as bdb:
+        df = pandas.DataFrame({
+            'x': [1.5, float('nan'), 3.0],
+            'n': numpy.array([1, 2, 3], dtype=numpy.int64),
+            's': ['a', None, numpy.int64(7)],
+        }, columns=['x', 'n', 's'])
+        bayesdb_read_pandas_df(bdb, 't', df, create=True)
+        assert bdb.sql_execute('SELECT _rowid_, * FROM t').fetchall() == [
+            (0, 1.5, 1, 'a'),
+            (1, None, 2, None),
+            (2, 3.0, 3, 7),
+        ]
+
+def test_chunked():
+    csv = 'a,b\n' + ''.join('%d,%s\n' % (i, 'x' if i % 3 else '')
+        for i in xrange(25))
+    chunk_size = read_pandas.PANDAS_CHUNK_SIZE
+    read_pandas.PANDAS_CHUNK_SIZE = 4
+    try:
+        with bayesdb_open() as bdb:
+            reader = pandas.read_csv(StringIO.StringIO(csv), chunksize=10)
+            bayesdb_read_pandas_df(bdb, 't', reader, create=True)
+            assert bdb.sql_execute('SELECT _rowid_, a, b FROM t').fetchall() \
+                == [(i, i, u'x' if i % 3 else None) for i in xrange(25)]
+    finally:
+        read_pandas.PANDAS_CHUNK_SIZE = chunk_size
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import pytest
+
+import bayeslite
+
+from bayeslite import BQLError
+from bayeslite import bayesdb_open
+from bayeslite import bayesdb_register_backend
+from bayeslite import bayesdb_row_similarities
+from bayeslite.backends.nig_normal import NIGNormalBackend
+
+class DistanceBackend(NIGNormalBackend):
+    """NIG-Normal with rows similar according to their distance in x."""
+
+    def row_similarity(self, bdb, generator_id, modelnos, rowid, target_rowid,
+            colnos):
+        cursor = bdb.sql_execute('''
+            SELECT 1. / (1 + abs(t0.x - t1.x)) FROM t AS t0, t AS t1
+                WHERE t0._rowid_ = ? AND t1._rowid_ = ?
+        ''', (rowid, target_rowid))
+        return [cursor.fetchvalue()]
+
+    def row_similarity_many(self, bdb, generator_id, modelnos, queries,
+            colnos):
+        return [
+            self.row_similarity(
+                bdb, generator_id, modelnos, rowid, target_rowid, colnos)
+            for rowid, target_rowid in queries
+        ]
+
+def _bdb():
+    bdb = bayesdb_open(':memory:')
+    bayesdb_register_backend(bdb, DistanceBackend())
+    bdb.sql_execute('create table t(x, y)')
+    for x in [0, 10, 1, 20, 12, 3, 30]:
+        bdb.sql_execute('insert into t(x, y) values(?, ?)', (x, x))
+    bdb.execute('create population p for t(x numerical; y numerical)')
+    bdb.execute('create generator g for p using nig_normal')
+    bdb.execute('initialize 1 model for g')
+    return bdb
+
+def test_pairwise_similarity_batch():
+    with _bdb() as bdb:
+        # Without WHERE the matrix is computed in blocks up front; with
+        # it, pair by pair, so the results must agree.
+        batched = bdb.execute('''
+            estimate similarity in the context of x from pairwise p
+        ''').fetchall()
+        assert len(batched) == 49
+        assert batched == bdb.execute('''
+            estimate similarity in the context of x from pairwise p where 1
+        ''').fetchall()
+        batched = bdb.execute('''
+            estimate similarity in the context of x from pairwise p
+                order by similarity in the context of x desc, rowid0, rowid1
+                limit 8
+        ''').fetchall()
+        # The matrix is computed once for both mentions.
+        assert bdb.temp_table_name() == 'bayesdb_temp_2'
+        assert [(r0, r1) for r0, r1, _value in batched] == \
+            [(i, i) for i in xrange(1, 8)] + [(1, 3)]
+        with pytest.raises(BQLError):
+            bdb.execute('''
+                estimate similarity in the context of * from pairwise p
+            ''')
+
+def test_pairwise_similarity_top():
+    with _bdb() as bdb:
+        stored = []
+        def trace(string, bindings):
+            if string.startswith('INSERT INTO "bayesdb_temp_'):
+                stored.append(len(bindings) / 3)
+        bdb.sql_trace(trace)
+        # ORDER BY SIMILARITY ... LIMIT stores only the best pairs, and
+        # any tied with them, and agrees with the query computed pair by
+        # pair.
+        for order in ['desc, rowid0, rowid1', 'desc, rowid1 desc, rowid0',
+                'asc, rowid0, rowid1', 'asc, rowid1, rowid0']:
+            for limit, offset in [(0, 0), (1, 0), (3, 2), (8, 0), (100, 0),
+                    (-1, 3)]:
+                del stored[:]
+                query = '''
+                    estimate similarity in the context of x from pairwise p
+                        %s order by similarity in the context of x %s
+                        limit ? offset ?
+                '''
+                top = bdb.execute(query % ('', order), (limit, offset))
+                assert top.fetchall() == bdb.execute(query % ('where 1', order),
+                    (limit, offset)).fetchall()
+                if limit < 0:
+                    assert sum(stored) == 49
+                elif order.startswith('desc') and limit + offset <= 7:
+                    # The diagonal is all ties for the most similar.
+                    assert sum(stored) == (7 if limit + offset else 0)
+                else:
+                    # Other similarities come in symmetric pairs.
+                    n = min(limit + offset, 49)
+                    assert n <= sum(stored) <= n + 2
+        bdb.sql_untrace(trace)
+
+def test_row_similarities():
+    with _bdb() as bdb:
+        pairwise = list(bayesdb_row_similarities(bdb, 'p', 'x', block_size=3))
+        assert pairwise == bdb.execute('''
+            estimate similarity in the context of x from pairwise p
+        ''').fetchall()
+        neighbours = list(bayesdb_row_similarities(bdb, 'p', 'x', k=2,
+            block_size=3))
+        assert [(r0, r1) for r0, r1, _value in neighbours] == [
+            (1, 3), (1, 6),
+            (2, 5), (2, 6),
+            (3, 1), (3, 6),
+            (4, 5), (4, 2),
+            (5, 2), (5, 4),
+            (6, 3), (6, 1),
+            (7, 4), (7, 5),
+        ]
+        assert neighbours[0][2] == 1. / 2
+        assert len(list(bayesdb_row_similarities(bdb, 'p', 'x', k=10))) == 42
+        assert list(bayesdb_row_similarities(bdb, 'p', 'x', k=0)) == []
+        with pytest.raises(BQLError):
+            bayesdb_row_similarities(bdb, 'q', 'x')
+        with pytest.raises(BQLError):
+            bayesdb_row_similarities(bdb, 'p', 'z')
+        with pytest.raises(ValueError):
+            bayesdb_row_similarities(bdb, 'p', 'x', k=-1)
+
+def test_row_similarities_exported():
+    assert bayeslite.bayesdb_row_similarities is bayesdb_row_similarities